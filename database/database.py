@@ -1,6 +1,12 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from starlette.requests import Request
+from utils.tracing import TRACING_ENABLED, instrument_engine
+import itertools
+import threading
+import time
 
 import os
 from dotenv import load_dotenv
@@ -8,18 +14,130 @@ from dotenv import load_dotenv
 load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.environ["CONNECTION_STRING"]
+READ_REPLICA_CONNECTION_STRINGS = [url.strip() for url in os.environ.get(
+    "READ_REPLICA_CONNECTION_STRINGS", "").split(",") if url.strip()]
+READ_REPLICA_HEALTH_INTERVAL = float(
+    os.environ.get("READ_REPLICA_HEALTH_INTERVAL", 10))
+READ_REPLICA_STICKY_SECONDS = int(
+    os.environ.get("READ_REPLICA_STICKY_SECONDS", 5))
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={
-                       'connect_timeout': 10}, pool_pre_ping=True)
+# set on responses to requests that wrote, so that the client's reads go to
+# the primary until the replicas have caught up
+STICKY_COOKIE = "read_primary"
+
+
+def get_connect_args(url):
+    if url.startswith("sqlite"):
+        return {"check_same_thread": False}
+    return {'connect_timeout': 10}
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=get_connect_args(
+    SQLALCHEMY_DATABASE_URL), pool_pre_ping=True)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if TRACING_ENABLED:
+    instrument_engine(engine)
 
 Base = declarative_base()
 
 
-def get_db():
+class Replica:
+    def __init__(self, url):
+        self.engine = create_engine(
+            url, connect_args=get_connect_args(url), pool_pre_ping=True)
+        self.session = sessionmaker(
+            autocommit=False, autoflush=False, bind=self.engine)
+        if TRACING_ENABLED:
+            instrument_engine(self.engine)
+        self.healthy = True
+        self.checked = 0.0
+        self._lock = threading.Lock()
+
+    def is_healthy(self):
+        # at most one probe per interval, the other requests use the last result
+        now = time.monotonic()
+        if now - self.checked < READ_REPLICA_HEALTH_INTERVAL or not self._lock.acquire(blocking=False):
+            return self.healthy
+        try:
+            self.checked = now
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            self.healthy = True
+        except Exception:
+            self.healthy = False
+        finally:
+            self._lock.release()
+        return self.healthy
+
+    def mark_unhealthy(self):
+        self.healthy = False
+        self.checked = time.monotonic()
+
+
+replicas = [Replica(url) for url in READ_REPLICA_CONNECTION_STRINGS]
+_next_replica = itertools.count()
+
+
+def pick_replica():
+    for _ in range(len(replicas)):
+        replica = replicas[next(_next_replica) % len(replicas)]
+        if replica.is_healthy():
+            return replica
+    return None
+
+
+@event.listens_for(Session, "after_flush")
+def mark_flush_write(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def mark_statement_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def mark_request_write(session):
+    request = session.info.get("request")
+    if session.info.pop("wrote", False) and request is not None:
+        request.state.db_wrote = True
+
+
+@event.listens_for(Session, "after_rollback")
+def clear_write(session):
+    session.info.pop("wrote", None)
+
+
+def request_session(request: Request = None):
+    # commits in the session mark the request as having written, for
+    # read_your_writes; sessions opened outside get_db pass it here
+    db = SessionLocal()
+    if request is not None:
+        db.info["request"] = request
+    return db
+
+
+def get_db(request: Request):
+    try:
+        db = request_session(request)
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db(request: Request):
+    replica = None
+    if replicas and not request.cookies.get(STICKY_COOKIE):
+        replica = pick_replica()
+
+    db = replica.session() if replica else SessionLocal()
     try:
-        db = SessionLocal()
         yield db
+    except OperationalError:
+        if replica:
+            replica.mark_unhealthy()
+        raise
     finally:
         db.close()
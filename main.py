@@ -1,11 +1,20 @@
 import logger.app_logger as app_logger
 from logger.app_logger_formatter import CustomFormatter
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Query
+from fastapi.responses import ORJSONResponse
 from http import HTTPStatus
 from fastapi.middleware.cors import CORSMiddleware
 import models.models as models
-from database.database import engine
-from routers import auth, user, service, tracker, gpt
+import utils.metrics as metrics
+from database.database import engine, replicas, STICKY_COOKIE, READ_REPLICA_STICKY_SECONDS
+from routers import auth, user, service, tracker, gpt, jobs
+from routers.auth import get_current_user, get_role_exception
+from utils.compression import compress_response
+from utils.jobs import job_pool
+from utils.threadpool import configure_threadpool, stop_sampler
+from utils.traffic_capture import TrafficCapture
+from utils.tracing import TraceRequests, exporter as trace_exporter
+from utils.openai_api import close_client
 from starlette.requests import Request
 from starlette.responses import Response
 from starlette.responses import JSONResponse
@@ -16,7 +25,8 @@ models.Base.metadata.create_all(bind=engine)
 app = FastAPI(
     title="GPT-3 Tools API",
     description="GPT-3 Tools API",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 formatter = CustomFormatter("%(asctime)s")
@@ -52,6 +62,16 @@ async def catch_exceptions_middleware(request: Request, call_next):
         return JSONResponse({"detail": "Internal server error"}, status_code=500)
 
 
+async def read_your_writes(request: Request, call_next):
+    response = await call_next(request)
+
+    if replicas and getattr(request.state, "db_wrote", False):
+        response.set_cookie(key=STICKY_COOKIE, value="1", max_age=READ_REPLICA_STICKY_SECONDS,
+                            httponly=True, secure=True, samesite="none")
+
+    return response
+
+
 def get_extra_info(request: Request, response: Response):
     return {"req": {
         "url": request.url.path,
@@ -79,6 +99,12 @@ async def log_request(request: Request, call_next):
 
 app.middleware("http")(cors_handler)
 app.middleware("http")(catch_exceptions_middleware)
+app.middleware("http")(read_your_writes)
+# inside the compression, it records uncompressed sizes and token usage
+app.add_middleware(TrafficCapture)
+app.middleware("http")(compress_response)
+# outermost, the request span includes the time spent in the other middlewares
+app.add_middleware(TraceRequests)
 # app.middleware("http")(log_request)
 
 app.include_router(auth.router)
@@ -86,8 +112,53 @@ app.include_router(user.router)
 app.include_router(service.router)
 app.include_router(tracker.router)
 app.include_router(gpt.router)
+app.include_router(jobs.router)
+
+
+@app.on_event("startup")
+async def set_threadpool_size():
+    configure_threadpool()
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    await job_pool.start()
 
 
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await job_pool.stop()
+
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    await close_client()
+
+
+@app.on_event("shutdown")
+async def stop_threadpool_sampler():
+    await stop_sampler()
+
+
+# the routes below never block, they run on the event loop
 @app.get("/ping")
-def ping():
+async def ping():
     return {"detail": "pong"}
+
+
+@app.get("/metrics")
+async def get_metrics(current_user: dict = Depends(get_current_user)):
+    # labels include API key names and per-user limiter state
+    if current_user["role"] != "admin":
+        raise get_role_exception()
+    return metrics.snapshot()
+
+
+@app.get("/traces")
+async def get_traces(limit: int = Query(200, ge=1), current_user: dict = Depends(get_current_user)):
+    # spans carry SQL and paths with user ids
+    if current_user["role"] != "admin":
+        raise get_role_exception()
+    # only exporters that keep spans in this process have recent()
+    recent = getattr(trace_exporter, "recent", None)
+    return recent(limit) if recent is not None else []
@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy import Column, Enum, Integer, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Enum, Float, Integer, String, DateTime, Boolean, ForeignKey, Text
 from sqlalchemy.orm import relationship
 from database.database import Base
 
@@ -35,6 +35,11 @@ class Services(Base):
     family = Column(String(100))
     created_date = Column(DateTime, default=datetime.datetime.utcnow)
     is_active = Column(Boolean, default=True)
+    model = Column(String(100))
+    temperature = Column(Float)
+    max_tokens = Column(Integer)
+    stop = Column(String(500))
+    cost_by_token = Column(Float)
 
     tracking = relationship("Tracking", back_populates="service")
 
@@ -47,6 +52,7 @@ class Tracking(Base):
     service_id = Column(Integer, ForeignKey("services.id"))
     insertion_date = Column(DateTime, default=datetime.datetime.utcnow)
     consumed_tokens = Column(Integer)
+    model = Column(String(100))
 
     user = relationship("Users", back_populates="tracking")
     service = relationship("Services", back_populates="tracking")
@@ -58,3 +64,38 @@ class InvalidJWT(Base):
     id = Column(Integer, primary_key=True, index=True)
     token = Column(String(500))
     insertion_date = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+class Jobs(Base):
+    __tablename__ = "jobs"
+
+    id = Column(String(32), primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    service_id = Column(Integer, ForeignKey("services.id"))
+    status = Column(Enum("queued", "running", "succeeded",
+                    "failed"), default="queued", index=True)
+    user_claims = Column(Text)
+    payload = Column(Text(16777215))
+    callback_url = Column(String(500))
+    status_code = Column(Integer)
+    result = Column(Text(16777215))
+    consumed_tokens = Column(Integer, default=0)
+    created_date = Column(DateTime, default=datetime.datetime.utcnow)
+    started_date = Column(DateTime)
+    finished_date = Column(DateTime)
+    expires_date = Column(DateTime, index=True)
+
+
+class CacheVersions(Base):
+    __tablename__ = "cache_versions"
+
+    key = Column(String(100), primary_key=True)
+    version = Column(Integer, default=0)
+
+
+class SessionLeases(Base):
+    __tablename__ = "session_leases"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    session_id = Column(String(32))
+    expires_date = Column(DateTime)
@@ -1,13 +1,17 @@
 from fastapi import Depends, HTTPException, status, APIRouter, Response
+from fastapi.concurrency import run_in_threadpool
 from typing import Optional, List
 import models.models as models
 from security.oauth2 import OAuth2PasswordBearerWithCookie
 from passlib.context import CryptContext
 from sqlalchemy.orm import Session
-from database.database import get_db
+from database.database import get_db, SessionLocal
+from utils.tracing import span
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from pydantic import BaseModel
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
+import time
 
 import os
 from dotenv import load_dotenv
@@ -17,6 +21,11 @@ load_dotenv()
 SECRET_KEY = os.environ["SECRET_KEY"]
 ALGORITHM = os.environ["ALGORITHM"]
 EXPIRATION_MINUTES = int(os.environ["EXPIRATION_MINUTES"])
+CLAIMS_CACHE_SIZE = int(os.environ.get("CLAIMS_CACHE_SIZE", 10000))
+# a token that was not revoked is only looked up again after this; other
+# processes take up to this long to see a logout
+TOKEN_REVOCATION_RECHECK = float(
+    os.environ.get("TOKEN_REVOCATION_RECHECK", 5))
 
 bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -27,6 +36,15 @@ router = APIRouter(prefix="/api/v1/auth",
                    tags=["Authentication"])
 
 
+class Token(BaseModel):
+    access_token: str
+    token_type: str
+
+
+class Detail(BaseModel):
+    detail: str
+
+
 def verify_password(plain_password, hashed_password):
     return bcrypt_context.verify(plain_password, hashed_password)
 
@@ -47,15 +65,79 @@ def create_access_token(username: str, user_id: int, user_role: str, subscriptio
     return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def get_current_user(token: str = Depends(oauth2_bearer), db: Session = Depends(get_db)):
-    old_token = db.query(models.InvalidJWT).filter(
-        models.InvalidJWT.token == token).first()
-    if old_token:
-        raise token_invalid_exception()
+_claims_cache = {}
+
+
+def decode_access_token(token: str):
+    # signature check without any DB access, so it is cheap enough to run
+    # before admission control; revocation is still checked by get_current_user
+    payload = _claims_cache.get(token)
+    if payload is not None and payload["exp"] > time.time():
+        return payload
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise get_user_exception()
+    if len(_claims_cache) >= CLAIMS_CACHE_SIZE:
+        _claims_cache.clear()
+    _claims_cache[token] = payload
+    return payload
+
+
+# token -> True once it is known to be revoked, otherwise the monotonic time
+# until which it is known not to be
+_revocations = {}
+
+
+def cached_revocation(token: str):
+    # None when the DB has to be asked
+    state = _revocations.get(token)
+    if state is True:
+        return True
+    if state is not None and state > time.monotonic():
+        return False
+    return None
+
+
+def lookup_revocation(token: str, db):
+    revoked = db.query(models.InvalidJWT.id).filter(
+        models.InvalidJWT.token == token).first() is not None
+    if len(_revocations) >= CLAIMS_CACHE_SIZE:
+        _revocations.clear()
+    _revocations[token] = True if revoked else time.monotonic() + \
+        TOKEN_REVOCATION_RECHECK
+    return revoked
+
+
+def lookup_revocation_in_session(token: str):
+    with SessionLocal() as db:
+        return lookup_revocation(token, db)
+
+
+def check_access_token(token: str, db):
+    # get_current_user for callers that are already off the event loop
+    with span("auth.get_current_user"):
+        revoked = cached_revocation(token)
+        if revoked is None:
+            revoked = lookup_revocation(token, db)
+        if revoked:
+            raise token_invalid_exception()
+        return user_from_claims(decode_access_token(token))
+
+
+async def get_current_user(token: str = Depends(oauth2_bearer)):
+    # async so that it runs on the event loop, a thread is only taken when
+    # the revocation has to be looked up
+    with span("auth.get_current_user"):
+        revoked = cached_revocation(token)
+        if revoked is None:
+            revoked = await run_in_threadpool(lookup_revocation_in_session, token)
+        if revoked:
+            raise token_invalid_exception()
+        return user_from_claims(decode_access_token(token))
+
+
+def user_from_claims(payload: dict):
     username: str = payload.get("sub")
     user_id: int = payload.get("id")
     user_role: str = payload.get("role")
@@ -66,7 +148,7 @@ def get_current_user(token: str = Depends(oauth2_bearer), db: Session = Depends(
     return {"username": username, "id": user_id, "role": user_role, "permissions": user_permissions, "subscription": user_subscription}
 
 
-@router.post("/login")
+@router.post("/login", response_model=Token)
 def login_for_access_token(response: Response, form_data: OAuth2PasswordRequestForm = Depends(),
                                  db: Session = Depends(get_db)):
     user = authenticate_user(form_data.username, form_data.password, db)
@@ -86,7 +168,7 @@ def login_for_access_token(response: Response, form_data: OAuth2PasswordRequestF
     return {"access_token": token, "token_type": "Bearer"}
 
 
-@router.post("/logout")
+@router.post("/logout", response_model=Detail)
 def logout(response: Response, token: str = Depends(oauth2_bearer), db: Session = Depends(get_db)):
     response.delete_cookie("access_token")
 
@@ -95,6 +177,7 @@ def logout(response: Response, token: str = Depends(oauth2_bearer), db: Session
 
     db.add(token_model)
     db.commit()
+    _revocations[token] = True
 
     return {"detail": "Logout successful"}
 
@@ -1,382 +1,206 @@
-from fastapi import Depends, APIRouter
-from fastapi.responses import JSONResponse
-from typing import List
-from sqlalchemy.orm import Session
-import models.models as models
-from database.database import get_db
-from pydantic import BaseModel
-from routers.auth import get_current_user, get_user_exception, get_permissions_exception
-from utils.openai_api import get_response
-
-from transformers import GPT2TokenizerFast
-
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-MAX_TOKENS = int(os.environ["MAX_TOKENS"])
-
-tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+import asyncio
+import json
+from typing import Optional
+from fastapi import Depends, APIRouter, Header, HTTPException, Request, status, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.security.utils import get_authorization_scheme_param
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+from database.database import SessionLocal
+from routers.auth import get_current_user, check_access_token, decode_access_token, oauth2_bearer
+import utils.metrics as metrics
+from utils.deadline import request_deadline, set_deadline, GPT_REQUEST_TIMEOUT, REQUEST_TIMEOUT_MAX
+from utils.gpt_services import SERVICES, ServiceSpec, CompletionResponse
+from utils.idempotency import run_idempotent, fingerprint
+from utils.jobs import execute
+from utils.pipeline import run_service
+from utils.rate_limit import check_rate_limit
+from utils.sessions import SessionAccounting, origin_allowed, end_session, flush_periodically, logger, WS_MAX_IN_FLIGHT
+import math
 
 router = APIRouter(prefix="/api/v1/services/gpt-3",
                    tags=["GPT-3"])
 
 
-def capacity_token_count(db, user_id, service_id, prompt_template):
-    tokens_to_consume = len(tokenizer(prompt_template)["input_ids"])
-    available_tokens = db.query(models.Permissions).filter(models.Permissions.service_id == service_id).filter(
-        models.Permissions.user_id == user_id).first().available_tokens
-    if tokens_to_consume > available_tokens:
-        return JSONResponse(
-            status_code=402, content={"detail": "You do not have enough tokens available.", "tokens_to_consume": tokens_to_consume, "available_tokens": available_tokens})
-    return None
-
-
-def maximum_token_count(prompt_template):
-    max_tokens = MAX_TOKENS
-    tokens_to_consume = len(tokenizer(prompt_template)["input_ids"])
-    if tokens_to_consume > max_tokens:
-        return JSONResponse(status_code=413, content={
-            "detail": "Maximum capacity of tokens per request exceeded.", "maximum_allowed": max_tokens})
-    return None
-
-
-def check_if_service_is_activate(db, service_id):
-    is_active = db.query(models.Services).filter(
-        models.Services.id == service_id).first().is_active
-    if not is_active:
-        return JSONResponse(status_code=409, content={
-            "detail": "The service was deactivated."})
-    return None
-
-
-class PromptBase(BaseModel):
-    sentence: str
-
-
-class PromptTranslation(BaseModel):
-    sentence: str
-    source: str
-    target: str
-
-
-class PromptIntent(BaseModel):
-    sentence: str
-    tags: List[str]
-
-
-class PromptWriter(BaseModel):
-    message_type: str
-    sender: str
-    recipient: str
-    tags: List[str]
-    word_limit: int
-
-
-@router.post("/lang-detection")
-async def lang_detection(prompt: PromptBase, user: dict = Depends(get_current_user),
-                         db: Session = Depends(get_db)):
-    service_id = 1
-
-    if user is None:
-        raise get_user_exception()
-
-    response = check_if_service_is_activate(db, service_id)
-    if response is not None:
-        return response
-
-    if service_id not in user["permissions"]:
-        raise get_permissions_exception()
-
-    prompt_template = f"Tell me what language this is sentence '{prompt.sentence}'. For example: english, spanish, french, etc."
-
-    response = maximum_token_count(prompt_template)
-    if response is not None:
-        return response
-
-    if user["subscription"] != "premium":
-        response = capacity_token_count(
-            db, user["id"], service_id, prompt_template)
-        if response is not None:
-            return response
-
-    response = await get_response(prompt_template)
-
-    consumed_tokens = response["usage"]["total_tokens"]
-
-    tracker_model = models.Tracking()
-    tracker_model.user_id = user["id"]
-    tracker_model.service_id = service_id
-    tracker_model.consumed_tokens = consumed_tokens
-
-    if user["subscription"] != "premium":
-        service_state = db.query(models.Permissions).filter(models.Permissions.user_id == user["id"]).filter(
-            models.Permissions.service_id == service_id).first()
-        service_state.available_tokens -= consumed_tokens
-        db.add(service_state)
-        db.commit()
-
-    db.add(tracker_model)
-    db.commit()
-
-    return response
-
-
-@router.post("/lang-translation")
-async def lang_translation(prompt: PromptTranslation, user: dict = Depends(get_current_user),
-                           db: Session = Depends(get_db)):
-    service_id = 2
-
-    if user is None:
-        raise get_user_exception()
-
-    response = check_if_service_is_activate(db, service_id)
-    if response is not None:
-        return response
-
-    if service_id not in user["permissions"]:
-        raise get_permissions_exception()
-
-    prompt_template = f"Translate this sentence from {prompt.source} to {prompt.target}: '{prompt.sentence}'"
-
-    response = maximum_token_count(prompt_template)
-    if response is not None:
-        return response
-
-    if user["subscription"] != "premium":
-        response = capacity_token_count(
-            db, user["id"], service_id, prompt_template)
-        if response is not None:
-            return response
-
-    response = await get_response(prompt_template)
-
-    consumed_tokens = response["usage"]["total_tokens"]
-
-    tracker_model = models.Tracking()
-    tracker_model.user_id = user["id"]
-    tracker_model.service_id = service_id
-    tracker_model.consumed_tokens = consumed_tokens
-
-    if user["subscription"] != "premium":
-        service_state = db.query(models.Permissions).filter(models.Permissions.user_id == user["id"]).filter(
-            models.Permissions.service_id == service_id).first()
-        service_state.available_tokens -= consumed_tokens
-        db.add(service_state)
-        db.commit()
-
-    db.add(tracker_model)
-    db.commit()
-
-    return response
-
-
-@router.post("/sentiment-detect")
-async def sentiment_detect(prompt: PromptBase, user: dict = Depends(get_current_user),
-                           db: Session = Depends(get_db)):
-    service_id = 3
-
-    if user is None:
-        raise get_user_exception()
-
-    response = check_if_service_is_activate(db, service_id)
-    if response is not None:
-        return response
-
-    if service_id not in user["permissions"]:
-        raise get_permissions_exception()
-
-    prompt_template = f"Classify the following sentence as negative, neutral or positive: '{prompt.sentence}'"
-
-    response = maximum_token_count(prompt_template)
-    if response is not None:
-        return response
-
-    if user["subscription"] != "premium":
-        response = capacity_token_count(
-            db, user["id"], service_id, prompt_template)
-        if response is not None:
-            return response
-
-    response = await get_response(prompt_template)
-
-    consumed_tokens = response["usage"]["total_tokens"]
-
-    tracker_model = models.Tracking()
-    tracker_model.user_id = user["id"]
-    tracker_model.service_id = service_id
-    tracker_model.consumed_tokens = consumed_tokens
-
-    if user["subscription"] != "premium":
-        service_state = db.query(models.Permissions).filter(models.Permissions.user_id == user["id"]).filter(
-            models.Permissions.service_id == service_id).first()
-        service_state.available_tokens -= consumed_tokens
-        db.add(service_state)
-        db.commit()
-
-    db.add(tracker_model)
-    db.commit()
-
-    return response
-
-
-@router.post("/intent-detection")
-async def intent_detection(prompt: PromptIntent, user: dict = Depends(get_current_user),
-                           db: Session = Depends(get_db)):
-    service_id = 4
-
-    if user is None:
-        raise get_user_exception()
-
-    response = check_if_service_is_activate(db, service_id)
-    if response is not None:
-        return response
-
-    if service_id not in user["permissions"]:
-        raise get_permissions_exception()
-
-    tags = " or ".join(prompt.tags)
-    prompt_template = f"Is the intent behind the following text {tags}: '{prompt.sentence}'.Please, only give me a option into tags."
-
-    response = maximum_token_count(prompt_template)
-    if response is not None:
-        return response
-
-    if user["subscription"] != "premium":
-        response = capacity_token_count(
-            db, user["id"], service_id, prompt_template)
-        if response is not None:
-            return response
-
-    response = await get_response(prompt_template)
-
-    consumed_tokens = response["usage"]["total_tokens"]
-
-    tracker_model = models.Tracking()
-    tracker_model.user_id = user["id"]
-    tracker_model.service_id = service_id
-    tracker_model.consumed_tokens = consumed_tokens
-
-    if user["subscription"] != "premium":
-        service_state = db.query(models.Permissions).filter(models.Permissions.user_id == user["id"]).filter(
-            models.Permissions.service_id == service_id).first()
-        service_state.available_tokens -= consumed_tokens
-        db.add(service_state)
-        db.commit()
-
-    db.add(tracker_model)
-    db.commit()
-
-    return response
-
-
-@router.post("/summarize")
-async def summarize(prompt: PromptBase, user: dict = Depends(get_current_user),
-                    db: Session = Depends(get_db)):
-    service_id = 5
-
-    if user is None:
-        raise get_user_exception()
-
-    response = check_if_service_is_activate(db, service_id)
-    if response is not None:
-        return response
-
-    response = check_if_service_is_activate(db, service_id)
-    if response is not None:
-        return response
-
-    if service_id not in user["permissions"]:
-        raise get_permissions_exception()
-
-    prompt_template = f"Extract the key points from this message: '{prompt.sentence}'"
-
-    response = maximum_token_count(prompt_template)
-    if response is not None:
-        return response
-
-    if user["subscription"] != "premium":
-        response = capacity_token_count(
-            db, user["id"], service_id, prompt_template)
-        if response is not None:
-            return response
-
-    response = await get_response(prompt_template)
-
-    consumed_tokens = response["usage"]["total_tokens"]
-
-    tracker_model = models.Tracking()
-    tracker_model.user_id = user["id"]
-    tracker_model.service_id = service_id
-    tracker_model.consumed_tokens = consumed_tokens
-
-    if user["subscription"] != "premium":
-        service_state = db.query(models.Permissions).filter(models.Permissions.user_id == user["id"]).filter(
-            models.Permissions.service_id == service_id).first()
-        service_state.available_tokens -= consumed_tokens
-        db.add(service_state)
-        db.commit()
-
-    db.add(tracker_model)
-    db.commit()
-
-    return response
-
-
-@router.post("/writer")
-async def writer(prompt: PromptWriter, user: dict = Depends(get_current_user),
-                 db: Session = Depends(get_db)):
-    service_id = 6
-
-    if user is None:
-        raise get_user_exception()
-
-    response = check_if_service_is_activate(db, service_id)
-    if response is not None:
-        return response
-
-    if service_id not in user["permissions"]:
-        raise get_permissions_exception()
-
-    tags = ", ".join(prompt.tags)
-    prompt_template = f'''
-    Create a {prompt.message_type} with next considerations:
-
-    1. Customer Name: {prompt.recipient}
-    2. Bullet points: {tags}.
-    3. Write the message in {prompt.word_limit} words
-    
-    And finally, regards from sender: {prompt.sender}
-    '''
-
-    response = maximum_token_count(prompt_template)
-    if response is not None:
-        return response
-
-    if user["subscription"] != "premium":
-        response = capacity_token_count(
-            db, user["id"], service_id, prompt_template)
-        if response is not None:
-            return response
-
-    response = await get_response(prompt_template)
-
-    consumed_tokens = response["usage"]["total_tokens"]
-
-    tracker_model = models.Tracking()
-    tracker_model.user_id = user["id"]
-    tracker_model.service_id = service_id
-    tracker_model.consumed_tokens = consumed_tokens
-
-    if user["subscription"] != "premium":
-        service_state = db.query(models.Permissions).filter(models.Permissions.user_id == user["id"]).filter(
-            models.Permissions.service_id == service_id).first()
-        service_state.available_tokens -= consumed_tokens
-        db.add(service_state)
-        db.commit()
-
-    db.add(tracker_model)
-    db.commit()
-
-    return response
+def rate_limit(service_id):
+    # async so that it runs on the event loop: rejected requests never reach
+    # the threadpool, the DB or the tokenizer
+    async def dependency(token: str = Depends(oauth2_bearer)):
+        payload = decode_access_token(token)
+        retry_after = check_rate_limit(
+            payload.get("id"), payload.get("subscription"), service_id)
+        if retry_after:
+            raise get_rate_limit_exception(retry_after)
+    return dependency
+
+
+def add_service_route(spec: ServiceSpec):
+    request_model = spec.request_model
+
+    # no get_db: a session dependency would hold a thread for the whole
+    # request, run_service opens its own in the threadpool when it needs one
+    async def handler(prompt: request_model, request: Request, user: dict = Depends(get_current_user),
+                      idempotency_key: Optional[str] = Header(None, max_length=255)):
+        if idempotency_key is None or user is None:
+            return await run_service(spec, prompt, user, request=request)
+        # retries with the same key get the first response back, without a
+        # second upstream call or debit
+        return await run_idempotent(f"{user['id']}:{spec.service_id}:{idempotency_key}",
+                                    fingerprint(prompt.dict()),
+                                    lambda: run_service(spec, prompt, user, request=request))
+
+    handler.__name__ = spec.name
+    # the error bodies are returned as JSONResponse and skip the model
+    router.add_api_route(spec.path, handler, methods=["POST"],
+                         response_model=CompletionResponse, response_model_exclude_unset=True,
+                         dependencies=[Depends(request_deadline(GPT_REQUEST_TIMEOUT)),
+                                       Depends(rate_limit(spec.service_id))])
+
+
+for spec in SERVICES:
+    add_service_route(spec)
+
+
+SERVICES_BY_NAME = {spec.name: spec for spec in SERVICES}
+
+
+def authenticate_session(websocket: WebSocket):
+    # the token is checked in full once per connection, its expiry and
+    # revocation again on every flush tick, not once per message
+    scheme, token = get_authorization_scheme_param(
+        websocket.cookies.get("access_token"))
+    if scheme.lower() != "bearer":
+        return None
+    db = SessionLocal()
+    try:
+        user = check_access_token(token, db)
+        accounting = SessionAccounting(
+            user, token, decode_access_token(token).get("exp"))
+        if accounting.needs_lease() and not accounting.claim_lease(db):
+            accounting.ended = "Another session of this user is open"
+            return accounting
+        accounting.load(db)
+        return accounting
+    except HTTPException:
+        return None
+    finally:
+        db.close()
+
+
+@router.websocket("/session")
+async def session(websocket: WebSocket):
+    # one authenticated connection for many invocations of any GPT service:
+    # clients send {"request_id", "service", "payload"} and get back
+    # {"request_id", "status_code", "body"} as each invocation finishes, in
+    # whatever order they finish; an optional "timeout" in seconds works like
+    # the X-Request-Timeout header
+    if not origin_allowed(websocket.headers.get("origin")):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    accounting = await run_in_threadpool(authenticate_session, websocket)
+    if accounting is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if not accounting.active():
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=accounting.ended)
+        return
+    await websocket.accept()
+    user = accounting.user
+
+    send_lock = asyncio.Lock()
+    in_flight = asyncio.Semaphore(WS_MAX_IN_FLIGHT)
+    tasks = set()
+    connected = True
+
+    async def close(reason):
+        nonlocal connected
+        async with send_lock:
+            if connected:
+                connected = False
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=reason)
+
+    async def send(request_id, status_code, body):
+        metrics.counter("ws_messages_total", status=str(status_code)).inc()
+        async with send_lock:
+            if connected:
+                await websocket.send_text(json.dumps({"request_id": request_id, "status_code": status_code,
+                                                      "body": jsonable_encoder(body)}))
+
+    async def invoke(request_id, spec, payload, timeout):
+        # each invocation is its own task, the deadline is local to it
+        set_deadline(min(timeout, REQUEST_TIMEOUT_MAX))
+        try:
+            retry_after = check_rate_limit(
+                user["id"], user["subscription"], spec.service_id)
+            if retry_after:
+                await send(request_id, 429, {"detail": "Rate limit exceeded, please retry later",
+                                             "retry_after": math.ceil(retry_after)})
+                return
+            try:
+                prompt = spec.request_model(**payload)
+            except (ValidationError, TypeError) as e:
+                await send(request_id, 422, {"detail": e.errors() if isinstance(e, ValidationError) else str(e)})
+                return
+            status_code, body = await execute(spec, prompt, user, accounting)
+            await send(request_id, status_code, body)
+        except Exception as e:
+            logger.error(f"Session invocation failed: {str(e)}")
+        finally:
+            in_flight.release()
+
+    metrics.gauge("ws_sessions_active").inc()
+    flusher = asyncio.create_task(flush_periodically(accounting, close))
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except ValueError:
+                await send(None, 400, {"detail": "Messages must be JSON objects"})
+                continue
+            if not isinstance(message, dict) or message.get("request_id") is None:
+                await send(None, 400, {"detail": "Messages need a request_id"})
+                continue
+            if not accounting.active():
+                await close(accounting.ended)
+                break
+            spec = SERVICES_BY_NAME.get(message.get("service"))
+            if spec is None:
+                await send(message["request_id"], 404, {"detail": "Service not found"})
+                continue
+
+            timeout = message.get("timeout", GPT_REQUEST_TIMEOUT)
+            if not isinstance(timeout, (int, float)) or timeout <= 0:
+                await send(message["request_id"], 400, {"detail": "timeout must be a positive number of seconds"})
+                continue
+
+            # backpressure: stop reading once too many invocations are running
+            await in_flight.acquire()
+            task = asyncio.create_task(invoke(
+                message["request_id"], spec, message.get("payload") or {}, timeout))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        connected = False
+        # invocations already sent upstream still finish so that their usage
+        # is tracked, then whatever is left is written out
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        flusher.cancel()
+        try:
+            await run_in_threadpool(end_session, accounting)
+        except Exception as e:
+            logger.error(
+                f"Session tracking lost {len(accounting.pending)} rows: {str(e)}")
+        metrics.gauge("ws_sessions_active").dec()
+
+
+# exceptions
+def get_rate_limit_exception(retry_after):
+    rate_limit_exception = HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Rate limit exceeded, please retry later",
+        headers={"Retry-After": str(math.ceil(retry_after))}
+    )
+    return rate_limit_exception
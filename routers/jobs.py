@@ -0,0 +1,136 @@
+from fastapi import Depends, APIRouter, HTTPException, status
+from pydantic import BaseModel, HttpUrl, ValidationError
+from sqlalchemy.orm import Session
+from typing import Any, Optional
+from datetime import datetime
+import json
+import uuid
+import models.models as models
+from database.database import get_db
+from routers.auth import get_current_user, get_user_exception, get_permissions_exception, get_role_exception
+from routers.gpt import get_rate_limit_exception
+from utils.gpt_services import SERVICES_BY_NAME
+from utils.jobs import job_pool, job_to_dict, count_active_jobs, check_callback_url, JOB_MAX_CONCURRENT_PER_USER
+from utils.rate_limit import check_rate_limit
+
+router = APIRouter(prefix="/api/v1/jobs",
+                   tags=["Jobs"])
+
+
+class CreateJob(BaseModel):
+    payload: dict
+    callback_url: Optional[HttpUrl] = None
+
+
+class JobAccepted(BaseModel):
+    job_id: str
+    status: str
+
+
+class JobResponse(BaseModel):
+    job_id: str
+    service_id: int
+    status: str
+    status_code: Optional[int]
+    result: Optional[Any]
+    consumed_tokens: Optional[int]
+    created_date: Optional[datetime]
+    finished_date: Optional[datetime]
+    expires_date: Optional[datetime]
+
+
+@router.post("/{service_name}", response_model=JobAccepted, status_code=status.HTTP_202_ACCEPTED)
+def create_job(service_name: str, new_job: CreateJob, user: dict = Depends(get_current_user),
+               db: Session = Depends(get_db)):
+    if user is None:
+        raise get_user_exception()
+
+    spec = SERVICES_BY_NAME.get(service_name.replace("-", "_"))
+    if spec is None:
+        raise get_service_not_found_exception()
+
+    if spec.service_id not in user["permissions"]:
+        raise get_permissions_exception()
+
+    try:
+        spec.request_model(**new_job.payload)
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.errors())
+
+    retry_after = check_rate_limit(
+        user["id"], user["subscription"], spec.service_id)
+    if retry_after:
+        raise get_rate_limit_exception(retry_after)
+
+    if new_job.callback_url and not check_callback_url(new_job.callback_url):
+        raise get_callback_not_allowed_exception()
+
+    if count_active_jobs(db, user["id"]) >= JOB_MAX_CONCURRENT_PER_USER:
+        raise get_too_many_jobs_exception()
+
+    job_model = models.Jobs()
+    job_model.id = uuid.uuid4().hex
+    job_model.user_id = user["id"]
+    job_model.service_id = spec.service_id
+    job_model.status = "queued"
+    job_model.user_claims = json.dumps(user)
+    job_model.payload = json.dumps(new_job.payload)
+    job_model.callback_url = str(
+        new_job.callback_url) if new_job.callback_url else None
+
+    db.add(job_model)
+    db.commit()
+
+    job_pool.submit(job_model.id)
+
+    return {"job_id": job_model.id, "status": job_model.status}
+
+
+@router.get("/{job_id}", response_model=JobResponse)
+def get_job(job_id: str, user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+    if user is None:
+        raise get_user_exception()
+
+    job = db.query(models.Jobs).filter(models.Jobs.id == job_id).first()
+
+    if not job:
+        raise get_job_not_found_exception()
+
+    if user["role"] != "admin" and job.user_id != user["id"]:
+        raise get_role_exception()
+
+    return job_to_dict(job)
+
+
+# exceptions
+def get_service_not_found_exception():
+    service_not_found_exception = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="Service not found"
+    )
+    return service_not_found_exception
+
+
+def get_job_not_found_exception():
+    job_not_found_exception = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="Job not found"
+    )
+    return job_not_found_exception
+
+
+def get_too_many_jobs_exception():
+    too_many_jobs_exception = HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Maximum number of concurrent jobs reached"
+    )
+    return too_many_jobs_exception
+
+
+def get_callback_not_allowed_exception():
+    callback_not_allowed_exception = HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail="callback_url must point to a public host"
+    )
+    return callback_not_allowed_exception
@@ -1,21 +1,91 @@
-from fastapi import Depends, APIRouter, HTTPException, status
-from database.database import get_db
-from pydantic import BaseModel
+from fastapi import Depends, APIRouter, HTTPException, Request, status
+from database.database import get_db, get_read_db
+from pydantic import BaseModel, Field, constr, validator
+from typing import List, Optional
+from datetime import datetime
+import json
 import models.models as models
 from sqlalchemy.orm import Session
 from routers.auth import get_current_user, get_user_exception, get_user_not_found_exception, get_role_exception, bcrypt_context
+from utils.http_cache import precondition, cached_json_response, bump_version
+from utils.service_config import invalidate_service_configs
 
 router = APIRouter(prefix="/api/v1/services",
                    tags=["Services"])
 
 
+# the versioned endpoints read from the primary: a body read from a lagging
+# replica right after a bump would be cached under the new version
+def all_services_resource(request, user):
+    return "services", "services"
+
+
+def services_by_family_resource(request, user):
+    return f"services:family:{request.path_params['family']}", "services"
+
+
+def services_by_user_resource(request, user):
+    user_id = request.path_params["user_id"]
+    if user_id.isdigit():
+        user_id = int(user_id)
+    if user["role"] == "user" and user_id != user["id"]:
+        raise get_role_exception()
+    return f"permissions:{user_id}", f"permissions:{user_id}"
+
+
 class CreateService(BaseModel):
     name: str
     family: str
     is_active: bool
+    # unset model settings fall back to the service defaults and ENGINE,
+    # TEMPERATURE and MAX_TOKENS; unset pricing to MODEL_PRICING and COST_BY_TOKEN
+    model: Optional[str] = Field(None, max_length=100)
+    temperature: Optional[float] = Field(None, ge=0, le=2)
+    max_tokens: Optional[int] = Field(None, gt=0)
+    stop: Optional[List[constr(max_length=100)]] = Field(None, max_items=4)
+    cost_by_token: Optional[float] = Field(None, ge=0)
+
 
+class ServiceResponse(BaseModel):
+    id: int
+    name: str
+    family: str
+    created_date: Optional[datetime]
+    is_active: Optional[bool]
+    model: Optional[str]
+    temperature: Optional[float]
+    max_tokens: Optional[int]
+    stop: Optional[List[str]]
+    cost_by_token: Optional[float]
 
-@router.post("/register")
+    @validator("stop", pre=True)
+    def stop_from_json(cls, v):
+        return json.loads(v) if isinstance(v, str) else v
+
+    class Config:
+        orm_mode = True
+
+
+def set_model_settings(service_model, new_service: CreateService):
+    service_model.model = new_service.model
+    service_model.temperature = new_service.temperature
+    service_model.max_tokens = new_service.max_tokens
+    service_model.stop = json.dumps(
+        new_service.stop) if new_service.stop else None
+    service_model.cost_by_token = new_service.cost_by_token
+
+
+class PermissionResponse(BaseModel):
+    id: int
+    user_id: int
+    service_id: int
+    available_tokens: Optional[int]
+
+    class Config:
+        orm_mode = True
+
+
+@router.post("/register", response_model=CreateService)
 def create_service(new_service: CreateService, current_user: dict = Depends(get_current_user),
                          db: Session = Depends(get_db)):
     if current_user is None:
@@ -27,23 +97,26 @@ def create_service(new_service: CreateService, current_user: dict = Depends(get_
     service_model = models.Services()
     service_model.name = new_service.name
     service_model.family = new_service.family
+    set_model_settings(service_model, new_service)
 
     db.add(service_model)
     db.commit()
+    invalidate_service_configs()
+    bump_version("services")
 
     return new_service
 
 
-@router.get("/")
-def get_all_services(db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+@router.get("/", response_model=List[ServiceResponse], dependencies=[Depends(precondition(all_services_resource))])
+def get_all_services(request: Request, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
 
-    return db.query(models.Services).all()
+    return cached_json_response(request, lambda: [ServiceResponse.from_orm(s) for s in db.query(models.Services).all()])
 
 
-@router.get("/{service_id}")
-def get_service(service_id: int, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+@router.get("/{service_id}", response_model=ServiceResponse)
+def get_service(service_id: int, db=Depends(get_read_db), current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
 
@@ -56,15 +129,15 @@ def get_service(service_id: int, db=Depends(get_db), current_user: dict = Depend
     return service
 
 
-@router.get("/family/{family}")
-def get_services_by_family(family: str, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+@router.get("/family/{family}", response_model=List[ServiceResponse], dependencies=[Depends(precondition(services_by_family_resource))])
+def get_services_by_family(family: str, request: Request, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
 
-    return db.query(models.Services).filter(models.Services.family == family).all()
+    return cached_json_response(request, lambda: [ServiceResponse.from_orm(s) for s in db.query(models.Services).filter(models.Services.family == family).all()])
 
 
-@router.put("/{service_id}")
+@router.put("/{service_id}", response_model=CreateService)
 def update_service(service_id: int, updated_service: CreateService, db=Depends(get_db),
                    current_user: dict = Depends(get_current_user)):
 
@@ -83,28 +156,34 @@ def update_service(service_id: int, updated_service: CreateService, db=Depends(g
     service.name = updated_service.name
     service.family = updated_service.family
     service.is_active = updated_service.is_active
+    set_model_settings(service, updated_service)
 
     db.add(service)
     db.commit()
+    invalidate_service_configs()
+    bump_version("services")
 
     return updated_service
 
 
-@router.get("/users/{user_id}")
-def get_services_by_user(user_id: int, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+@router.get("/users/{user_id}", response_model=List[PermissionResponse], dependencies=[Depends(precondition(services_by_user_resource))])
+def get_services_by_user(user_id: int, request: Request, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
 
     if current_user["role"] == "user" and user_id != current_user["id"]:
         raise get_role_exception()
 
-    services_by_user = db.query(models.Permissions).filter(
-        models.Permissions.user_id == user_id).all()
+    def load():
+        services_by_user = db.query(models.Permissions).filter(
+            models.Permissions.user_id == user_id).all()
+
+        if not services_by_user:
+            raise get_user_data_not_found_exception()
 
-    if not services_by_user:
-        raise get_user_data_not_found_exception()
+        return [PermissionResponse.from_orm(p) for p in services_by_user]
 
-    return services_by_user
+    return cached_json_response(request, load)
 
 
 # exceptions
@@ -1,73 +1,152 @@
+import csv
+import io
 from fastapi import Depends, APIRouter, HTTPException, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel
 from sqlalchemy.orm import Session
-from sqlalchemy import Date, cast
 import models.models as models
-from database.database import get_db
+from database.database import get_read_db
 from routers.auth import get_current_user, get_user_exception, get_role_exception
-from typing import Optional
-from datetime import date
+from utils.service_config import get_service_configs, token_price, service_price
+from utils.tracking_archive import read_archived
+from typing import List, Optional
+from datetime import date, datetime, time, timedelta
 
-import os
-from dotenv import load_dotenv
+router = APIRouter(prefix="/api/v1/tracker",
+                   tags=["Tracking"])
 
-load_dotenv()
 
+class TrackingRow(BaseModel):
+    id: int
+    user_id: int
+    service_id: int
+    insertion_date: datetime
+    consumed_tokens: int
+    model: Optional[str]
+    price: float
+    username: Optional[str]
+    service_name: Optional[str]
 
-COST_BY_TOKEN = float(os.environ["COST_BY_TOKEN"])
 
-router = APIRouter(prefix="/api/v1/tracker",
-                   tags=["Tracking"])
+class TrackingSummary(BaseModel):
+    user_id: Optional[int]
+    username: Optional[str]
+    consumed_tokens: int
+    consumed_balance: float
+    available_tokens: Optional[int]
+    available_balance: Optional[float]
+
 
+class Historical(BaseModel):
+    historical: List[TrackingRow]
+    summary: List[TrackingSummary]
 
-@router.get("/historical")
+
+def filter_tracking(query, start_date, end_date, user_id=None, service_id=None):
+    if user_id is not None:
+        query = query.filter(models.Tracking.user_id == user_id)
+    if service_id is not None:
+        query = query.filter(models.Tracking.service_id == service_id)
+
+    if start_date and end_date:
+        # a plain range on the column, unlike a cast to DATE, can use an index
+        query = query.filter(models.Tracking.insertion_date >= datetime.combine(start_date, time())).filter(
+            models.Tracking.insertion_date < datetime.combine(end_date + timedelta(days=1), time()))
+    return query
+
+
+# the tracker responses can be very large: rows are read as plain tuples and
+# returned as an ORJSONResponse, the models above only document the shape
+def get_tracking_rows(db, start_date, end_date, user_id=None, service_id=None, names=False):
+    columns = [models.Tracking.id, models.Tracking.user_id, models.Tracking.service_id,
+               models.Tracking.insertion_date, models.Tracking.consumed_tokens, models.Tracking.model]
+    if names:
+        columns += [models.Users.username,
+                    models.Services.name.label("service_name")]
+
+    query = db.query(*columns)
+    if names:
+        query = query.join(models.Users, models.Users.id == models.Tracking.user_id).join(
+            models.Services, models.Services.id == models.Tracking.service_id)
+    query = filter_tracking(query, start_date, end_date, user_id, service_id)
+
+    keys = [c["name"] for c in query.column_descriptions]
+    data = [dict(zip(keys, row)) for row in query.all()]
+
+    archived = get_archived_rows(
+        db, start_date, end_date, user_id, service_id, names, {d["id"] for d in data})
+    data = archived + data
+
+    # rows are priced with the model that served them
+    configs = get_service_configs(db)
+    prices = {}
+    for d in data:
+        key = (d["service_id"], d["model"])
+        if key not in prices:
+            prices[key] = token_price(configs, *key)
+        d["price"] = round(d["consumed_tokens"]*prices[key], 2)
+    return data
+
+
+def get_archived_rows(db, start_date, end_date, user_id, service_id, names, hot_ids):
+    # rows moved to the segment files by scripts/archive_tracking.py; an id can
+    # be in both places if the job was interrupted, the SQL row wins
+    data = []
+    for d in read_archived(start_date, end_date, user_id, service_id):
+        if d["id"] in hot_ids:
+            continue
+        hot_ids.add(d["id"])
+        data.append(d)
+
+    if data and names:
+        usernames = dict(db.query(models.Users.id, models.Users.username).filter(
+            models.Users.id.in_({d["user_id"] for d in data})).all())
+        service_names = dict(db.query(models.Services.id, models.Services.name).filter(
+            models.Services.id.in_({d["service_id"] for d in data})).all())
+        data = [d for d in data if d["user_id"]
+                in usernames and d["service_id"] in service_names]
+        for d in data:
+            d["username"] = usernames[d["user_id"]]
+            d["service_name"] = service_names[d["service_id"]]
+    return data
+
+
+def summarize(data):
+    consumed_tokens = round(sum(r["consumed_tokens"] for r in data), 2)
+    consumed_balance = round(sum(r["price"] for r in data), 2)
+    return consumed_tokens, consumed_balance
+
+
+@router.get("/historical", response_model=Historical)
 def historical(
         start_date: Optional[date] = None, end_date: Optional[date] = None,
-        user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+        user: dict = Depends(get_current_user), db: Session = Depends(get_read_db)):
     if user is None:
         raise get_user_exception()
 
     if user["role"] != "admin":
         raise get_role_exception()
 
-    if start_date and end_date:
-        data = db.query(models.Tracking).filter(cast(models.Tracking.insertion_date, Date) <= end_date).filter(
-            cast(models.Tracking.insertion_date, Date) >= start_date).all()
-    else:
-        data = db.query(models.Tracking).all()
-
-    users = {}
-
-    for row in data:
-        username = row.user.username
-        service_name = row.service.name
-        row.username = username
-        row.service_name = service_name
-        delattr(row, "user")
-        delattr(row, "service")
-        users[row.user_id] = username
+    data = get_tracking_rows(db, start_date, end_date, names=True)
 
     if not data:
         raise get_user_data_not_found_exception()
 
-    data = [r.__dict__ for r in data]
+    by_user = {}
     for d in data:
-        d["price"] = round(d["consumed_tokens"]*COST_BY_TOKEN, 2)
+        by_user.setdefault(d["user_id"], []).append(d)
 
-    users_id = list(set(d["user_id"] for d in data))
     summary = []
-    for u in users_id:
-        user_data = list(filter(lambda d: d["user_id"] == u, data))
-        consumed_tokens = round(
-            sum(r["consumed_tokens"] for r in user_data), 2)
-        consumed_balance = round(sum(r["price"] for r in user_data), 2)
+    for u, user_data in by_user.items():
+        consumed_tokens, consumed_balance = summarize(user_data)
         summary.append(
-            {"user_id": u, "username": users[u], "consumed_tokens": consumed_tokens, "consumed_balance": consumed_balance})
+            {"user_id": u, "username": user_data[0]["username"], "consumed_tokens": consumed_tokens, "consumed_balance": consumed_balance})
 
-    return {"historical": data, "summary": summary}
+    return ORJSONResponse({"historical": data, "summary": summary})
 
 
-@router.get("/historical/user/{user_id}")
-def historical_by_user(user_id: int, user: dict = Depends(get_current_user), db: Session = Depends(get_db),
+@router.get("/historical/user/{user_id}", response_model=Historical)
+def historical_by_user(user_id: int, user: dict = Depends(get_current_user), db: Session = Depends(get_read_db),
                        start_date: Optional[date] = None, end_date: Optional[date] = None):
     if user is None:
         raise get_user_exception()
@@ -75,41 +154,26 @@ def historical_by_user(user_id: int, user: dict = Depends(get_current_user), db:
     if user["role"] == "user" and user_id != user["id"]:
         raise get_role_exception()
 
-    if start_date and end_date:
-        data = db.query(models.Tracking).filter(models.Tracking.user_id == user_id).filter(cast(
-            models.Tracking.insertion_date, Date) <= end_date).filter(cast(models.Tracking.insertion_date, Date) >= start_date).all()
-    else:
-        data = db.query(models.Tracking).filter(
-            models.Tracking.user_id == user_id).all()
-
-    for row in data:
-        username = row.user.username
-        service_name = row.service.name
-        row.username = username
-        row.service_name = service_name
-        delattr(row, "user")
-        delattr(row, "service")
-
-    user_permissions = db.query(models.Permissions).filter(
+    data = get_tracking_rows(db, start_date, end_date,
+                             user_id=user_id, names=True)
+
+    user_permissions = db.query(models.Permissions.service_id, models.Permissions.available_tokens).filter(
         models.Permissions.user_id == user_id).all()
 
     if not data and not user_permissions:
         raise get_user_data_not_found_exception()
 
-    data = [r.__dict__ for r in data]
-    for d in data:
-        d["price"] = round(d["consumed_tokens"]*COST_BY_TOKEN, 2)
-
-    user_data = list(filter(lambda d: d["user_id"] == user_id, data))
-    consumed_tokens = round(
-        sum(r["consumed_tokens"] for r in user_data), 2)
-    consumed_balance = round(sum(r["price"] for r in user_data), 2)
-
-    if db.query(models.Users).filter(
-            models.Users.id == user_id).first().subscription == "standard":
-        available_tokens = sum(
-            [r.available_tokens for r in user_permissions if r.available_tokens > 0])
-        available_balance = round(available_tokens * COST_BY_TOKEN, 2)
+    consumed_tokens, consumed_balance = summarize(data)
+
+    username, subscription = db.query(models.Users.username, models.Users.subscription).filter(
+        models.Users.id == user_id).first()
+
+    if subscription == "standard":
+        configs = get_service_configs(db)
+        available = [(s, t) for s, t in user_permissions if t > 0]
+        available_tokens = sum(t for _, t in available)
+        available_balance = round(
+            sum(t * service_price(configs, s) for s, t in available), 2)
     else:
         available_tokens = None
         available_balance = None
@@ -117,11 +181,11 @@ def historical_by_user(user_id: int, user: dict = Depends(get_current_user), db:
     summary = {"user_id": user_id, "username": username, "consumed_tokens": consumed_tokens,
                "consumed_balance": consumed_balance, "available_tokens": available_tokens, "available_balance": available_balance}
 
-    return {"historical": data, "summary": [summary]}
+    return ORJSONResponse({"historical": data, "summary": [summary]})
 
 
-@router.get("/historical/service/{service_id}")
-def historical_by_service(service_id: int, user: dict = Depends(get_current_user), db: Session = Depends(get_db),
+@router.get("/historical/service/{service_id}", response_model=Historical)
+def historical_by_service(service_id: int, user: dict = Depends(get_current_user), db: Session = Depends(get_read_db),
                           start_date: Optional[date] = None, end_date: Optional[date] = None):
     if user is None:
         raise get_user_exception()
@@ -129,31 +193,21 @@ def historical_by_service(service_id: int, user: dict = Depends(get_current_user
     if user["role"] != "admin":
         raise get_role_exception()
 
-    if start_date and end_date:
-        data = db.query(models.Tracking).filter(models.Tracking.service_id == service_id).filter(cast(
-            models.Tracking.insertion_date, Date) <= end_date).filter(cast(models.Tracking.insertion_date, Date) >= start_date).all()
-    else:
-        data = db.query(models.Tracking).filter(
-            models.Tracking.service_id == service_id).all()
+    data = get_tracking_rows(db, start_date, end_date,
+                             service_id=service_id)
 
     if not data:
         raise get_user_data_not_found_exception()
 
-    data = [r.__dict__ for r in data]
-    for d in data:
-        d["price"] = round(d["consumed_tokens"]*COST_BY_TOKEN, 2)
-
-    consumed_tokens = round(
-        sum(r["consumed_tokens"] for r in data), 2)
-    consumed_balance = round(sum(r["price"] for r in data), 2)
+    consumed_tokens, consumed_balance = summarize(data)
     summary = {"consumed_tokens": consumed_tokens,
                "consumed_balance": consumed_balance}
 
-    return {"historical": data, "summary": [summary]}
+    return ORJSONResponse({"historical": data, "summary": [summary]})
 
 
-@router.get("/historical/{user_id}/{service_id}")
-def historical_by_user_and_service(user_id: int, service_id: int, user: dict = Depends(get_current_user), db: Session = Depends(get_db),
+@router.get("/historical/{user_id}/{service_id}", response_model=Historical)
+def historical_by_user_and_service(user_id: int, service_id: int, user: dict = Depends(get_current_user), db: Session = Depends(get_read_db),
                                    start_date: Optional[date] = None, end_date: Optional[date] = None):
     if user is None:
         raise get_user_exception()
@@ -161,27 +215,73 @@ def historical_by_user_and_service(user_id: int, service_id: int, user: dict = D
     if user["role"] == "user" and user_id != user["id"]:
         raise get_role_exception()
 
-    if start_date and end_date:
-        data = db.query(models.Tracking).filter(models.Tracking.user_id == user_id).filter(models.Tracking.service_id == service_id).filter(
-            cast(models.Tracking.insertion_date, Date) <= end_date).filter(cast(models.Tracking.insertion_date, Date) >= start_date).all()
-    else:
-        data = db.query(models.Tracking).filter(models.Tracking.user_id == user_id).filter(
-            models.Tracking.service_id == service_id).all()
+    data = get_tracking_rows(db, start_date, end_date,
+                             user_id=user_id, service_id=service_id)
 
     if not data:
         raise get_user_data_not_found_exception()
 
-    data = [r.__dict__ for r in data]
-    for d in data:
-        d["price"] = round(d["consumed_tokens"]*COST_BY_TOKEN, 2)
-
-    consumed_tokens = round(
-        sum(r["consumed_tokens"] for r in data), 2)
-    consumed_balance = round(sum(r["price"] for r in data), 2)
+    consumed_tokens, consumed_balance = summarize(data)
     summary = {"user_id": user_id,
                "consumed_tokens": consumed_tokens, "consumed_balance": consumed_balance}
 
-    return {"historical": data, "summary": [summary]}
+    return ORJSONResponse({"historical": data, "summary": [summary]})
+
+
+EXPORT_COLUMNS = ["id", "user_id", "service_id", "insertion_date",
+                  "consumed_tokens", "model", "price"]
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_rows(db, start_date, end_date, user_id, service_id):
+    # SQL rows first so that archived copies of them can be skipped; rows are
+    # fetched in batches and never all held in memory
+    columns = [models.Tracking.id, models.Tracking.user_id, models.Tracking.service_id,
+               models.Tracking.insertion_date, models.Tracking.consumed_tokens, models.Tracking.model]
+    query = filter_tracking(db.query(*columns), start_date, end_date, user_id, service_id)
+    keys = [c["name"] for c in query.column_descriptions]
+    hot_ids = set()
+    for row in query.order_by(models.Tracking.id).yield_per(EXPORT_BATCH_SIZE):
+        hot_ids.add(row[0])
+        yield dict(zip(keys, row))
+
+    for row in read_archived(start_date, end_date, user_id, service_id):
+        if row["id"] not in hot_ids:
+            yield row
+
+
+def export_csv(db, start_date, end_date, user_id, service_id):
+    configs = get_service_configs(db)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for i, row in enumerate(export_rows(db, start_date, end_date, user_id, service_id), 1):
+        row["price"] = round(
+            row["consumed_tokens"]*token_price(configs, row["service_id"], row["model"]), 2)
+        writer.writerow([row[c] for c in EXPORT_COLUMNS])
+        if i % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@router.get("/export")
+def export(user_id: Optional[int] = None, service_id: Optional[int] = None,
+           start_date: Optional[date] = None, end_date: Optional[date] = None,
+           user: dict = Depends(get_current_user), db: Session = Depends(get_read_db)):
+    # every matching row as CSV, streamed; users can only export their own
+    if user is None:
+        raise get_user_exception()
+
+    if user["role"] != "admin":
+        if user_id is not None and user_id != user["id"]:
+            raise get_role_exception()
+        user_id = user["id"]
+
+    return StreamingResponse(export_csv(db, start_date, end_date, user_id, service_id),
+                             media_type="text/csv",
+                             headers={"Content-Disposition": 'attachment; filename="tracking.csv"'})
 
 
 # exceptions
@@ -1,14 +1,31 @@
-from fastapi import Depends, APIRouter
-from database.database import get_db
-from typing import List, Optional
-from pydantic import BaseModel, Field, validator
+from fastapi import Depends, APIRouter, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from database.database import get_db, get_read_db
+from typing import Any, List, Optional
+from datetime import datetime
+from pydantic import BaseModel, Field, ValidationError, validator
 import models.models as models
+from sqlalchemy import insert, update, delete, bindparam
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.orm import Session
-from routers.auth import get_current_user, get_user_exception, get_user_not_found_exception, get_role_exception, bcrypt_context
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import io
+import json
+from routers.auth import Detail, get_current_user, get_user_exception, get_user_not_found_exception, get_role_exception, bcrypt_context
+from utils.http_cache import bump_version
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
 
 
 password_regex = "((?=.*\d)(?=.*[a-z])(?=.*[A-Z])(?=.*[\W]).{8,64})"
 
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 1000))
+BULK_HASH_WORKERS = int(os.environ.get("BULK_HASH_WORKERS", 8))
+
 router = APIRouter(prefix="/api/v1/users",
                    tags=["Users"])
 
@@ -57,7 +74,105 @@ class UpdateUserAdmin(BaseModel):
         return v
 
 
-@router.post("/register")
+class PermissionChange(BaseModel):
+    user_id: int
+    service_id: int
+    action: str = Field("grant", regex="^(grant|revoke)$")
+    mode: str = Field("set", regex="^(set|add)$")
+    tokens: int = 0
+
+    @validator('tokens')
+    def tokens_greater_than_zero(cls, v):
+        if v < 0:
+            raise ValueError(
+                "service tokens must be greater or equal than zero")
+        return v
+
+
+class PermissionMatrix(BaseModel):
+    changes: List[PermissionChange]
+    dry_run: bool = False
+
+
+class UserResponse(BaseModel):
+    id: int
+    username: str
+    created_date: Optional[datetime]
+    role: str
+    subscription: str
+    is_active: Optional[bool]
+
+    class Config:
+        orm_mode = True
+
+
+# what the write routes echo back, the input without the password
+class CreatedUserResponse(BaseModel):
+    username: str
+    role: str
+    subscription: str
+    services: List[int]
+    tokens_by_service: List[int]
+
+
+class UpdatedUserResponse(BaseModel):
+    username: str
+
+
+class UpdatedUserAdminResponse(BaseModel):
+    username: str
+    role: str
+    subscription: str
+    services: List[int]
+    tokens_by_service: List[int]
+    services_to_delete: Optional[List[int]]
+
+
+class BulkRowResponse(BaseModel):
+    row: int
+    username: Optional[str]
+    status: str
+    detail: Optional[Any]
+
+
+class BulkUsersResponse(BaseModel):
+    created: int
+    failed: int
+    rows: List[BulkRowResponse]
+
+
+class PermissionChangeError(BaseModel):
+    row: int
+    detail: str
+
+
+class PermissionDiff(BaseModel):
+    action: str
+    user_id: int
+    service_id: int
+    from_tokens: Optional[int] = Field(alias="from")
+    to_tokens: Optional[int] = Field(alias="to")
+
+
+class PermissionMatrixResponse(BaseModel):
+    dry_run: bool
+    inserted: int
+    updated: int
+    deleted: int
+    errors: List[PermissionChangeError]
+    # only on dry runs
+    diff: Optional[List[PermissionDiff]]
+
+
+class CurrentUserResponse(BaseModel):
+    username: str
+    id: int
+    role: str
+    permissions: List[int]
+    subscription: str
+
+
+@router.post("/register", response_model=CreatedUserResponse)
 def create_user(new_user: CreateUser, current_user: dict = Depends(get_current_user),
                       db: Session = Depends(get_db)):
     if current_user is None:
@@ -96,28 +211,285 @@ def create_user(new_user: CreateUser, current_user: dict = Depends(get_current_u
     return new_user
 
 
-@router.get("/")
-def get_all_users(db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+def parse_bulk_rows(content_type, body):
+    # CSV columns: username,password,role,subscription,services,tokens_by_service
+    # where services and tokens_by_service are separated by ";"
+    if content_type.startswith("text/csv"):
+        rows = []
+        for row in csv.DictReader(io.StringIO(body.decode("utf-8-sig"))):
+            for key in ("services", "tokens_by_service"):
+                row[key] = [v for v in (row.get(key) or "").split(";") if v.strip()]
+            rows.append(row)
+        return rows
+
+    rows = json.loads(body)
+    if isinstance(rows, dict):
+        rows = rows.get("users", [])
+    if not isinstance(rows, list):
+        raise get_bulk_format_exception()
+    return rows
+
+
+def insert_user_chunk(db, chunk):
+    user_rows = [{"username": u.username, "password": hashed, "role": u.role,
+                  "subscription": u.subscription} for _, u, hashed in chunk]
+    db.execute(insert(models.Users), user_rows)
+
+    ids = dict(db.query(models.Users.username, models.Users.id).filter(
+        models.Users.username.in_([u.username for _, u, _ in chunk])).all())
+
+    permission_rows = []
+    for _, u, _ in chunk:
+        if u.subscription == "standard":
+            permission_rows += [{"user_id": ids[u.username], "service_id": s, "available_tokens": t}
+                                for s, t in zip(u.services, u.tokens_by_service)]
+        else:
+            permission_rows += [{"user_id": ids[u.username], "service_id": s}
+                                for s in u.services]
+    if permission_rows:
+        db.execute(insert(models.Permissions), permission_rows)
+
+
+def check_new_user(new_user: CreateUser, known_services):
+    # everything the DB would reject, so that no chunk fails halfway
+    if new_user.role not in models.Users.role.type.enums:
+        return "Unknown role"
+    if new_user.subscription not in models.Users.subscription.type.enums:
+        return "Unknown subscription"
+    if new_user.subscription == "standard" and len(new_user.services) != len(new_user.tokens_by_service):
+        return "services and tokens_by_service must have the same length"
+    if len(set(new_user.services)) != len(new_user.services):
+        return "Duplicate service ids"
+    unknown = sorted(set(new_user.services) - known_services)
+    if unknown:
+        return f"Unknown service ids: {unknown}"
+    return None
+
+
+def insert_failure(db, username, error):
+    if isinstance(error, IntegrityError) and db.query(models.Users.id).filter(
+            models.Users.username == username).first():
+        return "User already exists"
+    return str(error.orig)
+
+
+def provision_users(db, rows):
+    report = [None] * len(rows)
+    valid = []
+    seen = set()
+    known_services = {i for (i,) in db.query(models.Services.id).all()}
+    for i, row in enumerate(rows):
+        username = row.get("username") if isinstance(row, dict) else None
+        try:
+            new_user = CreateUser(**row)
+        except (ValidationError, TypeError) as e:
+            errors = e.errors() if isinstance(e, ValidationError) else str(e)
+            report[i] = {"row": i, "username": username,
+                         "status": "error", "detail": errors}
+            continue
+        if len(new_user.username) > models.Users.username.type.length:
+            report[i] = {"row": i, "username": username, "status": "error",
+                         "detail": "Username is too long"}
+            continue
+        detail = check_new_user(new_user, known_services)
+        if detail is not None:
+            report[i] = {"row": i, "username": username,
+                         "status": "error", "detail": detail}
+            continue
+        if new_user.username in seen:
+            report[i] = {"row": i, "username": username, "status": "error",
+                         "detail": "Duplicate username in request"}
+            continue
+        seen.add(new_user.username)
+        valid.append((i, new_user))
+
+    existing = set()
+    for start in range(0, len(valid), BULK_CHUNK_SIZE):
+        usernames = [u.username for _, u in valid[start:start + BULK_CHUNK_SIZE]]
+        existing.update(name for (name,) in db.query(models.Users.username).filter(
+            models.Users.username.in_(usernames)).all())
+
+    to_create = []
+    for i, new_user in valid:
+        if new_user.username in existing:
+            report[i] = {"row": i, "username": new_user.username,
+                         "status": "error", "detail": "User already exists"}
+        else:
+            to_create.append((i, new_user))
+
+    # bcrypt dominates the cost of provisioning and releases the GIL
+    with ThreadPoolExecutor(max_workers=BULK_HASH_WORKERS) as executor:
+        hashes = list(executor.map(get_password_hash,
+                      [u.password for _, u in to_create]))
+    to_create = [(i, u, h) for (i, u), h in zip(to_create, hashes)]
+
+    for start in range(0, len(to_create), BULK_CHUNK_SIZE):
+        chunk = to_create[start:start + BULK_CHUNK_SIZE]
+        try:
+            insert_user_chunk(db, chunk)
+            db.commit()
+            for i, u, _ in chunk:
+                report[i] = {"row": i, "username": u.username,
+                             "status": "created", "detail": None}
+        except DBAPIError:
+            # a concurrent insert took some of the usernames, or a service
+            # was deleted since the check; find which rows fail and why
+            db.rollback()
+            for entry in chunk:
+                i, u, _ = entry
+                try:
+                    insert_user_chunk(db, [entry])
+                    db.commit()
+                    report[i] = {"row": i, "username": u.username,
+                                 "status": "created", "detail": None}
+                except DBAPIError as e:
+                    db.rollback()
+                    report[i] = {"row": i, "username": u.username,
+                                 "status": "error", "detail": insert_failure(db, u.username, e)}
+
+    created = sum(1 for r in report if r["status"] == "created")
+    return {"created": created, "failed": len(report) - created, "rows": report}
+
+
+@router.post("/bulk", response_model=BulkUsersResponse)
+async def create_users_in_bulk(request: Request, current_user: dict = Depends(get_current_user),
+                               db: Session = Depends(get_db)):
     if current_user is None:
         raise get_user_exception()
 
     if current_user["role"] != "admin":
         raise get_role_exception()
 
-    users = [{i: u.__dict__[i] for i in u.__dict__ if i != "password"}
-             for u in db.query(models.Users).all()]
-    return users
+    body = await request.body()
+    try:
+        rows = parse_bulk_rows(request.headers.get("content-type", ""), body)
+    except (ValueError, csv.Error):
+        raise get_bulk_format_exception()
+
+    return await run_in_threadpool(provision_users, db, rows)
+
+
+def plan_permission_changes(db, changes):
+    user_ids = list({c.user_id for c in changes})
+    known_users = set()
+    current = {}
+    for start in range(0, len(user_ids), BULK_CHUNK_SIZE):
+        chunk = user_ids[start:start + BULK_CHUNK_SIZE]
+        known_users.update(i for (i,) in db.query(models.Users.id).filter(
+            models.Users.id.in_(chunk)).all())
+        for p in db.query(models.Permissions.id, models.Permissions.user_id, models.Permissions.service_id,
+                          models.Permissions.available_tokens).filter(models.Permissions.user_id.in_(chunk)).all():
+            current.setdefault((p.user_id, p.service_id),
+                               (p.id, p.available_tokens))
+    known_services = {i for (i,) in db.query(models.Services.id).all()}
+
+    # cells are applied in order; per (user, service) the net effect is either
+    # absent, an absolute value or a delta on top of the stored value
+    errors = []
+    final = {}
+    for i, c in enumerate(changes):
+        if c.user_id not in known_users:
+            errors.append({"row": i, "detail": "User not found"})
+            continue
+        if c.service_id not in known_services:
+            errors.append({"row": i, "detail": "Service not found"})
+            continue
+
+        key = (c.user_id, c.service_id)
+        if key in final:
+            state = final[key]
+        else:
+            state = ("add", 0) if key in current else None
+
+        if c.action == "revoke":
+            final[key] = None
+        elif c.mode == "set" or state is None:
+            final[key] = ("set", c.tokens)
+        else:
+            final[key] = (state[0], state[1] + c.tokens)
+
+    plan = {"insert": [], "set": [], "add": [], "delete": []}
+    for (user_id, service_id), state in final.items():
+        existing = current.get((user_id, service_id))
+        if state is None:
+            if existing:
+                plan["delete"].append(
+                    {"user_id": user_id, "service_id": service_id, "id": existing[0], "from": existing[1], "to": None})
+        elif existing is None:
+            plan["insert"].append(
+                {"user_id": user_id, "service_id": service_id, "from": None, "to": state[1]})
+        elif state[0] == "set" and state[1] != existing[1]:
+            plan["set"].append(
+                {"user_id": user_id, "service_id": service_id, "id": existing[0], "from": existing[1], "to": state[1]})
+        elif state[0] == "add" and state[1]:
+            plan["add"].append({"user_id": user_id, "service_id": service_id, "id": existing[0],
+                               "from": existing[1], "to": existing[1] + state[1], "delta": state[1]})
+    return plan, errors
+
+
+def apply_permission_plan(db, plan):
+    permissions = models.Permissions.__table__
+    if plan["insert"]:
+        db.execute(insert(permissions), [{"user_id": p["user_id"], "service_id": p["service_id"],
+                                          "available_tokens": p["to"]} for p in plan["insert"]])
+    if plan["set"]:
+        db.execute(update(permissions).where(permissions.c.id == bindparam("permission_id")).values(
+            available_tokens=bindparam("value")), [{"permission_id": p["id"], "value": p["to"]} for p in plan["set"]])
+    if plan["add"]:
+        # relative to the stored value so concurrent debits are not lost
+        db.execute(update(permissions).where(permissions.c.id == bindparam("permission_id")).values(
+            available_tokens=permissions.c.available_tokens + bindparam("delta")),
+            [{"permission_id": p["id"], "delta": p["delta"]} for p in plan["add"]])
+    ids = [p["id"] for p in plan["delete"]]
+    for start in range(0, len(ids), BULK_CHUNK_SIZE):
+        db.execute(delete(permissions).where(
+            permissions.c.id.in_(ids[start:start + BULK_CHUNK_SIZE])))
+    db.commit()
+    for user_id in {p["user_id"] for rows in plan.values() for p in rows}:
+        bump_version(f"permissions:{user_id}")
 
 
-@router.get("/myself")
-def get_user_information(db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+@router.put("/permissions/bulk", response_model=PermissionMatrixResponse, response_model_exclude_unset=True)
+def update_permissions_in_bulk(matrix: PermissionMatrix, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+    if current_user is None:
+        raise get_user_exception()
+
+    if current_user["role"] != "admin":
+        raise get_role_exception()
+
+    plan, errors = plan_permission_changes(db, matrix.changes)
+
+    if not matrix.dry_run:
+        apply_permission_plan(db, plan)
+
+    summary = {"dry_run": matrix.dry_run, "inserted": len(plan["insert"]),
+               "updated": len(plan["set"]) + len(plan["add"]), "deleted": len(plan["delete"]), "errors": errors}
+    if matrix.dry_run:
+        summary["diff"] = [{"action": action, **{k: v for k, v in p.items() if k in ("user_id", "service_id", "from", "to")}}
+                           for action, rows in plan.items() for p in rows]
+    return summary
+
+
+@router.get("/", response_model=List[UserResponse])
+def get_all_users(db=Depends(get_read_db), current_user: dict = Depends(get_current_user)):
+    if current_user is None:
+        raise get_user_exception()
+
+    if current_user["role"] != "admin":
+        raise get_role_exception()
+
+    return db.query(models.Users).all()
+
+
+@router.get("/myself", response_model=CurrentUserResponse)
+async def get_user_information(current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
     return current_user
 
 
-@router.get("/{user_id}")
-def get_user(user_id: int, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+@router.get("/{user_id}", response_model=UserResponse)
+def get_user(user_id: int, db=Depends(get_read_db), current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
 
@@ -130,36 +502,32 @@ def get_user(user_id: int, db=Depends(get_db), current_user: dict = Depends(get_
     if not user:
         raise get_user_not_found_exception()
 
-    return {i: user.__dict__[i] for i in user.__dict__ if i != "password"}
+    return user
 
 
-@router.get("/role/{role}")
-def get_users_by_role(role: str, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+@router.get("/role/{role}", response_model=List[UserResponse])
+def get_users_by_role(role: str, db=Depends(get_read_db), current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
 
     if current_user["role"] != "admin":
         raise get_role_exception()
 
-    users = [{i: u.__dict__[i] for i in u.__dict__ if i != "password"}
-             for u in db.query(models.Users).filter(models.Users.role == role).all()]
-    return users
+    return db.query(models.Users).filter(models.Users.role == role).all()
 
 
-@router.get("/subscription/{subscription}")
-def get_users_by_subscription(subscription: str, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
+@router.get("/subscription/{subscription}", response_model=List[UserResponse])
+def get_users_by_subscription(subscription: str, db=Depends(get_read_db), current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
 
     if current_user["role"] != "admin":
         raise get_role_exception()
 
-    users = [{i: u.__dict__[i] for i in u.__dict__ if i != "password"}
-             for u in db.query(models.Users).filter(models.Users.subscription == subscription).all()]
-    return users
+    return db.query(models.Users).filter(models.Users.subscription == subscription).all()
 
 
-@router.put("/as-admin/{user_id}")
+@router.put("/as-admin/{user_id}", response_model=UpdatedUserAdminResponse)
 def update_user_as_admin(user_id: int, updated_user: UpdateUserAdmin, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
 
     if current_user is None:
@@ -225,10 +593,12 @@ def update_user_as_admin(user_id: int, updated_user: UpdateUserAdmin, db=Depends
             db.add(permissions_model)
             db.commit()
 
+    bump_version(f"permissions:{user_id}")
+
     return updated_user
 
 
-@router.put("/as-user/{user_id}")
+@router.put("/as-user/{user_id}", response_model=UpdatedUserResponse)
 def update_user_as_user(user_id: int, updated_user: UpdateUser, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
 
     if current_user is None:
@@ -250,7 +620,7 @@ def update_user_as_user(user_id: int, updated_user: UpdateUser, db=Depends(get_d
     return updated_user
 
 
-@router.put("/activate/{user_id}")
+@router.put("/activate/{user_id}", response_model=Detail)
 def activate_user(user_id: int, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
@@ -269,7 +639,7 @@ def activate_user(user_id: int, db=Depends(get_db), current_user: dict = Depends
     return {"detail": "User activated successfully"}
 
 
-@router.put("/deactivate/{user_id}")
+@router.put("/deactivate/{user_id}", response_model=Detail)
 def deactivate_user(user_id: int, db=Depends(get_db), current_user: dict = Depends(get_current_user)):
     if current_user is None:
         raise get_user_exception()
@@ -286,3 +656,12 @@ def deactivate_user(user_id: int, db=Depends(get_db), current_user: dict = Depen
     db.commit()
 
     return {"detail": "User deactivated successfully"}
+
+
+# exceptions
+def get_bulk_format_exception():
+    bulk_format_exception = HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Expected a JSON list of users or a CSV file"
+    )
+    return bulk_format_exception
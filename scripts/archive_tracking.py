@@ -0,0 +1,38 @@
+import argparse
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import models.models as models  # noqa: E402
+from database.database import SessionLocal  # noqa: E402
+from utils.tracking_archive import archive_tracking, TRACKING_ARCHIVE_DIR, TRACKING_RETENTION_DAYS  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move tracking rows older than the retention period into compressed segment files")
+    parser.add_argument("--days", type=int, default=TRACKING_RETENTION_DAYS,
+                        help="rows from days older than this are archived")
+    parser.add_argument("--directory", default=TRACKING_ARCHIVE_DIR)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report what would be archived")
+    args = parser.parse_args()
+
+    cutoff = datetime.datetime.utcnow().date() - datetime.timedelta(days=args.days)
+    db = SessionLocal()
+    try:
+        report = archive_tracking(db, models.Tracking.__table__, cutoff,
+                                  directory=args.directory, dry_run=args.dry_run)
+    finally:
+        db.close()
+
+    for entry in report:
+        print(f"{entry['date']}: {entry['rows']} rows")
+    action = "would be archived" if args.dry_run else f"archived to {args.directory}"
+    print(f"{sum(e['rows'] for e in report)} rows before {cutoff} {action}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.lang_id import build_profile  # noqa: E402
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "lang_corpus")
+OUTPUT = os.path.join(os.path.dirname(__file__),
+                      "..", "utils", "data", "lang_profiles.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the character n-gram profiles used by the local language identifier")
+    parser.add_argument("--corpus", default=CORPUS_DIR,
+                        help="directory with one <language>.txt file per language")
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--size", type=int, default=1000,
+                        help="number of n-grams kept per language")
+    args = parser.parse_args()
+
+    profiles = {}
+    for filename in sorted(os.listdir(args.corpus)):
+        if not filename.endswith(".txt"):
+            continue
+        with open(os.path.join(args.corpus, filename), encoding="utf-8") as f:
+            profiles[filename[:-4]] = build_profile(f.read(), args.size)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(profiles, f, ensure_ascii=False, separators=(",", ":"))
+
+    print(f"{len(profiles)} profiles written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
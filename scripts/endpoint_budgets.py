@@ -0,0 +1,322 @@
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# never run against a configured database, replica, archive or rate limiter
+_workdir = tempfile.mkdtemp(prefix="endpoint-budgets-")
+os.environ["CONNECTION_STRING"] = "sqlite:///" + os.path.join(_workdir, "budgets.db")
+os.environ["READ_REPLICA_CONNECTION_STRINGS"] = ""
+os.environ["TRACKING_ARCHIVE_DIR"] = os.path.join(_workdir, "archive")
+os.environ["RATE_LIMIT_ENABLED"] = "false"
+# the revocation lookup on every request, as the budgets count it
+os.environ["TOKEN_REVOCATION_RECHECK"] = "0"
+for key, value in {"SECRET_KEY": "budgets", "ALGORITHM": "HS256", "EXPIRATION_MINUTES": "60",
+                   "COST_BY_TOKEN": "0.00002", "OPENAI_API_KEY": "sk-budgets", "ENGINE": "text-davinci-003",
+                   "TEMPERATURE": "0", "MAX_TOKENS": "1000"}.items():
+    os.environ.setdefault(key, value)
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import event, insert  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from main import app  # noqa: E402
+import models.models as models  # noqa: E402
+import utils.metrics as metrics  # noqa: E402
+import utils.pipeline as pipeline  # noqa: E402
+from database.database import engine, SessionLocal  # noqa: E402
+from routers.auth import bcrypt_context, create_access_token  # noqa: E402
+
+PASSWORD = "Budget-passw0rd"
+SERVICE_IDS = list(range(1, 7))
+
+# statements executed on behalf of the request being measured; a list so
+# that the copies of the context made for the threadpool share it
+_statements = ContextVar("statements", default=None)
+_total = [0]
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    _total[0] += 1
+    counter = _statements.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+async def measure_statements(request: Request, call_next):
+    _statements.set([0])
+    response = await call_next(request)
+    response.headers["X-Statements"] = str(_statements.get()[0])
+    return response
+
+
+async def stub_response(prompt, model=pipeline.default_model, **settings):
+    # the harness measures this service, not the upstream one
+    prompt_tokens = max(1, len(prompt) // 4)
+    return {"id": "cmpl-budget", "object": "text_completion", "model": model,
+            "choices": [{"text": " ok", "index": 0, "logprobs": None, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 1, "total_tokens": prompt_tokens + 1}}
+
+
+@dataclass
+class Budget:
+    # request(client, state) performs the call and returns the response;
+    # constant means the statement count may not grow with the tracking table;
+    # streamed bodies run their queries after the X-Statements header is sent
+    method: str
+    path: str
+    statements: int
+    milliseconds: float
+    request: Callable
+    status: int = 200
+    constant: bool = False
+    streamed: bool = False
+
+
+def as_admin(method, url, **kwargs):
+    return lambda c, state: c.request(method, url, cookies=state["admin"], **kwargs)
+
+
+def as_user(method, url, **kwargs):
+    return lambda c, state: c.request(method, url, cookies=state["user"], **kwargs)
+
+
+def gpt(path, payload):
+    return Budget("POST", f"/api/v1/services/gpt-3/{path}", 6, 250, as_user(
+        "POST", f"/api/v1/services/gpt-3/{path}", json=payload))
+
+
+def new_username(state):
+    state["users"] += 1
+    return f"budget{state['users']}"
+
+
+def register_user(c, state):
+    return c.post("/api/v1/users/register", cookies=state["admin"], json={
+        "username": new_username(state), "password": PASSWORD, "role": "user", "subscription": "standard",
+        "services": SERVICE_IDS, "tokens_by_service": [1000] * len(SERVICE_IDS)})
+
+
+def bulk_users(c, state):
+    return c.post("/api/v1/users/bulk", cookies=state["admin"], json=[
+        {"username": new_username(state), "password": PASSWORD, "role": "user", "subscription": "standard",
+         "services": SERVICE_IDS, "tokens_by_service": [1000] * len(SERVICE_IDS)} for _ in range(10)])
+
+
+def login(c, state):
+    return c.post("/api/v1/auth/login", data={"username": "user", "password": PASSWORD})
+
+
+def logout(c, state):
+    # with a token of its own, logging out invalidates it
+    token = create_access_token("user", 2, "user", "standard",
+                                datetime.timedelta(minutes=5), SERVICE_IDS)
+    return c.post("/api/v1/auth/logout", cookies={"access_token": f"Bearer {token}"})
+
+
+def create_job(c, state):
+    response = c.post("/api/v1/jobs/sentiment-detect", cookies=state["user"],
+                      json={"payload": {"sentence": "I like it"}})
+    state["job_id"] = response.json().get("job_id")
+    return response
+
+
+def websocket_session(c, state):
+    # one invocation over a session, including the flush on disconnect
+    with c.websocket_connect("/api/v1/services/gpt-3/session", cookies=state["user"]) as ws:
+        ws.send_json({"request_id": 1, "service": "sentiment_detect",
+                      "payload": {"sentence": "I like it"}})
+        status_code = ws.receive_json()["status_code"]
+    # the handler finishes, and flushes, after the client side has closed
+    waited = time.monotonic()
+    while metrics.gauge("ws_sessions_active").value and time.monotonic() - waited < 5:
+        time.sleep(0.001)
+    return status_code
+
+
+SERVICE = {"name": "budget", "family": "gpt", "is_active": True}
+SENTENCE = {"sentence": "The quick brown fox jumps over the lazy dog."}
+
+BUDGETS = [
+    Budget("POST", "/api/v1/auth/login", 3, 1000, login),
+    Budget("POST", "/api/v1/auth/logout", 2, 100, logout),
+    Budget("POST", "/api/v1/users/register", 14, 1000, register_user),
+    Budget("POST", "/api/v1/users/bulk", 6, 5000, bulk_users),
+    Budget("PUT", "/api/v1/users/permissions/bulk", 7, 200, as_admin(
+        "PUT", "/api/v1/users/permissions/bulk", json={"changes": [
+            {"user_id": 2, "service_id": s, "mode": "add", "tokens": 1} for s in SERVICE_IDS]})),
+    Budget("GET", "/api/v1/users/", 2, 200, as_admin("GET", "/api/v1/users/"), constant=True),
+    Budget("GET", "/api/v1/users/myself", 1, 100, as_user("GET", "/api/v1/users/myself")),
+    Budget("GET", "/api/v1/users/{user_id}", 2, 100, as_admin("GET", "/api/v1/users/2")),
+    Budget("GET", "/api/v1/users/role/{role}", 2, 200, as_admin("GET", "/api/v1/users/role/user"), constant=True),
+    Budget("GET", "/api/v1/users/subscription/{subscription}", 2, 200,
+           as_admin("GET", "/api/v1/users/subscription/standard"), constant=True),
+    Budget("PUT", "/api/v1/users/as-admin/{user_id}", 17, 200, as_admin(
+        "PUT", "/api/v1/users/as-admin/3", json={
+            "username": "other", "role": "user", "subscription": "standard",
+            "services": SERVICE_IDS, "tokens_by_service": [1000] * len(SERVICE_IDS)})),
+    Budget("PUT", "/api/v1/users/as-user/{user_id}", 4, 1000, as_user(
+        "PUT", "/api/v1/users/as-user/2", json={"username": "user", "password": PASSWORD})),
+    Budget("PUT", "/api/v1/users/activate/{user_id}", 4, 100, as_admin("PUT", "/api/v1/users/activate/3")),
+    Budget("PUT", "/api/v1/users/deactivate/{user_id}", 4, 100, as_admin("PUT", "/api/v1/users/deactivate/3")),
+    Budget("POST", "/api/v1/services/register", 4, 100, as_admin(
+        "POST", "/api/v1/services/register", json=SERVICE)),
+    Budget("GET", "/api/v1/services/", 3, 100, as_user("GET", "/api/v1/services/"), constant=True),
+    Budget("GET", "/api/v1/services/{service_id}", 2, 100, as_user("GET", "/api/v1/services/1")),
+    Budget("GET", "/api/v1/services/family/{family}", 3, 100,
+           as_user("GET", "/api/v1/services/family/gpt"), constant=True),
+    Budget("PUT", "/api/v1/services/{service_id}", 4, 100, as_admin(
+        "PUT", "/api/v1/services/7", json=SERVICE)),
+    Budget("GET", "/api/v1/services/users/{user_id}", 3, 100,
+           as_user("GET", "/api/v1/services/users/2"), constant=True),
+    Budget("GET", "/api/v1/tracker/historical", 3, 2000,
+           as_admin("GET", "/api/v1/tracker/historical"), constant=True),
+    Budget("GET", "/api/v1/tracker/historical/user/{user_id}", 4, 1000,
+           as_user("GET", "/api/v1/tracker/historical/user/2"), constant=True),
+    Budget("GET", "/api/v1/tracker/historical/service/{service_id}", 3, 1000,
+           as_admin("GET", "/api/v1/tracker/historical/service/1"), constant=True),
+    Budget("GET", "/api/v1/tracker/historical/{user_id}/{service_id}", 3, 1000,
+           as_user("GET", "/api/v1/tracker/historical/2/1"), constant=True),
+    Budget("GET", "/api/v1/tracker/export", 3, 2000,
+           as_admin("GET", "/api/v1/tracker/export"), constant=True, streamed=True),
+    gpt("lang-detection", SENTENCE),
+    gpt("lang-translation", {**SENTENCE, "source": "english", "target": "spanish"}),
+    gpt("sentiment-detect", SENTENCE),
+    gpt("intent-detection", {**SENTENCE, "tags": ["animals", "sports"]}),
+    gpt("summarize", SENTENCE),
+    gpt("writer", {"message_type": "email", "sender": "Ann", "recipient": "Bob",
+                   "tags": ["meeting", "monday"], "word_limit": 50}),
+    Budget("WEBSOCKET", "/api/v1/services/gpt-3/session", 9, 500, websocket_session),
+    Budget("POST", "/api/v1/jobs/{service_name}", 5, 250, create_job, status=202),
+    Budget("GET", "/api/v1/jobs/{job_id}", 2, 100,
+           lambda c, state: c.get(f"/api/v1/jobs/{state['job_id']}", cookies=state["user"])),
+]
+
+
+def seed(rows):
+    db = SessionLocal()
+    try:
+        password = bcrypt_context.hash(PASSWORD)
+        db.execute(insert(models.Users), [
+            {"id": 1, "username": "admin", "password": password, "role": "admin", "subscription": "premium"},
+            {"id": 2, "username": "user", "password": password, "role": "user", "subscription": "standard"},
+            {"id": 3, "username": "other", "password": password, "role": "user", "subscription": "standard"}])
+        db.execute(insert(models.Services), [{"id": s, "name": f"service{s}", "family": "gpt", "is_active": True}
+                                             for s in SERVICE_IDS])
+        db.execute(insert(models.Permissions), [{"user_id": u, "service_id": s, "available_tokens": 10 ** 9}
+                                                for u in (1, 2, 3) for s in SERVICE_IDS])
+        db.commit()
+    finally:
+        db.close()
+    add_tracking(rows)
+
+
+def add_tracking(rows):
+    db = SessionLocal()
+    try:
+        start = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+        db.execute(insert(models.Tracking), [{"user_id": random.choice((1, 2, 3)), "service_id": random.choice(SERVICE_IDS),
+                                              "insertion_date": start + datetime.timedelta(seconds=i * 7),
+                                              "consumed_tokens": random.randint(1, 4000)} for i in range(rows)])
+        db.commit()
+    finally:
+        db.close()
+
+
+def run(client, state, budget):
+    total = _total[0]
+    started = time.perf_counter()
+    response = budget.request(client, state)
+    elapsed = (time.perf_counter() - started) * 1000
+    if budget.method == "WEBSOCKET":
+        # sessions bypass the HTTP middleware and flush from the threadpool,
+        # nothing else runs while one is measured
+        return response, _total[0] - total, elapsed
+    if budget.streamed:
+        # the client has read the whole body by now
+        return response.status_code, _total[0] - total, elapsed
+    return response.status_code, int(response.headers.get("X-Statements", -1)), elapsed
+
+
+def uncovered_routes(app):
+    declared = {(b.method, b.path) for b in BUDGETS}
+    missing = []
+    for route in app.routes:
+        if not getattr(route.endpoint, "__module__", "").startswith("routers."):
+            continue
+        for method in getattr(route, "methods", None) or ["WEBSOCKET"]:
+            if (method, route.path) not in declared:
+                missing.append(f"{method} {route.path}")
+    return missing
+
+
+def main(args):
+    random.seed(0)
+    pipeline.get_response = stub_response
+    app.middleware("http")(measure_statements)
+    event.listen(engine, "before_cursor_execute", count_statement)
+
+    failures = [f"{route}: no budget declared" for route in uncovered_routes(app)]
+    seed(args.rows)
+    state = {"users": 0, "job_id": None,
+             "admin": {"access_token": "Bearer " + create_access_token(
+                 "admin", 1, "admin", "premium", datetime.timedelta(minutes=60), SERVICE_IDS)},
+             "user": {"access_token": "Bearer " + create_access_token(
+                 "user", 2, "user", "standard", datetime.timedelta(minutes=60), SERVICE_IDS)}}
+
+    with TestClient(app) as client:
+        counts = {}
+        print(f"{'endpoint':<62} {'statements':>10} {'ms':>8}")
+        for budget in BUDGETS:
+            status_code, statements, elapsed = run(client, state, budget)
+            counts[(budget.method, budget.path)] = statements
+            line = f"{budget.method + ' ' + budget.path:<62} {statements:>4}/{budget.statements:<5} {elapsed:>8.1f}"
+            problems = []
+            if status_code != budget.status:
+                problems.append(f"status {status_code}, expected {budget.status}")
+            if statements > budget.statements:
+                problems.append(f"{statements} statements, budget {budget.statements}")
+            if elapsed > budget.milliseconds * args.time_factor:
+                problems.append(f"{elapsed:.0f} ms, budget {budget.milliseconds * args.time_factor:.0f}")
+            print(line + ("  FAIL: " + "; ".join(problems) if problems else ""))
+            failures += [f"{budget.method} {budget.path}: {p}" for p in problems]
+
+        # statement counts of the listing endpoints may not depend on the
+        # number of rows they return
+        add_tracking(args.rows * (args.scale - 1))
+        for budget in BUDGETS:
+            if not budget.constant:
+                continue
+            _, statements, _ = run(client, state, budget)
+            if statements > counts[(budget.method, budget.path)]:
+                failures.append(f"{budget.method} {budget.path}: {counts[(budget.method, budget.path)]} statements "
+                                f"with {args.rows} tracking rows, {statements} with {args.rows * args.scale}")
+
+    for failure in failures:
+        print("FAIL", failure)
+    print(f"{len(BUDGETS)} endpoints, {len(failures)} failures")
+    return 1 if failures else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run every API route against a seeded SQLite database with a stubbed upstream, "
+                    "failing when a route exceeds its statement or time budget")
+    parser.add_argument("--rows", type=int, default=2000,
+                        help="tracking rows seeded before the first pass")
+    parser.add_argument("--scale", type=int, default=10,
+                        help="the tracking table is grown by this factor before re-checking constant routes")
+    parser.add_argument("--time-factor", type=float, default=1.0,
+                        help="multiplies every time budget, for slow machines")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -0,0 +1,156 @@
+import argparse
+import asyncio
+import base64
+import json
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import httpx
+
+FILLER = "the quick brown fox jumps over the lazy dog "
+
+
+def fill(shape):
+    # rebuilds a body from the shape recorded by utils/traffic_capture.py,
+    # strings get filler text of their original length
+    if isinstance(shape, dict):
+        if set(shape) == {"len"}:
+            return (FILLER * (shape["len"] // len(FILLER) + 1))[:shape["len"]]
+        return {k: fill(v) for k, v in shape.items()}
+    if isinstance(shape, list):
+        return [fill(v) for v in shape]
+    return shape
+
+
+def token_user_id(token):
+    # the id claim of a test user's token, the signature is the server's business
+    payload = token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))).get("id")
+
+
+def fill_params(params, user_ids):
+    # values recorded as buckets by utils/traffic_capture.py: user ids map to
+    # the test user of that bucket, like the callers do; other ids are
+    # placeholders that will not exist
+    filled = {}
+    for key, value in params.items():
+        if isinstance(value, dict) and "bucket" in value:
+            if key == "user_id" and user_ids:
+                value = user_ids[value["bucket"] % len(user_ids)]
+            elif key.endswith("_id") and key != "job_id":
+                value = value["bucket"]
+            else:
+                value = f"replay{value['bucket']}"
+        filled[key] = value
+    return filled
+
+
+def load(path, skip, limit):
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["route"] is None or record["route"].startswith(tuple(skip)):
+                continue
+            records.append(record)
+    records.sort(key=lambda r: r["ts"])
+    return records[:limit] if limit else records
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def replay(args, records, tokens):
+    user_ids = [token_user_id(token) for token in tokens]
+    results = defaultdict(list)
+    statuses = defaultdict(Counter)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        async def issue(record):
+            headers = {}
+            if tokens and record.get("user_bucket") is not None:
+                # the same bucket always maps to the same test user, which
+                # keeps the recorded per-user skew
+                token = tokens[record["user_bucket"] % len(tokens)]
+                headers["Cookie"] = f'access_token="Bearer {token}"'
+            if record.get("idempotency_key"):
+                headers["Idempotency-Key"] = uuid.uuid4().hex
+            body = fill(record["body_shape"]) if "body_shape" in record else None
+
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.request(record["method"],
+                                                    record["route"].format(**fill_params(record["path_params"], user_ids)),
+                                                    params=fill_params(record["query"], user_ids), json=body, headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = e.__class__.__name__
+                results[record["route"]].append(time.perf_counter() - started)
+                statuses[record["route"]][status] += 1
+
+        # keeps the recorded inter-arrival times, divided by the speed
+        start = time.perf_counter()
+        first = records[0]["ts"]
+        tasks = []
+        for record in records:
+            if args.speed > 0:
+                delay = (record["ts"] - first) / args.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(issue(record)))
+        await asyncio.gather(*tasks)
+    return results, statuses, time.perf_counter() - start
+
+
+def report(records, results, statuses, elapsed):
+    recorded = defaultdict(list)
+    for record in records:
+        recorded[record["route"]].append(record["duration_ms"] / 1000)
+
+    print(f"{len(records)} requests in {elapsed:.1f}s ({len(records) / elapsed:.1f}/s)")
+    print(f"{'route':<56} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'rec p95':>8}  status")
+    for route in sorted(results, key=lambda r: -len(results[r])):
+        latencies = results[route]
+        print(f"{route:<56} {len(latencies):>6} "
+              f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.95) * 1000:>8.1f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.1f} {max(latencies) * 1000:>8.1f} "
+              f"{percentile(recorded[route], 0.95) * 1000:>8.1f}  "
+              + " ".join(f"{s}:{n}" for s, n in sorted(statuses[route].items(), key=str)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-issue traffic recorded with CAPTURE_TRAFFIC=true against a running instance, "
+                    "preferably one using scripts/stub_openai.py as its upstream, and report latencies per route")
+    parser.add_argument("file", nargs="?", default="traffic.jsonl")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="2 replays twice as fast as recorded, 0 sends everything at once")
+    parser.add_argument("--token", action="append", default=[],
+                        help="access token of a test user, repeat for several; user buckets are spread over them")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--skip", action="append", default=None,
+                        help="route prefixes not to replay, by default the auth routes, so that "
+                             "logging out does not invalidate the test tokens")
+    args = parser.parse_args()
+
+    records = load(args.file, args.skip or ["/api/v1/auth/"], args.limit)
+    if not records:
+        print(f"no requests to replay in {args.file}")
+        return
+    results, statuses, elapsed = asyncio.run(replay(args, records, args.token))
+    report(records, results, statuses, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# the routers read these at import time; the benchmark uses its own engine
+for key, value in {"CONNECTION_STRING": "sqlite://", "SECRET_KEY": "benchmark", "ALGORITHM": "HS256",
+                   "EXPIRATION_MINUTES": "60", "COST_BY_TOKEN": "0.00002"}.items():
+    os.environ.setdefault(key, value)
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse, ORJSONResponse  # noqa: E402
+from sqlalchemy import create_engine, insert  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+import models.models as models  # noqa: E402
+from routers.tracker import get_tracking_rows  # noqa: E402
+from utils.service_config import COST_BY_TOKEN  # noqa: E402
+
+
+def seed(db, rows):
+    db.execute(insert(models.Users), [{"id": u, "username": f"user{u}", "password": "x"}
+                                      for u in range(1, 101)])
+    db.execute(insert(models.Services), [{"id": s, "name": f"service{s}", "family": "gpt"}
+                                         for s in range(1, 7)])
+    start = datetime.datetime(2023, 1, 1)
+    db.execute(insert(models.Tracking), [{"user_id": random.randint(1, 100), "service_id": random.randint(1, 6),
+                                          "insertion_date": start + datetime.timedelta(seconds=i),
+                                          "consumed_tokens": random.randint(1, 4000)} for i in range(rows)])
+    db.commit()
+
+
+def before(db):
+    # ORM rows, lazy relationships, __dict__ copies and the generic encoder
+    data = db.query(models.Tracking).all()
+    for row in data:
+        row.username = row.user.username
+        row.service_name = row.service.name
+        delattr(row, "user")
+        delattr(row, "service")
+    data = [r.__dict__ for r in data]
+    for d in data:
+        d["price"] = round(d["consumed_tokens"]*COST_BY_TOKEN, 2)
+    return JSONResponse(jsonable_encoder({"historical": data})).body
+
+
+def after(db):
+    data = get_tracking_rows(db, None, None, names=True)
+    return ORJSONResponse({"historical": data}).body
+
+
+def measure(fn, session_factory, repeat):
+    timings = []
+    for _ in range(repeat):
+        db = session_factory()
+        try:
+            t = time.perf_counter()
+            body = fn(db)
+            timings.append(time.perf_counter() - t)
+        finally:
+            db.close()
+    return min(timings), len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the cost of building a tracker history response before and after the column queries and orjson")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = session_factory()
+    seed(db, args.rows)
+    db.close()
+
+    for name, fn in (("before", before), ("after", after)):
+        elapsed, size = measure(fn, session_factory, args.repeat)
+        print(f"{name:>6}: {elapsed:.3f}s for {args.rows} rows ({size / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# a stand-in for the completions API in load tests; start it and point the
+# API at it with OPENAI_API_BASE=http://<host>:<port>/v1
+app = FastAPI()
+settings = {"latency_ms": 800.0, "sigma": 0.5,
+            "completion_tokens": 60, "error_rate": 0.0}
+
+
+@app.post("/v1/completions")
+async def completions(request: Request):
+    body = await request.json()
+    # lognormal around the median: mostly close to it, with a long tail
+    await asyncio.sleep(settings["latency_ms"] / 1000 *
+                        random.lognormvariate(0, settings["sigma"]))
+    if random.random() < settings["error_rate"]:
+        return JSONResponse({"error": {"message": "stubbed failure"}}, status_code=500)
+
+    prompt_tokens = max(1, len(body.get("prompt", "")) // 4)
+    completion_tokens = min(body.get("max_tokens", 16), settings["completion_tokens"])
+    return {"id": f"cmpl-stub{random.getrandbits(32):08x}", "object": "text_completion",
+            "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"text": " stub" * completion_tokens, "index": 0, "logprobs": None,
+                         "finish_reason": "length"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens}}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a fake OpenAI completions endpoint with configurable latency")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=settings["latency_ms"],
+                        help="median response time")
+    parser.add_argument("--sigma", type=float, default=settings["sigma"],
+                        help="spread of the lognormal response time, 0 for a constant one")
+    parser.add_argument("--completion-tokens", type=int, default=settings["completion_tokens"])
+    parser.add_argument("--error-rate", type=float, default=settings["error_rate"],
+                        help="share of requests answered with a 500")
+    args = parser.parse_args()
+
+    settings.update(latency_ms=args.latency_ms, sigma=args.sigma,
+                    completion_tokens=args.completion_tokens, error_rate=args.error_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
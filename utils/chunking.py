@@ -0,0 +1,47 @@
+import re
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+# a paragraph break can pre-tokenize into two tokens
+SEPARATOR_TOKENS = 2
+
+
+def _pieces(text, budget, count_many, split_oversized):
+    # paragraphs that fit are kept whole, the others are broken into
+    # sentences and, as a last resort, into raw token windows
+    paragraphs = [p.strip() for p in PARAGRAPH_BREAK.split(text) if p.strip()]
+    for paragraph, tokens in zip(paragraphs, count_many(paragraphs)):
+        if tokens <= budget:
+            yield paragraph, tokens, "\n\n"
+            continue
+
+        separator = "\n\n"
+        sentences = [s for s in SENTENCE_END.split(paragraph) if s]
+        for sentence, tokens in zip(sentences, count_many(sentences)):
+            if tokens <= budget:
+                yield sentence, tokens, separator
+            else:
+                parts = split_oversized(sentence, budget)
+                for part, tokens in zip(parts, count_many(parts)):
+                    yield part, tokens, separator
+                    separator = " "
+            separator = " "
+
+
+def chunk_text(text, budget, count_many, split_oversized):
+    # greedily packs paragraphs, sentences or token windows into chunks of at
+    # most budget tokens, reserving room for the separator of every join
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece, tokens, separator in _pieces(text, budget, count_many, split_oversized):
+        if current and current_tokens + tokens + SEPARATOR_TOKENS > budget:
+            chunks.append("".join(current))
+            current = []
+            current_tokens = 0
+        current.append(separator + piece if current else piece)
+        current_tokens += tokens + (SEPARATOR_TOKENS if len(current) > 1 else 0)
+    if current:
+        chunks.append("".join(current))
+    return chunks
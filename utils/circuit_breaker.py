@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import deque
+import utils.metrics as metrics
+
+STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class CircuitBreaker:
+    # opens when the error rate over the last `window` calls reaches
+    # `error_threshold`; after `open_seconds` a single probe call is let
+    # through and its outcome decides whether the circuit closes again
+    def __init__(self, name, window=50, min_requests=10, error_threshold=0.5, open_seconds=30):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.opened_at = 0.0
+        self._outcomes = deque(maxlen=window)
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+        self._state_gauge = metrics.gauge("circuit_breaker_state", name=name)
+        self._error_rate_gauge = metrics.gauge(
+            "circuit_breaker_error_rate", name=name)
+
+    def _set_state(self, state):
+        self.state = state
+        self._state_gauge.set(STATES[state])
+        if state == "open":
+            self.opened_at = time.monotonic()
+            metrics.counter("circuit_breaker_opened_total", name=self.name).inc()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    metrics.counter("circuit_breaker_rejected_total",
+                                    name=self.name).inc()
+                    return False
+                self._set_state("half_open")
+                self._probe_in_flight = False
+
+            if self.state == "half_open":
+                if self._probe_in_flight:
+                    metrics.counter("circuit_breaker_rejected_total",
+                                    name=self.name).inc()
+                    return False
+                self._probe_in_flight = True
+
+            return True
+
+    def release_probe(self):
+        # the probe was abandoned without an outcome, let another one through
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record(self, success):
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_in_flight = False
+                self._outcomes.clear()
+                self._set_state("closed" if success else "open")
+                return
+
+            self._outcomes.append(success)
+            errors = self._outcomes.count(False)
+            error_rate = errors / len(self._outcomes)
+            self._error_rate_gauge.set(round(error_rate, 4))
+            if self.state == "closed" and len(self._outcomes) >= self.min_requests \
+                    and error_rate >= self.error_threshold:
+                self._set_state("open")
@@ -0,0 +1,206 @@
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+import utils.metrics as metrics
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# zstandard and Brotli are in requirements.txt; without them, as in a bare
+# checkout, only gzip is offered
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_ENABLED = os.environ.get(
+    "COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+# server preference between codecs the client accepts with the same q-value
+COMPRESSION_CODECS = [c.strip() for c in os.environ.get(
+    "COMPRESSION_CODECS", "zstd,br,gzip").split(",") if c.strip()]
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", 3))
+COMPRESSION_BROTLI_LEVEL = int(os.environ.get("COMPRESSION_BROTLI_LEVEL", 4))
+COMPRESSION_CACHE_MAX = int(os.environ.get("COMPRESSION_CACHE_MAX", 1000))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/x-ndjson")
+
+# compressed bodies of responses with an ETag, by (etag, codec); an ETag
+# identifies one version of one body, see utils/http_cache.py
+_compressed = OrderedDict()
+_compressed_lock = threading.Lock()
+
+
+# a compressor takes chunks and returns whatever compressed bytes are ready;
+# finish() returns the rest
+class GzipCompressor:
+    def __init__(self):
+        self._compressor = zlib.compressobj(
+            COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class ZstdCompressor:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(
+            level=COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_LEVEL)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+CODECS = {"gzip": GzipCompressor}
+if zstandard is not None:
+    CODECS["zstd"] = ZstdCompressor
+if brotli is not None:
+    CODECS["br"] = BrotliCompressor
+
+
+def negotiate(accept_encoding):
+    # the accepted codec with the highest q-value, None for identity
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for name in COMPRESSION_CODECS:
+        if name not in CODECS:
+            continue
+        q = accepted.get(name, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def compress(codec, body):
+    compressor = CODECS[codec]()
+    started = time.perf_counter()
+    data = compressor.compress(body) + compressor.finish()
+    record(codec, len(body), len(data), time.perf_counter() - started)
+    return data
+
+
+def record(codec, size_in, size_out, elapsed):
+    metrics.histogram("compression_seconds", codec=codec).observe(elapsed)
+    metrics.counter("compression_bytes_in_total", codec=codec).inc(size_in)
+    metrics.counter("compression_bytes_out_total", codec=codec).inc(size_out)
+
+
+def cached_compress(codec, etag, body):
+    key = (etag, codec)
+    data = _compressed.get(key)
+    if data is not None:
+        metrics.counter("compression_cache_hits_total", codec=codec).inc()
+        return data
+    data = compress(codec, body)
+    with _compressed_lock:
+        _compressed[key] = data
+        while len(_compressed) > COMPRESSION_CACHE_MAX:
+            _compressed.popitem(last=False)
+    return data
+
+
+async def compress_stream(codec, body_iterator):
+    # for responses of unknown length, e.g. exports: compressed bytes are
+    # sent as soon as the codec emits them
+    compressor = CODECS[codec]()
+    size_in = size_out = 0
+    elapsed = 0.0
+    async for chunk in body_iterator:
+        started = time.perf_counter()
+        data = compressor.compress(chunk)
+        elapsed += time.perf_counter() - started
+        size_in += len(chunk)
+        size_out += len(data)
+        if data:
+            yield data
+    data = compressor.finish()
+    size_out += len(data)
+    record(codec, size_in, size_out, elapsed)
+    yield data
+
+
+def compressible(response):
+    if "content-encoding" in response.headers or response.status_code in (204, 206, 304):
+        return False
+    content_type = response.headers.get("content-type", "")
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+async def single_chunk(data):
+    yield data
+
+
+async def compress_response(request: Request, call_next):
+    # headers are changed in place, the response keeps its cookies and
+    # background tasks
+    response = await call_next(request)
+    if not compressible(response):
+        return response
+
+    response.headers["Vary"] = ", ".join(
+        v for v in (response.headers.get("vary"), "Accept-Encoding") if v)
+    codec = negotiate(request.headers.get(
+        "accept-encoding")) if COMPRESSION_ENABLED else None
+    if codec is None:
+        return response
+
+    length = response.headers.get("content-length")
+    if length is None:
+        response.headers["Content-Encoding"] = codec
+        response.body_iterator = compress_stream(codec, response.body_iterator)
+        return response
+
+    if int(length) < COMPRESSION_MIN_SIZE:
+        return response
+
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = response.headers.get("etag")
+    if etag is not None:
+        data = await run_in_threadpool(cached_compress, codec, etag, body)
+    else:
+        data = await run_in_threadpool(compress, codec, body)
+    response.headers["Content-Encoding"] = codec
+    response.headers["Content-Length"] = str(len(data))
+    response.body_iterator = single_chunk(data)
+    return response
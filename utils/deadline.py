@@ -0,0 +1,77 @@
+import time
+from contextvars import ContextVar
+from fastapi import HTTPException, Request, status
+import utils.metrics as metrics
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# seconds the client is willing to wait for the response
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+REQUEST_TIMEOUT_MAX = float(os.environ.get("REQUEST_TIMEOUT_MAX", 120))
+GPT_REQUEST_TIMEOUT = float(os.environ.get("GPT_REQUEST_TIMEOUT", 30))
+
+# monotonic time by which the current request has to be answered; unset for
+# work nobody is waiting on, like background jobs
+_deadline = ContextVar("deadline", default=None)
+
+
+def request_deadline(default):
+    # async so that the deadline is set in the context the endpoint runs in
+    async def dependency(request: Request):
+        timeout = default
+        value = request.headers.get(REQUEST_TIMEOUT_HEADER)
+        if value is not None:
+            try:
+                timeout = min(float(value), REQUEST_TIMEOUT_MAX)
+            except ValueError:
+                raise get_invalid_timeout_exception()
+            if timeout <= 0:
+                raise get_invalid_timeout_exception()
+        _deadline.set(time.monotonic() + timeout)
+    return dependency
+
+
+def set_deadline(timeout):
+    return _deadline.set(time.monotonic() + timeout if timeout is not None else None)
+
+
+def remaining():
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def cap_timeout(timeout):
+    left = remaining()
+    return timeout if left is None else max(0.0, min(timeout, left))
+
+
+def check_deadline(stage_name, **labels):
+    # drops the request before a stage it has no time left for
+    left = remaining()
+    if left is not None and left <= 0:
+        raise deadline_exceeded(stage_name, **labels)
+
+
+def deadline_exceeded(stage_name, **labels):
+    metrics.counter("deadline_exceeded_total", stage=stage_name, **labels).inc()
+    return get_deadline_exception()
+
+
+# exceptions
+def get_deadline_exception():
+    deadline_exception = HTTPException(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+        detail="The request deadline was exceeded"
+    )
+    return deadline_exception
+
+
+def get_invalid_timeout_exception():
+    invalid_timeout_exception = HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f"{REQUEST_TIMEOUT_HEADER} must be a positive number of seconds"
+    )
+    return invalid_timeout_exception
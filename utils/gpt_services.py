@@ -0,0 +1,168 @@
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional, Type
+from pydantic import BaseModel
+from utils.lang_id import local_lang_detection
+
+
+class PromptBase(BaseModel):
+    sentence: str
+
+
+class PromptSummarize(BaseModel):
+    sentence: str
+    long_document: bool = False
+
+
+class PromptTranslation(BaseModel):
+    sentence: str
+    source: str
+    target: str
+
+
+class PromptIntent(BaseModel):
+    sentence: str
+    tags: List[str]
+
+
+class PromptWriter(BaseModel):
+    message_type: str
+    sender: str
+    recipient: str
+    tags: List[str]
+    word_limit: int
+
+
+class CompletionChoice(BaseModel):
+    text: str
+    index: Optional[int]
+    logprobs: Optional[Any]
+    finish_reason: Optional[str]
+
+
+class CompletionUsage(BaseModel):
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+
+
+class CompletionResponse(BaseModel):
+    # an upstream text completion; chunks is set by map-reduce summaries,
+    # cached by answers from the semantic cache
+    id: Optional[str]
+    object: Optional[str]
+    created: Optional[int]
+    model: Optional[str]
+    choices: List[CompletionChoice]
+    usage: CompletionUsage
+    chunks: Optional[int]
+    cached: Optional[bool]
+
+
+def normalize_template(template):
+    # indentation and blank line runs in the source are billed as prompt
+    # tokens but carry no meaning for the model
+    lines = [" ".join(line.split()) for line in template.strip().splitlines()]
+    normalized = []
+    for line in lines:
+        if line or (normalized and normalized[-1]):
+            normalized.append(line)
+    return "\n".join(normalized)
+
+
+@dataclass
+class ServiceSpec:
+    # service_id is the row id in the services table; template is a
+    # str.format template filled with fields(prompt), which defaults to the
+    # request model's own fields; generation overrides the completion
+    # settings of get_response for this service; services with a
+    # reduce_template accept documents above MAX_TOKENS in document_field
+    # and summarize them with map-reduce; semantic_cache enables the
+    # near-duplicate cache keyed on document_field; local_answer may answer
+    # from the prompt values without calling upstream, returning None to
+    # fall back to it
+    service_id: int
+    name: str
+    path: str
+    request_model: Type[BaseModel]
+    template: str
+    fields: Optional[Callable[[BaseModel], dict]] = None
+    generation: dict = field(default_factory=dict)
+    reduce_template: Optional[str] = None
+    document_field: str = "sentence"
+    semantic_cache: bool = False
+    local_answer: Optional[Callable[[dict], Optional[dict]]] = None
+
+    def __post_init__(self):
+        self.template = normalize_template(self.template)
+        if self.reduce_template:
+            self.reduce_template = normalize_template(self.reduce_template)
+
+    def values(self, prompt: BaseModel):
+        return self.fields(prompt) if self.fields else prompt.dict()
+
+    def render(self, prompt: BaseModel):
+        return self.template.format(**self.values(prompt))
+
+
+SERVICES = [
+    ServiceSpec(
+        service_id=1,
+        name="lang_detection",
+        path="/lang-detection",
+        request_model=PromptBase,
+        template="Tell me what language this is sentence '{sentence}'. For example: english, spanish, french, etc.",
+        semantic_cache=True,
+        local_answer=local_lang_detection
+    ),
+    ServiceSpec(
+        service_id=2,
+        name="lang_translation",
+        path="/lang-translation",
+        request_model=PromptTranslation,
+        template="Translate this sentence from {source} to {target}: '{sentence}'"
+    ),
+    ServiceSpec(
+        service_id=3,
+        name="sentiment_detect",
+        path="/sentiment-detect",
+        request_model=PromptBase,
+        template="Classify the following sentence as negative, neutral or positive: '{sentence}'",
+        semantic_cache=True
+    ),
+    ServiceSpec(
+        service_id=4,
+        name="intent_detection",
+        path="/intent-detection",
+        request_model=PromptIntent,
+        template="Is the intent behind the following text {tags}: '{sentence}'.Please, only give me a option into tags.",
+        fields=lambda p: {"sentence": p.sentence, "tags": " or ".join(p.tags)}
+    ),
+    ServiceSpec(
+        service_id=5,
+        name="summarize",
+        path="/summarize",
+        request_model=PromptSummarize,
+        template="Extract the key points from this message: '{sentence}'",
+        fields=lambda p: {"sentence": p.sentence},
+        reduce_template="Combine these key points into a single list of key points without repetitions: '{sentence}'"
+    ),
+    ServiceSpec(
+        service_id=6,
+        name="writer",
+        path="/writer",
+        request_model=PromptWriter,
+        template='''
+        Create a {message_type} with next considerations:
+
+        1. Customer Name: {recipient}
+        2. Bullet points: {tags}.
+        3. Write the message in {word_limit} words
+
+        And finally, regards from sender: {sender}
+        ''',
+        fields=lambda p: {"message_type": p.message_type, "recipient": p.recipient,
+                          "tags": ", ".join(p.tags), "word_limit": p.word_limit, "sender": p.sender}
+    ),
+]
+
+SERVICES_BY_NAME = {s.name: s for s in SERVICES}
@@ -0,0 +1,195 @@
+import hashlib
+import importlib
+import orjson
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from starlette.responses import Response
+import models.models as models
+import utils.metrics as metrics
+from database.database import SessionLocal
+from routers.auth import get_current_user
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "database", "memory" or "module:attr" of a store
+HTTP_CACHE_VERSION_STORE = os.environ.get(
+    "HTTP_CACHE_VERSION_STORE", "database")
+HTTP_CACHE_MAX_BODIES = int(os.environ.get("HTTP_CACHE_MAX_BODIES", 1000))
+# how long a worker trusts a version it read from the DB; bumps made by other
+# workers are seen within this long, bumps made by this one at once
+HTTP_CACHE_VERSION_TTL = float(os.environ.get("HTTP_CACHE_VERSION_TTL", 1))
+HTTP_CACHE_MAX_VERSIONS = int(
+    os.environ.get("HTTP_CACHE_MAX_VERSIONS", 10000))
+
+
+# versions must be shared by every process serving the API for the ETags to
+# stay correct; the in-process store is only valid with a single worker. A
+# store has an epoch prefixed to its ETags, peek(key) returning the version
+# when it is known without I/O or None, get(key), run in the threadpool, and
+# bump(key)
+class InMemoryVersionStore:
+    def __init__(self):
+        # versions restart at zero with the process, the epoch keeps ETags
+        # handed out by a previous process from matching
+        self.epoch = uuid.uuid4().hex[:8]
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def peek(self, key):
+        return self._versions.get(key, 0)
+
+    def get(self, key):
+        return self._versions.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+
+class DatabaseVersionStore:
+    # shared by every worker using the same DB, bumps are one UPDATE; the
+    # versions read are kept for HTTP_CACHE_VERSION_TTL, so that a warm 304
+    # does no DB work
+    epoch = ""
+
+    def __init__(self, ttl=HTTP_CACHE_VERSION_TTL):
+        self.ttl = ttl
+        self._versions = {}
+
+    def peek(self, key):
+        entry = self._versions.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    def get(self, key):
+        with SessionLocal() as db:
+            version = db.query(models.CacheVersions.version).filter(
+                models.CacheVersions.key == key).scalar() or 0
+        if len(self._versions) >= HTTP_CACHE_MAX_VERSIONS:
+            self._versions.clear()
+        self._versions[key] = (version, time.monotonic() + self.ttl)
+        return version
+
+    def bump(self, key):
+        try:
+            self._bump(key)
+        finally:
+            self._versions.pop(key, None)
+
+    def _bump(self, key):
+        versions = models.CacheVersions.__table__
+        with SessionLocal() as db:
+            for _ in range(2):
+                if db.execute(update(versions).where(versions.c.key == key).values(
+                        version=versions.c.version + 1)).rowcount:
+                    db.commit()
+                    return
+                try:
+                    db.add(models.CacheVersions(key=key, version=1))
+                    db.commit()
+                    return
+                except IntegrityError:
+                    # another process inserted it first, update it instead
+                    db.rollback()
+
+
+STORES = {"database": DatabaseVersionStore, "memory": InMemoryVersionStore}
+
+
+def _load_store(path):
+    if path in STORES:
+        return STORES[path]()
+    module_name, _, attr = path.partition(":")
+    store = getattr(importlib.import_module(module_name), attr)
+    return store() if isinstance(store, type) else store
+
+
+version_store = _load_store(HTTP_CACHE_VERSION_STORE)
+
+_bodies = OrderedDict()
+_bodies_lock = threading.Lock()
+
+
+def bump_version(key):
+    version_store.bump(key)
+
+
+def make_etag(cache_key, version):
+    digest = hashlib.sha1(cache_key.encode("utf-8")).hexdigest()[:16]
+    return f'W/"{version_store.epoch}{digest}-{version}"'
+
+
+def matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [t.strip() for t in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or etag[2:] in candidates
+
+
+async def get_version(key):
+    version = version_store.peek(key)
+    if version is None:
+        version = await run_in_threadpool(version_store.get, key)
+    return version
+
+
+def precondition(resource):
+    # resource(request, user) returns (cache_key, version_key) and raises if
+    # the caller may not see it; the user is checked as for a 200, revoked
+    # tokens get no 304; once the revocation and the version are known in
+    # the process, the 304 is answered without DB access
+    async def dependency(request: Request, user: dict = Depends(get_current_user)):
+        cache_key, version_key = resource(request, user)
+        etag = make_etag(cache_key, await get_version(version_key))
+        request.state.etag = (cache_key, etag)
+        if matches(request.headers.get("if-none-match"), etag):
+            metrics.counter("http_cache_not_modified_total").inc()
+            raise get_not_modified_exception(etag)
+    return dependency
+
+
+def _default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError
+
+
+def serialize(content):
+    return orjson.dumps(content, default=_default)
+
+
+def cached_json_response(request: Request, build):
+    # build() is only called when no body is cached for this version
+    cache_key, etag = request.state.etag
+    body = _bodies.get(etag)
+    if body is None:
+        metrics.counter("http_cache_body_misses_total").inc()
+        body = serialize(build())
+        with _bodies_lock:
+            _bodies[etag] = body
+            while len(_bodies) > HTTP_CACHE_MAX_BODIES:
+                _bodies.popitem(last=False)
+    else:
+        metrics.counter("http_cache_body_hits_total").inc()
+    return Response(content=body, media_type="application/json",
+                    headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+
+# exceptions
+def get_not_modified_exception(etag):
+    not_modified_exception = HTTPException(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"}
+    )
+    return not_modified_exception
@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import importlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse, ORJSONResponse
+import utils.metrics as metrics
+from utils.deadline import cap_timeout
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+IDEMPOTENCY_STORE = os.environ.get("IDEMPOTENCY_STORE")
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 86400))
+# an in-flight claim expires after this, in case its process died
+IDEMPOTENCY_LOCK_TTL = int(os.environ.get("IDEMPOTENCY_LOCK_TTL", 120))
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", 30))
+IDEMPOTENCY_POLL_INTERVAL = float(
+    os.environ.get("IDEMPOTENCY_POLL_INTERVAL", 0.25))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", 100000))
+
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+# entries are {"fingerprint", "state": "pending"} while the first request
+# runs and {"fingerprint", "state": "done", "status_code", "body"} after;
+# with several processes the store has to be shared, like the rate limiter's;
+# an IDEMPOTENCY_STORE has the same claim, get, complete and release methods
+class InMemoryIdempotencyStore:
+    def __init__(self, max_keys=IDEMPOTENCY_MAX_KEYS):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        if item[1] <= now:
+            del self._entries[key]
+            return None
+        return item[0]
+
+    def _set(self, key, entry, expires):
+        self._entries[key] = (entry, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def claim(self, key, fingerprint, ttl):
+        # stores a pending entry and returns None if there is no entry,
+        # otherwise returns the existing one
+        now = time.monotonic()
+        with self._lock:
+            entry = self._get(key, now)
+            if entry is None:
+                self._set(key, {"fingerprint": fingerprint,
+                          "state": "pending"}, now + ttl)
+            return entry
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.monotonic())
+
+    def complete(self, key, entry, ttl):
+        with self._lock:
+            self._set(key, entry, time.monotonic() + ttl)
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def _load_store(path):
+    module_name, _, attr = path.partition(":")
+    store = getattr(importlib.import_module(module_name), attr)
+    return store() if isinstance(store, type) else store
+
+
+idempotency_store = _load_store(
+    IDEMPOTENCY_STORE) if IDEMPOTENCY_STORE else InMemoryIdempotencyStore()
+
+# requests of this process that are executing, duplicates arriving here wait
+# on these instead of polling the store
+_in_flight = {}
+
+
+def fingerprint(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def replay(entry):
+    return ORJSONResponse(entry["body"], status_code=entry["status_code"],
+                          headers={REPLAYED_HEADER: "true"})
+
+
+async def wait_for_entry(key):
+    event = _in_flight.get(key)
+    timeout = cap_timeout(IDEMPOTENCY_WAIT)
+    if event is not None:
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return idempotency_store.get(key)
+
+    waited = time.monotonic()
+    while True:
+        entry = idempotency_store.get(key)
+        if entry is None or entry["state"] == "done" or time.monotonic() - waited >= timeout:
+            return entry
+        await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+
+async def run_idempotent(key, payload_fingerprint, execute):
+    # execute() is awaited once per key; its result is stored when it returns
+    # one, and not when it raises, so that a failed request can be retried
+    while True:
+        entry = idempotency_store.claim(
+            key, payload_fingerprint, IDEMPOTENCY_LOCK_TTL)
+        if entry is None:
+            break
+        if entry["fingerprint"] != payload_fingerprint:
+            raise get_idempotency_mismatch_exception()
+        if entry["state"] == "pending":
+            metrics.counter("idempotency_waits_total").inc()
+            entry = await wait_for_entry(key)
+            if entry is None:
+                # the first request failed, this one takes over
+                continue
+            if entry["state"] == "pending":
+                raise get_idempotency_in_progress_exception()
+        metrics.counter("idempotency_replays_total").inc()
+        return replay(entry)
+
+    event = _in_flight[key] = asyncio.Event()
+    try:
+        response = await execute()
+    except BaseException:
+        idempotency_store.release(key)
+        raise
+    else:
+        if isinstance(response, JSONResponse):
+            status_code, body = response.status_code, json.loads(response.body)
+        else:
+            status_code, body = 200, response
+        idempotency_store.complete(key, {"fingerprint": payload_fingerprint, "state": "done",
+                                         "status_code": status_code, "body": body}, IDEMPOTENCY_TTL)
+        return response
+    finally:
+        if _in_flight.get(key) is event:
+            del _in_flight[key]
+        event.set()
+
+
+# exceptions
+def get_idempotency_mismatch_exception():
+    idempotency_mismatch_exception = HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail="This Idempotency-Key was already used with a different request body"
+    )
+    return idempotency_mismatch_exception
+
+
+def get_idempotency_in_progress_exception():
+    idempotency_in_progress_exception = HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="A request with this Idempotency-Key is still in progress"
+    )
+    return idempotency_in_progress_exception
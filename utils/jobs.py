@@ -0,0 +1,290 @@
+import asyncio
+import datetime
+import ipaddress
+import json
+import socket
+import urllib.parse
+import httpx
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+import logger.app_logger as app_logger
+from logger.app_logger_formatter import CustomFormatter
+import models.models as models
+import utils.metrics as metrics
+from database.database import SessionLocal
+from utils.gpt_services import SERVICES
+from utils.pipeline import run_service
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_MAX_CONCURRENT_PER_USER = int(
+    os.environ.get("JOB_MAX_CONCURRENT_PER_USER", 5))
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", 86400))
+JOB_PURGE_INTERVAL = int(os.environ.get("JOB_PURGE_INTERVAL", 600))
+JOB_CALLBACK_TIMEOUT = float(os.environ.get("JOB_CALLBACK_TIMEOUT", 10))
+JOB_RUNNING_TIMEOUT = int(os.environ.get("JOB_RUNNING_TIMEOUT", 3600))
+# callbacks only go to these hosts, ".example.com" allows its subdomains;
+# when empty, to any host that resolves to public addresses only
+JOB_CALLBACK_ALLOWED_HOSTS = [h.strip().lower() for h in os.environ.get(
+    "JOB_CALLBACK_ALLOWED_HOSTS", "").split(",") if h.strip()]
+
+SERVICES_BY_ID = {s.service_id: s for s in SERVICES}
+
+formatter = CustomFormatter("%(asctime)s")
+logger = app_logger.get_logger(__name__, formatter)
+
+
+def job_to_dict(job):
+    return {"job_id": job.id, "service_id": job.service_id, "status": job.status,
+            "status_code": job.status_code,
+            "result": json.loads(job.result) if job.result else None,
+            "consumed_tokens": job.consumed_tokens, "created_date": job.created_date,
+            "finished_date": job.finished_date, "expires_date": job.expires_date}
+
+
+def callback_target(url):
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return None, None
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except ValueError:
+        return None, None
+    return parsed.hostname.lower(), port
+
+
+def host_listed(host):
+    return any(host == h or (h.startswith(".") and host.endswith(h)) for h in JOB_CALLBACK_ALLOWED_HOSTS)
+
+
+def public_address(address):
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if getattr(ip, "ipv4_mapped", None):
+        ip = ip.ipv4_mapped
+    # is_global excludes private, loopback, link-local (the metadata
+    # endpoints), shared and reserved ranges
+    return ip.is_global and not ip.is_multicast
+
+
+def public_addresses(infos):
+    return bool(infos) and all(public_address(info[4][0]) for info in infos)
+
+
+def check_callback_url(url):
+    # blocking, for the routes; the worker checks again before delivering
+    # since the host may resolve differently by then
+    host, port = callback_target(url)
+    if host is None:
+        return False
+    if JOB_CALLBACK_ALLOWED_HOSTS:
+        return host_listed(host)
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        return False
+    return public_addresses(infos)
+
+
+async def resolve_callback_url(url):
+    # the address to deliver to, or None when the callback is not allowed;
+    # listed hosts are trusted and left to the client to resolve
+    host, port = callback_target(url)
+    if host is None:
+        return None
+    if JOB_CALLBACK_ALLOWED_HOSTS:
+        return host if host_listed(host) else None
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        return None
+    return infos[0][4][0] if public_addresses(infos) else None
+
+
+def pin_callback_url(url, address):
+    # the request goes to the address that was checked, resolving the host
+    # again could give another one; Host and SNI still name the host
+    parsed = urllib.parse.urlsplit(url)
+    if address == parsed.hostname.lower():
+        return url, {}, {}
+    userinfo, _, host = parsed.netloc.rpartition("@")
+    netloc = f"[{address}]" if ":" in address else address
+    if parsed.port:
+        netloc += f":{parsed.port}"
+    if userinfo:
+        netloc = f"{userinfo}@{netloc}"
+    pinned = urllib.parse.urlunsplit(parsed._replace(netloc=netloc))
+    extensions = {"sni_hostname": parsed.hostname} if parsed.scheme == "https" else {}
+    return pinned, {"Host": host}, extensions
+
+
+def count_active_jobs(db, user_id):
+    # locks the user's row until the new job is committed, so that
+    # concurrent submits of the same user are counted one after the other
+    db.query(models.Users.id).filter(
+        models.Users.id == user_id).with_for_update().first()
+    return db.query(models.Jobs).filter(models.Jobs.user_id == user_id).filter(
+        models.Jobs.status.in_(["queued", "running"])).count()
+
+
+async def execute(spec, prompt, user, accounting=None):
+    # returns (status_code, body) for whatever the pipeline produced
+    try:
+        response = await run_service(spec, prompt, user, accounting)
+    except HTTPException as e:
+        return e.status_code, {"detail": e.detail}
+    except Exception as e:
+        logger.error(f"Job failed: {str(e)}")
+        return 500, {"detail": "Internal server error"}
+
+    if isinstance(response, JSONResponse):
+        return response.status_code, json.loads(response.body)
+    return 200, response
+
+
+class JobWorkerPool:
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._queue = None
+        self._loop = None
+        self._tasks = []
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._tasks = [asyncio.create_task(self._worker())
+                       for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._purge_expired()))
+
+        # queued jobs left by a previous process; claiming is atomic, so it
+        # does not matter if several processes pick up the same ids
+        for job_id in await run_in_threadpool(queued_jobs):
+            self._enqueue(job_id)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job_id):
+        # routes run in the threadpool, the queue belongs to the event loop
+        self._loop.call_soon_threadsafe(self._enqueue, job_id)
+
+    def _enqueue(self, job_id):
+        self._queue.put_nowait(job_id)
+        metrics.gauge("jobs_queue_depth").set(self._queue.qsize())
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            metrics.gauge("jobs_queue_depth").set(self._queue.qsize())
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logger.error(f"Job worker error: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id):
+        # the DB work runs in the threadpool, here and in the pipeline
+        claimed = await run_in_threadpool(claim_job, job_id)
+        if claimed is None:
+            return
+
+        service_id, payload, user_claims = claimed
+        spec = SERVICES_BY_ID[service_id]
+        prompt = spec.request_model(**json.loads(payload))
+        user = json.loads(user_claims)
+        status_code, body = await execute(spec, prompt, user)
+
+        job, callback_url = await run_in_threadpool(finish_job, job_id, status_code, body)
+        metrics.counter("jobs_finished_total", status=job["status"]).inc()
+
+        if callback_url:
+            await self._deliver(job, callback_url)
+
+    async def _deliver(self, job, callback_url):
+        address = await resolve_callback_url(callback_url)
+        if address is None:
+            metrics.counter("jobs_callbacks_total", status="blocked").inc()
+            logger.error(f"Job callback to {callback_url} blocked")
+            return
+        url, headers, extensions = pin_callback_url(callback_url, address)
+        try:
+            # redirects are not followed, they could point anywhere
+            async with httpx.AsyncClient(timeout=JOB_CALLBACK_TIMEOUT, follow_redirects=False) as client:
+                response = await client.post(url, content=json.dumps(job, default=str),
+                                             headers={"Content-Type": "application/json", **headers},
+                                             extensions=extensions)
+            metrics.counter("jobs_callbacks_total",
+                            status=str(response.status_code)).inc()
+        except httpx.HTTPError as e:
+            metrics.counter("jobs_callbacks_total", status="error").inc()
+            logger.error(f"Job callback to {callback_url} failed: {str(e)}")
+
+    async def _purge_expired(self):
+        while True:
+            await asyncio.sleep(JOB_PURGE_INTERVAL)
+            try:
+                await run_in_threadpool(purge_jobs)
+            except Exception as e:
+                logger.error(f"Job purge failed: {str(e)}")
+
+
+def queued_jobs():
+    with SessionLocal() as db:
+        return [job_id for (job_id,) in db.query(models.Jobs.id).filter(models.Jobs.status == "queued").all()]
+
+
+def claim_job(job_id):
+    # returns (service_id, payload, user_claims), or None when another
+    # worker claimed the job first
+    with SessionLocal() as db:
+        claimed = db.query(models.Jobs).filter(models.Jobs.id == job_id).filter(
+            models.Jobs.status == "queued").update({"status": "running", "started_date": datetime.datetime.utcnow()},
+                                                   synchronize_session=False)
+        db.commit()
+        if not claimed:
+            return None
+        return db.query(models.Jobs.service_id, models.Jobs.payload, models.Jobs.user_claims).filter(
+            models.Jobs.id == job_id).first()
+
+
+def finish_job(job_id, status_code, body):
+    with SessionLocal() as db:
+        job = db.query(models.Jobs).filter(models.Jobs.id == job_id).first()
+        now = datetime.datetime.utcnow()
+        job.status = "succeeded" if status_code == 200 else "failed"
+        job.status_code = status_code
+        job.result = json.dumps(body)
+        job.consumed_tokens = body.get("usage", {}).get(
+            "total_tokens", 0) if status_code == 200 else 0
+        job.finished_date = now
+        job.expires_date = now + datetime.timedelta(seconds=JOB_RESULT_TTL)
+        result = job_to_dict(job), job.callback_url
+        db.commit()
+        return result
+
+
+def purge_jobs():
+    with SessionLocal() as db:
+        now = datetime.datetime.utcnow()
+        db.query(models.Jobs).filter(models.Jobs.expires_date < now).delete(
+            synchronize_session=False)
+        # jobs whose process died while running them, timed from when they
+        # started, not from when they were queued
+        db.query(models.Jobs).filter(models.Jobs.status == "running").filter(
+            models.Jobs.started_date < now - datetime.timedelta(seconds=JOB_RUNNING_TIMEOUT)).update(
+            {"status": "failed", "status_code": 500,
+             "result": json.dumps({"detail": "Job interrupted"}), "finished_date": now,
+             "expires_date": now + datetime.timedelta(seconds=JOB_RESULT_TTL)},
+            synchronize_session=False)
+        db.commit()
+
+
+job_pool = JobWorkerPool()
@@ -0,0 +1,161 @@
+import json
+import re
+import time
+import utils.metrics as metrics
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# either a comma separated list of keys, each optionally followed by
+# ":<organization>", or a JSON list of {"key", "organization", "weight"}
+OPENAI_API_KEYS = os.environ.get("OPENAI_API_KEYS", "")
+OPENAI_KEY_COOLDOWN = float(os.environ.get("OPENAI_KEY_COOLDOWN", 10))
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+    # the rate limit headers use Go durations: "1s", "6m0s", "20ms"
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(n) * DURATION_UNITS[unit] for n, unit in parts)
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class ApiKey:
+    def __init__(self, key, organization=None, weight=1.0):
+        self.key = key
+        self.organization = organization
+        self.weight = float(weight)
+        self.name = f"{key[:3]}...{key[-4:]}" + (f"@{organization}" if organization else "")
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.limit_requests = None
+        self.limit_tokens = None
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+
+    @property
+    def headers(self):
+        headers = {"Authorization": f"Bearer {self.key}"}
+        if self.organization:
+            headers["OpenAI-Organization"] = self.organization
+        return headers
+
+    def available_at(self, tokens, now):
+        # when this key is expected to accept a request of this many tokens,
+        # going by the last budget reported upstream
+        at = self.cooldown_until
+        if self.remaining_requests is not None and self.remaining_requests - self.in_flight <= 0:
+            at = max(at, self.requests_reset_at)
+        if self.remaining_tokens is not None and self.remaining_tokens < tokens:
+            at = max(at, self.tokens_reset_at)
+        return at if at > now else now
+
+    def load(self):
+        return (self.in_flight + 1) / self.weight
+
+    def update(self, headers, now):
+        self.limit_requests = _int_header(headers, "x-ratelimit-limit-requests") or self.limit_requests
+        self.limit_tokens = _int_header(headers, "x-ratelimit-limit-tokens") or self.limit_tokens
+        remaining_requests = _int_header(headers, "x-ratelimit-remaining-requests")
+        if remaining_requests is not None:
+            self.remaining_requests = remaining_requests
+            self.requests_reset_at = now + (parse_duration(
+                headers.get("x-ratelimit-reset-requests")) or 0)
+        remaining_tokens = _int_header(headers, "x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            self.remaining_tokens = remaining_tokens
+            self.tokens_reset_at = now + (parse_duration(
+                headers.get("x-ratelimit-reset-tokens")) or 0)
+
+    def headroom(self):
+        # share of the request budget left, keys that never reported one are
+        # assumed to be untouched
+        if self.limit_requests and self.remaining_requests is not None:
+            return self.remaining_requests / self.limit_requests
+        return 1.0
+
+    def utilization(self):
+        if self.limit_requests and self.remaining_requests is not None:
+            return round(1 - self.remaining_requests / self.limit_requests, 4)
+        return None
+
+
+class KeyPool:
+    def __init__(self, keys):
+        self.keys = keys
+        metrics.register_collector(self._collect)
+
+    def acquire(self, tokens=0):
+        # weighted least loaded among the keys that can take the request now;
+        # returns (None, seconds until one can) when none of them can
+        now = time.monotonic()
+        ready = [k for k in self.keys if k.available_at(tokens, now) <= now]
+        if not ready:
+            return None, min(k.available_at(tokens, now) for k in self.keys) - now
+
+        key = min(ready, key=lambda k: (k.load(), -k.headroom()))
+        key.in_flight += 1
+        if key.remaining_tokens is not None:
+            key.remaining_tokens -= tokens
+        return key, 0.0
+
+    def release(self, key, status_code=None, headers=None, retry_after=None):
+        now = time.monotonic()
+        key.in_flight -= 1
+        if headers is not None:
+            key.update(headers, now)
+        metrics.counter("openai_key_requests_total", key=key.name,
+                        status=str(status_code)).inc()
+        if status_code == 429:
+            key.cooldown_until = now + (retry_after or parse_duration(
+                (headers or {}).get("x-ratelimit-reset-requests")) or OPENAI_KEY_COOLDOWN)
+            metrics.counter("openai_key_cooldowns_total", key=key.name).inc()
+
+    def wait_time(self, tokens=0):
+        now = time.monotonic()
+        return max(0.0, min(k.available_at(tokens, now) for k in self.keys) - now)
+
+    def _collect(self):
+        now = time.monotonic()
+        for k in self.keys:
+            metrics.gauge("openai_key_in_flight", key=k.name).set(k.in_flight)
+            metrics.gauge("openai_key_cooling_down", key=k.name).set(int(k.cooldown_until > now))
+            if k.remaining_requests is not None:
+                metrics.gauge("openai_key_remaining_requests", key=k.name).set(k.remaining_requests)
+            if k.remaining_tokens is not None:
+                metrics.gauge("openai_key_remaining_tokens", key=k.name).set(k.remaining_tokens)
+            if k.utilization() is not None:
+                metrics.gauge("openai_key_utilization", key=k.name).set(k.utilization())
+
+
+def parse_keys(value, default_key=None):
+    value = value.strip()
+    if value.startswith("["):
+        return [ApiKey(k["key"], k.get("organization"), k.get("weight", 1)) for k in json.loads(value)]
+    keys = []
+    for entry in value.split(","):
+        if entry.strip():
+            key, _, organization = entry.strip().partition(":")
+            keys.append(ApiKey(key, organization or None))
+    if not keys and default_key:
+        keys.append(ApiKey(default_key))
+    return keys
@@ -0,0 +1,110 @@
+import threading
+from collections import deque
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+METRICS_RESERVOIR_SIZE = int(os.environ.get("METRICS_RESERVOIR_SIZE", 1024))
+
+_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def export(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dec(self, value=1):
+        self.value -= value
+
+    def export(self):
+        return self.value
+
+
+class Histogram:
+    # count, sum and max are exact; quantiles come from a sliding window of
+    # the most recent observations
+    def __init__(self, reservoir_size=METRICS_RESERVOIR_SIZE):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=reservoir_size)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        self.recent.append(value)
+
+    def quantile(self, q):
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def _rounded(self, q):
+        value = self.quantile(q)
+        return None if value is None else round(value, 6)
+
+    def export(self):
+        return {"count": self.count, "sum": round(self.sum, 6), "max": round(self.max, 6),
+                "p50": self._rounded(0.5), "p95": self._rounded(0.95), "p99": self._rounded(0.99)}
+
+
+def _get(kind, metric, labels):
+    key = (metric, tuple(sorted(labels.items())))
+    instance = _metrics.get(key)
+    if instance is None:
+        with _lock:
+            instance = _metrics.setdefault(key, kind())
+    return instance
+
+
+def counter(metric, **labels) -> Counter:
+    return _get(Counter, metric, labels)
+
+
+def gauge(metric, **labels) -> Gauge:
+    return _get(Gauge, metric, labels)
+
+
+def histogram(metric, **labels) -> Histogram:
+    return _get(Histogram, metric, labels)
+
+
+def register_collector(collector):
+    # collectors are called on every snapshot to refresh gauges whose value
+    # lives somewhere else
+    _collectors.append(collector)
+
+
+def snapshot():
+    for collector in _collectors:
+        collector()
+
+    data = {}
+    for (name, labels), metric in list(_metrics.items()):
+        data.setdefault(name, []).append(
+            {"labels": dict(labels), "value": metric.export()})
+    return data
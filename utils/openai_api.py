@@ -1,28 +1,252 @@
-import openai_async
+import asyncio
+import random
+import time
+import httpx
 import json
+from fastapi import HTTPException, status
+import utils.metrics as metrics
+from utils.circuit_breaker import CircuitBreaker
+from utils.deadline import cap_timeout, remaining, deadline_exceeded
+from utils.key_pool import KeyPool, parse_keys, OPENAI_API_KEYS
+from utils.scheduler import upstream_scheduler
+from utils.tracing import span, inject_headers
 
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-api_key = os.environ["OPENAI_API_KEY"]
+api_key = os.environ.get("OPENAI_API_KEY")
 model = os.environ["ENGINE"]
 temperature = float(os.environ["TEMPERATURE"])
 max_tokens = int(os.environ["MAX_TOKENS"])
 
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE", "https://api.openai.com/v1")
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 10))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 100))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 2))
+OPENAI_BACKOFF_BASE = float(os.environ.get("OPENAI_BACKOFF_BASE", 0.5))
+OPENAI_BACKOFF_MAX = float(os.environ.get("OPENAI_BACKOFF_MAX", 8))
+OPENAI_RETRY_AFTER_MAX = float(os.environ.get("OPENAI_RETRY_AFTER_MAX", 30))
+OPENAI_HEDGE = os.environ.get("OPENAI_HEDGE", "false").lower() == "true"
+OPENAI_HEDGE_MIN_SAMPLES = int(
+    os.environ.get("OPENAI_HEDGE_MIN_SAMPLES", 50))
 
-async def get_response(prompt: str):
-    # generate the response
-    response = await openai_async.complete(
-        api_key,
-        timeout=10,
-        payload={
-            "model": model,
-            "prompt": prompt,
-            "temperature": temperature,
-            "max_tokens": max_tokens
-        }
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+breaker = CircuitBreaker(
+    "openai",
+    window=int(os.environ.get("OPENAI_BREAKER_WINDOW", 50)),
+    min_requests=int(os.environ.get("OPENAI_BREAKER_MIN_REQUESTS", 10)),
+    error_threshold=float(os.environ.get(
+        "OPENAI_BREAKER_ERROR_THRESHOLD", 0.5)),
+    open_seconds=float(os.environ.get("OPENAI_BREAKER_OPEN_SECONDS", 30))
+)
+
+latency = metrics.histogram("upstream_latency_seconds")
+
+key_pool = KeyPool(parse_keys(OPENAI_API_KEYS, api_key))
+if not key_pool.keys:
+    raise RuntimeError("OPENAI_API_KEY or OPENAI_API_KEYS must be set")
+
+# one client per event loop, so that connections to the API are reused
+_client = {"loop": None, "client": None}
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    if _client["loop"] is not loop:
+        limits = httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                              max_keepalive_connections=OPENAI_MAX_CONNECTIONS)
+        _client["client"] = httpx.AsyncClient(
+            base_url=OPENAI_API_BASE, limits=limits)
+        _client["loop"] = loop
+    return _client["client"]
+
+
+async def close_client():
+    client = _client["client"]
+    _client["loop"] = _client["client"] = None
+    if client is not None:
+        await client.aclose()
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code=None, retry_after=None, message=""):
+        super().__init__(message or f"upstream returned {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status_code is None or self.status_code in RETRYABLE_STATUS_CODES
+
+
+def _parse_retry_after(headers):
+    value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def _attempt(prompt: str, settings: dict):
+    tokens = settings.get("max_tokens", 0)
+    timeout = cap_timeout(OPENAI_TIMEOUT)
+    if timeout <= 0:
+        raise deadline_exceeded("upstream_attempt")
+    key, wait = key_pool.acquire(tokens)
+    if key is None:
+        raise UpstreamError(429, wait, "every API key is rate limited")
+
+    started = time.perf_counter()
+    status_code = headers = retry_after = None
+    try:
+        with span("openai.completions", "client", model=settings["model"], max_tokens=tokens) as call:
+            # httpx timeouts apply per network operation, wait_for bounds the whole call
+            response = await asyncio.wait_for(get_client().post(
+                "/completions",
+                json={"prompt": prompt, **settings},
+                headers=inject_headers(key.headers),
+                timeout=timeout
+            ), timeout)
+            status_code, headers = response.status_code, response.headers
+            if call is not None:
+                call.set("http.status_code", status_code)
+        retry_after = _parse_retry_after(headers)
+    except (httpx.TimeoutException, asyncio.TimeoutError) as e:
+        if timeout < OPENAI_TIMEOUT:
+            # cut short by the request deadline, not an upstream failure
+            raise deadline_exceeded("upstream_attempt")
+        raise UpstreamError(message=f"{e.__class__.__name__}: {e}")
+    except httpx.HTTPError as e:
+        raise UpstreamError(message=f"{e.__class__.__name__}: {e}")
+    finally:
+        key_pool.release(key, status_code, headers, retry_after)
+
+    if status_code == 429:
+        # the key cools down, another one may take the retry right away
+        raise UpstreamError(429, key_pool.wait_time(tokens))
+
+    if status_code != 200:
+        raise UpstreamError(status_code, retry_after)
+
+    try:
+        data = json.loads(response.text)
+    except ValueError:
+        raise UpstreamError(message="invalid JSON from upstream")
+
+    latency.observe(time.perf_counter() - started)
+    return data
+
+
+async def _hedged_attempt(prompt: str, settings: dict):
+    # a second attempt is sent once the first one has been running longer
+    # than the observed p95; whichever answers first wins. The caller holds
+    # one scheduler slot, the hedge needs a second one and is skipped when
+    # none is free
+    hedge_delay = latency.quantile(0.95) if OPENAI_HEDGE and \
+        latency.count >= OPENAI_HEDGE_MIN_SAMPLES else None
+
+    first = asyncio.ensure_future(_attempt(prompt, settings))
+    if hedge_delay is None:
+        return await first
+
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+        if done:
+            return first.result()
+
+        if not upstream_scheduler.try_acquire():
+            metrics.counter("upstream_hedges_skipped_total").inc()
+            return await first
+
+        metrics.counter("upstream_hedges_total").inc()
+        second = asyncio.ensure_future(_attempt(prompt, settings))
+        second.add_done_callback(lambda _: upstream_scheduler.release())
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        metrics.counter("upstream_hedges_won_total").inc()
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def get_response(prompt: str, model: str = model, temperature: float = temperature,
+                       max_tokens: int = max_tokens, stop: list = None):
+    settings = {"model": model, "temperature": temperature,
+                "max_tokens": max_tokens}
+    if stop:
+        settings["stop"] = stop
+
+    if not breaker.allow():
+        raise get_upstream_unavailable_exception(breaker.open_seconds)
+
+    attempt = 0
+    while True:
+        try:
+            response = await _hedged_attempt(prompt, settings)
+        except UpstreamError as e:
+            breaker.record(not e.retryable)
+            metrics.counter("upstream_errors_total",
+                            status=str(e.status_code)).inc()
+
+            retry_after = e.retry_after
+            if retry_after is None:
+                # full jitter
+                retry_after = random.uniform(0, min(
+                    OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+            if not e.retryable or attempt >= OPENAI_MAX_RETRIES or retry_after > OPENAI_RETRY_AFTER_MAX:
+                if e.status_code == 429:
+                    raise get_upstream_unavailable_exception(retry_after)
+                raise get_upstream_exception()
+
+            left = remaining()
+            if left is not None and retry_after >= left:
+                # the retry could not finish in time
+                raise deadline_exceeded("upstream_retry")
+
+            attempt += 1
+            metrics.counter("upstream_retries_total").inc()
+            await asyncio.sleep(retry_after)
+
+            if not breaker.allow():
+                raise get_upstream_unavailable_exception(breaker.open_seconds)
+            continue
+        except (asyncio.CancelledError, HTTPException):
+            breaker.release_probe()
+            raise
+        except Exception:
+            breaker.record(False)
+            raise
+
+        breaker.record(True)
+        return response
+
+
+# exceptions
+def get_upstream_exception():
+    upstream_exception = HTTPException(
+        status_code=status.HTTP_502_BAD_GATEWAY,
+        detail="The language model service failed to respond"
     )
+    return upstream_exception
 
-    return json.loads(response.text)
+
+def get_upstream_unavailable_exception(retry_after):
+    upstream_unavailable_exception = HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="The language model service is temporarily unavailable",
+        headers={"Retry-After": str(max(1, round(retry_after)))}
+    )
+    return upstream_unavailable_exception
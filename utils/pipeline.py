@@ -0,0 +1,388 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+import models.models as models
+from database.database import SessionLocal, request_session
+import utils.metrics as metrics
+from routers.auth import get_user_exception, get_permissions_exception
+from utils.gpt_services import SERVICES, ServiceSpec
+from utils.chunking import chunk_text, SEPARATOR_TOKENS
+from utils.deadline import check_deadline
+from utils.tracing import span
+from utils.openai_api import get_response, model as default_model, max_tokens as default_max_tokens
+from utils.rate_limit import record_token_usage
+from utils.http_cache import bump_version
+from utils.scheduler import upstream_scheduler, service_weight
+from utils.semantic_cache import SemanticCache, SEMANTIC_CACHE_MODE
+from utils.service_config import get_service_config, cached_service_config
+from utils.token_counter import TemplateTokenCounter, PromptTokens, max_token_bytes
+
+from transformers import GPT2TokenizerFast
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MAX_TOKENS = int(os.environ["MAX_TOKENS"])
+SUMMARIZE_MAX_CONCURRENCY = int(
+    os.environ.get("SUMMARIZE_MAX_CONCURRENCY", 4))
+SUMMARIZE_MAX_CHUNKS = int(os.environ.get("SUMMARIZE_MAX_CHUNKS", 32))
+SUMMARIZE_MAX_REDUCE_ROUNDS = int(
+    os.environ.get("SUMMARIZE_MAX_REDUCE_ROUNDS", 3))
+# completion limit of the map and intermediate reduce calls, it bounds the
+# partial summaries so that every reduce round is guaranteed to shrink them
+SUMMARIZE_PARTIAL_MAX_TOKENS = int(
+    os.environ.get("SUMMARIZE_PARTIAL_MAX_TOKENS", MAX_TOKENS // 4))
+
+# partial summaries are joined as paragraphs, so that chunking keeps them whole
+PARTIAL_SEPARATOR = "\n\n"
+
+tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+MAX_TOKEN_BYTES = max_token_bytes(tokenizer)
+
+token_counters = {spec.name: TemplateTokenCounter(
+    spec.template, tokenizer) for spec in SERVICES}
+reduce_token_counters = {spec.name: TemplateTokenCounter(
+    spec.reduce_template, tokenizer) for spec in SERVICES if spec.reduce_template}
+
+semantic_caches = {spec.name: SemanticCache(spec.name) for spec in SERVICES
+                   if spec.semantic_cache and SEMANTIC_CACHE_MODE != "off"}
+
+stage_hooks = []
+
+
+def record_stage_metrics(spec, stage_name, elapsed):
+    metrics.histogram("pipeline_stage_seconds", service=spec.name,
+                      stage=stage_name).observe(elapsed)
+
+
+stage_hooks.append(record_stage_metrics)
+
+
+@contextmanager
+def stage(spec, stage_name):
+    # tracking always runs, upstream tokens are spent by then
+    if stage_name != "tracking":
+        check_deadline(stage_name, service=spec.name)
+    started = time.perf_counter()
+    try:
+        with span(f"pipeline.{stage_name}", service=spec.name):
+            yield
+    finally:
+        elapsed = time.perf_counter() - started
+        for hook in stage_hooks:
+            hook(spec, stage_name, elapsed)
+
+
+def get_prompt_tokens(spec: ServiceSpec, values: dict, prompt_template: str):
+    return PromptTokens(token_counters[spec.name], values, prompt_template, MAX_TOKEN_BYTES)
+
+
+async def available_tokens_of(accounting, service_id):
+    # the DB accounting blocks and runs in the threadpool, the in-memory one
+    # of the websocket sessions is read on the event loop
+    if accounting.blocking:
+        return await run_in_threadpool(accounting.available_tokens, service_id)
+    return accounting.available_tokens(service_id)
+
+
+async def track_with(accounting, service_id, consumed_tokens, model=None):
+    if accounting.blocking:
+        await run_in_threadpool(accounting.track, service_id, consumed_tokens, model)
+    else:
+        accounting.track(service_id, consumed_tokens, model)
+
+
+async def capacity_token_count(accounting, service_id, prompt_tokens: PromptTokens):
+    available_tokens = await available_tokens_of(accounting, service_id)
+    if not prompt_tokens.at_most(available_tokens):
+        return JSONResponse(
+            status_code=402, content={"detail": "You do not have enough tokens available.", "tokens_to_consume": prompt_tokens.count(), "available_tokens": available_tokens})
+    return None
+
+
+def maximum_token_count(prompt_tokens: PromptTokens):
+    max_tokens = MAX_TOKENS
+    if not prompt_tokens.at_most(max_tokens):
+        return JSONResponse(status_code=413, content={
+            "detail": "Maximum capacity of tokens per request exceeded.", "maximum_allowed": max_tokens})
+    return None
+
+
+def count_many(texts):
+    if not texts:
+        return []
+    with span("tokenize", texts=len(texts)):
+        return [len(ids) for ids in tokenizer(texts)["input_ids"]]
+
+
+def split_oversized(text, budget):
+    with span("tokenize", texts=1):
+        ids = tokenizer(text)["input_ids"]
+    return [tokenizer.decode(ids[i:i + budget]) for i in range(0, len(ids), budget)]
+
+
+def chunk_document(counter: TemplateTokenCounter, values: dict, field_name: str, text: str):
+    # the template overhead is measured with an empty document, the margin
+    # covers merges between the template and the chunk edges
+    overhead = counter.count({**values, field_name: ""}) + 4
+    return chunk_text(text, MAX_TOKENS - overhead, count_many, split_oversized)
+
+
+async def gather_or_cancel(coroutines):
+    tasks = [asyncio.ensure_future(c) for c in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+def plan_reduce(partials: int, partial_tokens: int, overhead: int):
+    # worst case, every partial summary is partial_tokens long: returns the
+    # number of partials entering each reduce round, the last one being the
+    # final pass, or None when they cannot be brought down to a single prompt
+    budget = MAX_TOKENS - overhead - 4
+    # a chunk is only closed when the next partial does not fit anymore
+    filled = budget - partial_tokens - SEPARATOR_TOKENS
+    rounds = [partials]
+    while overhead + combined_tokens(rounds[-1], partial_tokens) > MAX_TOKENS:
+        if filled <= 0 or len(rounds) > SUMMARIZE_MAX_REDUCE_ROUNDS:
+            return None
+        following = combined_tokens(rounds[-1], partial_tokens) // filled + 1
+        if following >= rounds[-1]:
+            return None
+        rounds.append(following)
+    return rounds
+
+
+def combined_tokens(partials: int, completion_tokens: int):
+    return partials * completion_tokens + (partials - 1) * SEPARATOR_TOKENS
+
+
+def reduce_reservation(rounds, partial_tokens: int, completion_tokens: int, overhead: int):
+    # prompts and completions of every reduce round, intermediate rounds send
+    # one prompt per chunk of the previous partials
+    tokens = overhead + combined_tokens(rounds[-1], partial_tokens) + completion_tokens
+    for entering, leaving in zip(rounds, rounds[1:]):
+        tokens += leaving * overhead + combined_tokens(entering, partial_tokens) + \
+            leaving * partial_tokens
+    return tokens
+
+
+async def run_map_reduce(spec: ServiceSpec, values: dict, user: dict, settings: dict, accounting):
+    counter = token_counters[spec.name]
+    reduce_counter = reduce_token_counters[spec.name]
+    field_name = spec.document_field
+    completion_tokens = settings.get("max_tokens", default_max_tokens)
+    partial_tokens = min(completion_tokens, SUMMARIZE_PARTIAL_MAX_TOKENS)
+    partial_settings = {**settings, "max_tokens": partial_tokens}
+
+    with stage(spec, "chunking"):
+        chunks = chunk_document(counter, values, field_name, values[field_name])
+    if len(chunks) > SUMMARIZE_MAX_CHUNKS:
+        return JSONResponse(status_code=413, content={
+            "detail": "Maximum number of chunks per document exceeded.", "maximum_chunks": SUMMARIZE_MAX_CHUNKS})
+
+    reduce_overhead = reduce_counter.count({**values, field_name: ""})
+    rounds = plan_reduce(len(chunks), partial_tokens, reduce_overhead)
+    if rounds is None:
+        return get_unreducible_response()
+
+    with stage(spec, "quota"):
+        if user["subscription"] != "premium":
+            # map prompts, one completion per chunk and every reduce round of
+            # the worst case must all fit before anything is sent
+            tokens_to_consume = sum(counter.count({**values, field_name: c}) for c in chunks) + \
+                partial_tokens * len(chunks) + \
+                reduce_reservation(rounds, partial_tokens, completion_tokens, reduce_overhead)
+            available_tokens = await available_tokens_of(accounting, spec.service_id)
+            if tokens_to_consume > available_tokens:
+                return JSONResponse(
+                    status_code=402, content={"detail": "You do not have enough tokens available.", "tokens_to_consume": tokens_to_consume, "available_tokens": available_tokens})
+
+    semaphore = asyncio.Semaphore(SUMMARIZE_MAX_CONCURRENCY)
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+    async def complete(template, text, settings=partial_settings):
+        async with semaphore:
+            async with upstream_scheduler.slot(user["subscription"], user["id"], service_weight(spec.name)):
+                response = await get_response(template.format(**{**values, field_name: text}), **settings)
+        for key in usage:
+            usage[key] += response["usage"].get(key, 0)
+        return response
+
+    try:
+        with stage(spec, "upstream"):
+            responses = await gather_or_cancel(complete(spec.template, c) for c in chunks)
+            partials = [r["choices"][0]["text"].strip() for r in responses]
+
+            # reduce until the partial summaries fit into a single prompt; the
+            # plan is a worst case, a round that does not shrink the partials
+            # means the completions are longer than they can be
+            for _ in range(len(rounds)):
+                combined = PARTIAL_SEPARATOR.join(partials)
+                if reduce_counter.count({**values, field_name: combined}) <= MAX_TOKENS:
+                    response = await complete(spec.reduce_template, combined, settings)
+                    break
+                reduce_chunks = chunk_document(
+                    reduce_counter, values, field_name, combined)
+                if len(reduce_chunks) >= len(partials):
+                    return get_unreducible_response()
+                responses = await gather_or_cancel(complete(spec.reduce_template, c) for c in reduce_chunks)
+                partials = [r["choices"][0]["text"].strip() for r in responses]
+            else:
+                return get_unreducible_response()
+    finally:
+        if usage["total_tokens"]:
+            with stage(spec, "tracking"):
+                await track_with(accounting, spec.service_id,
+                                 usage["total_tokens"], settings.get("model", default_model))
+
+    return {**response, "usage": usage, "chunks": len(chunks)}
+
+
+def get_unreducible_response():
+    return JSONResponse(status_code=413, content={
+        "detail": "The document is too long to be summarized into a single prompt.",
+        "maximum_reduce_rounds": SUMMARIZE_MAX_REDUCE_ROUNDS})
+
+
+def check_if_service_is_activate(config):
+    if not config["is_active"]:
+        return JSONResponse(status_code=409, content={
+            "detail": "The service was deactivated."})
+    return None
+
+
+def generation_settings(spec: ServiceSpec, config):
+    # model settings stored on the service row win over the spec's defaults
+    return {**spec.generation, **config["generation"]}
+
+
+def track_usage(db, user, service_id, consumed_tokens, model=None):
+    record_token_usage(user["id"], user["subscription"],
+                       service_id, consumed_tokens)
+
+    tracker_model = models.Tracking()
+    tracker_model.user_id = user["id"]
+    tracker_model.service_id = service_id
+    tracker_model.consumed_tokens = consumed_tokens
+    tracker_model.model = model
+
+    if user["subscription"] != "premium":
+        service_state = db.query(models.Permissions).filter(models.Permissions.user_id == user["id"]).filter(
+            models.Permissions.service_id == service_id).first()
+        service_state.available_tokens -= consumed_tokens
+        db.add(service_state)
+
+    db.add(tracker_model)
+    db.commit()
+
+    if user["subscription"] != "premium":
+        bump_version(f"permissions:{user['id']}")
+
+
+class DatabaseAccounting:
+    # token balances read from and usage written to the DB on every call,
+    # each in its own session; long-lived sessions can pass their own with
+    # the same two methods, blocking tells whether they need the threadpool
+    blocking = True
+
+    def __init__(self, user, request=None):
+        self.user = user
+        self.request = request
+
+    def available_tokens(self, service_id):
+        with SessionLocal() as db:
+            return db.query(models.Permissions).filter(models.Permissions.service_id == service_id).filter(
+                models.Permissions.user_id == self.user["id"]).first().available_tokens
+
+    def track(self, service_id, consumed_tokens, model=None):
+        # the debit is a write of the request, its reads go to the primary
+        with request_session(self.request) as db:
+            track_usage(db, self.user, service_id, consumed_tokens, model)
+
+
+def load_service_config(service_id):
+    with SessionLocal() as db:
+        return get_service_config(db, service_id)
+
+
+async def run_service(spec: ServiceSpec, prompt, user: dict, accounting=None, request=None):
+    # no session is held across the upstream call, the DB work of each stage
+    # opens its own in the threadpool
+    with stage(spec, "auth"):
+        if user is None:
+            raise get_user_exception()
+
+    with stage(spec, "activation"):
+        config = cached_service_config(spec.service_id)
+        if config is None:
+            config = await run_in_threadpool(load_service_config, spec.service_id)
+        response = check_if_service_is_activate(config)
+        if response is not None:
+            return response
+
+        if spec.service_id not in user["permissions"]:
+            raise get_permissions_exception()
+
+    if accounting is None:
+        accounting = DatabaseAccounting(user, request)
+
+    values = spec.values(prompt)
+
+    if spec.local_answer is not None:
+        with stage(spec, "local_answer"):
+            response = spec.local_answer(values)
+        if response is not None:
+            with stage(spec, "tracking"):
+                await track_with(accounting, spec.service_id, 0, response["model"])
+            return response
+
+    cache = semantic_caches.get(spec.name)
+    if cache is not None:
+        with stage(spec, "cache"):
+            fingerprint = cache.fingerprint(str(values[spec.document_field]))
+            cached = cache.get(fingerprint)
+        if cached is not None and cache.mode == "on":
+            with stage(spec, "tracking"):
+                await track_with(accounting, spec.service_id, 0, cached.get("model"))
+            return {**cached, "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}, "cached": True}
+
+    settings = generation_settings(spec, config)
+    prompt_template = spec.template.format(**values)
+    prompt_tokens = get_prompt_tokens(spec, values, prompt_template)
+
+    with stage(spec, "token_limits"):
+        response = maximum_token_count(prompt_tokens)
+    if response is not None:
+        if spec.reduce_template and getattr(prompt, "long_document", False):
+            return await run_map_reduce(spec, values, user, settings, accounting)
+        return response
+
+    with stage(spec, "quota"):
+        if user["subscription"] != "premium":
+            response = await capacity_token_count(
+                accounting, spec.service_id, prompt_tokens)
+            if response is not None:
+                return response
+
+    with stage(spec, "upstream"):
+        async with upstream_scheduler.slot(user["subscription"], user["id"], service_weight(spec.name)):
+            response = await get_response(prompt_template, **settings)
+
+    if cache is not None:
+        if cached is not None:
+            cache.compare(cached, response)
+        cache.put(fingerprint, response)
+
+    with stage(spec, "tracking"):
+        await track_with(accounting, spec.service_id,
+                         response["usage"]["total_tokens"], response.get("model"))
+
+    return response
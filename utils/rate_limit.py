@@ -0,0 +1,127 @@
+import importlib
+import threading
+import time
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE")
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+
+
+def _tier_limits(tier, requests_per_minute, tokens_per_minute):
+    prefix = f"RATE_LIMIT_{tier.upper()}_"
+    requests_per_minute = float(os.environ.get(
+        prefix + "REQUESTS_PER_MINUTE", requests_per_minute))
+    tokens_per_minute = float(os.environ.get(
+        prefix + "TOKENS_PER_MINUTE", tokens_per_minute))
+    limits = {
+        "request_rate": requests_per_minute / 60,
+        "request_burst": float(os.environ.get(prefix + "REQUEST_BURST", max(1, requests_per_minute / 6))),
+        "token_rate": tokens_per_minute / 60,
+        "token_burst": float(os.environ.get(prefix + "TOKEN_BURST", tokens_per_minute)),
+    }
+    # a bucket that never refills, or cannot hold one request, would reject
+    # every request; RATE_LIMIT_ENABLED=false is the way to turn limits off
+    if limits["request_rate"] <= 0 or limits["token_rate"] <= 0:
+        raise ValueError(f"{prefix}REQUESTS_PER_MINUTE and {prefix}TOKENS_PER_MINUTE must be positive")
+    if limits["request_burst"] < 1 or limits["token_burst"] <= 0:
+        raise ValueError(f"{prefix}REQUEST_BURST must be at least 1 and {prefix}TOKEN_BURST positive")
+    return limits
+
+
+TIER_LIMITS = {
+    "standard": _tier_limits("standard", 30, 20000),
+    "premium": _tier_limits("premium", 120, 120000),
+}
+
+
+# acquire takes cost units if they are available and returns 0, otherwise it
+# returns the seconds until they will be; debit takes cost units
+# unconditionally and lets the bucket go into debt; a RATE_LIMIT_STORE has
+# the same two methods
+class InMemoryBucketStore:
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _level(self, key, capacity, rate, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return capacity
+        return min(capacity, bucket[0] + (now - bucket[1]) * rate)
+
+    def _store(self, key, tokens, now, capacity, rate):
+        if key not in self._buckets and len(self._buckets) >= self.max_keys:
+            self._evict_full(now)
+        self._buckets[key] = (tokens, now, capacity, rate)
+
+    def _evict_full(self, now):
+        # a bucket that has refilled to capacity is indistinguishable from a
+        # missing one, so it can be dropped without changing any decision
+        full = [k for k, (tokens, updated, capacity, rate) in self._buckets.items()
+                if tokens + (now - updated) * rate >= capacity]
+        for k in full:
+            del self._buckets[k]
+
+    def acquire(self, key, capacity, rate, cost=1.0):
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._level(key, capacity, rate, now)
+            if tokens >= cost:
+                self._store(key, tokens - cost, now, capacity, rate)
+                return 0.0
+        return (cost - tokens) / rate
+
+    def debit(self, key, capacity, rate, cost):
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._level(key, capacity, rate, now)
+            self._store(key, max(tokens - cost, -capacity), now, capacity, rate)
+
+
+def _load_store(path):
+    module_name, _, attr = path.partition(":")
+    store = getattr(importlib.import_module(module_name), attr)
+    return store() if isinstance(store, type) else store
+
+
+_store = _load_store(RATE_LIMIT_STORE) if RATE_LIMIT_STORE else InMemoryBucketStore()
+
+
+def get_bucket_store():
+    return _store
+
+
+def set_bucket_store(store):
+    global _store
+    _store = store
+
+
+def check_rate_limit(user_id, subscription, service_id):
+    if not RATE_LIMIT_ENABLED:
+        return 0.0
+
+    limits = TIER_LIMITS.get(subscription, TIER_LIMITS["standard"])
+
+    # the token budget is charged after the upstream call, so admission only
+    # requires the token bucket not to be in debt
+    retry_after = _store.acquire(
+        f"tok:{user_id}:{service_id}", limits["token_burst"], limits["token_rate"], 0)
+    if retry_after:
+        return retry_after
+
+    return _store.acquire(f"req:{user_id}:{service_id}", limits["request_burst"], limits["request_rate"])
+
+
+def record_token_usage(user_id, subscription, service_id, consumed_tokens):
+    if not RATE_LIMIT_ENABLED:
+        return
+
+    limits = TIER_LIMITS.get(subscription, TIER_LIMITS["standard"])
+    _store.debit(f"tok:{user_id}:{service_id}",
+                 limits["token_burst"], limits["token_rate"], consumed_tokens)
@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, status
+import utils.metrics as metrics
+from utils.deadline import cap_timeout, deadline_exceeded
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get("UPSTREAM_MAX_CONCURRENCY", 32))
+UPSTREAM_MAX_QUEUE_WAIT = float(os.environ.get("UPSTREAM_MAX_QUEUE_WAIT", 5))
+
+TIER_PRIORITY = {"premium": 0, "standard": 1}
+
+# weight of a request in the fair queuing between users of a tier, by service
+# name: a request advances its user's virtual time by 1 / weight, so a user
+# queueing the long services falls behind the users of the short ones sooner.
+# The tier is not weighted, premium and standard already have their own queue
+UPSTREAM_SERVICE_WEIGHTS = {"summarize": 0.5, "writer": 0.5,
+                            **json.loads(os.environ.get("UPSTREAM_SERVICE_WEIGHTS", "{}"))}
+if any(not w > 0 for w in UPSTREAM_SERVICE_WEIGHTS.values()):
+    raise ValueError("UPSTREAM_SERVICE_WEIGHTS must all be positive")
+
+
+def service_weight(service_name):
+    return float(UPSTREAM_SERVICE_WEIGHTS.get(service_name, 1.0))
+
+
+class UpstreamScheduler:
+    # caps the number of in-flight upstream calls; waiters are served by tier
+    # priority first and then by start-time fair queuing between users, so a
+    # user with many queued requests cannot starve the others in the same tier
+    def __init__(self, max_concurrency=UPSTREAM_MAX_CONCURRENCY, max_queue_wait=UPSTREAM_MAX_QUEUE_WAIT):
+        self.max_concurrency = max_concurrency
+        self.max_queue_wait = max_queue_wait
+        self.in_flight = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._virtual_time = {}
+        self._last_finish = {}
+
+        self._depth = metrics.gauge("upstream_queue_depth")
+        self._in_flight = metrics.gauge("upstream_in_flight")
+
+    def _start_tag(self, tier, user_id, weight):
+        virtual_time = self._virtual_time.get(tier, 0.0)
+        if len(self._last_finish) > 10000:
+            self._last_finish = {k: v for k, v in self._last_finish.items()
+                                 if v > self._virtual_time.get(k[0], 0.0)}
+        start = max(virtual_time, self._last_finish.get((tier, user_id), 0.0))
+        self._last_finish[(tier, user_id)] = start + 1.0 / weight
+        return start
+
+    def _update_gauges(self):
+        self._depth.set(sum(1 for e in self._queue if not e[-1].done()))
+        self._in_flight.set(self.in_flight)
+
+    async def acquire(self, tier, user_id, weight=1.0):
+        tier = tier if tier in TIER_PRIORITY else "standard"
+        enqueued = time.perf_counter()
+
+        if self.in_flight < self.max_concurrency and not self._queue:
+            self.in_flight += 1
+            self._update_gauges()
+            metrics.histogram("upstream_queue_wait_seconds",
+                              tier=tier).observe(0.0)
+            return
+
+        start = self._start_tag(tier, user_id, weight)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (TIER_PRIORITY[tier], start, next(
+            self._seq), tier, future))
+        self._update_gauges()
+
+        # nobody waits for a slot past the request's deadline
+        max_wait = cap_timeout(self.max_queue_wait)
+        try:
+            await asyncio.wait_for(future, max_wait)
+        except asyncio.TimeoutError:
+            if max_wait < self.max_queue_wait:
+                raise deadline_exceeded("upstream_queue", tier=tier)
+            metrics.counter("upstream_queue_timeouts_total", tier=tier).inc()
+            raise get_upstream_busy_exception()
+        except asyncio.CancelledError:
+            # the slot may have been handed over right before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+        finally:
+            self._update_gauges()
+
+        metrics.histogram("upstream_queue_wait_seconds", tier=tier).observe(
+            time.perf_counter() - enqueued)
+
+    def try_acquire(self):
+        # a slot only if one is free and nobody is waiting for it, for work
+        # that is worth doing only when it costs no one anything
+        if self.in_flight < self.max_concurrency and not any(not e[-1].done() for e in self._queue):
+            self.in_flight += 1
+            self._update_gauges()
+            return True
+        return False
+
+    def release(self):
+        while self._queue:
+            _, start, _, tier, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            # hand the slot over directly, in_flight stays the same
+            self._virtual_time[tier] = start
+            future.set_result(None)
+            self._update_gauges()
+            return
+
+        self.in_flight -= 1
+        self._update_gauges()
+
+    @asynccontextmanager
+    async def slot(self, tier, user_id, weight=1.0):
+        await self.acquire(tier, user_id, weight)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+upstream_scheduler = UpstreamScheduler()
+
+
+# exceptions
+def get_upstream_busy_exception():
+    upstream_busy_exception = HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="The service is overloaded, please retry later",
+        headers={"Retry-After": str(int(UPSTREAM_MAX_QUEUE_WAIT) or 1)}
+    )
+    return upstream_busy_exception
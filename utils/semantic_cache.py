@@ -0,0 +1,135 @@
+import hashlib
+import time
+import unicodedata
+from collections import OrderedDict
+import logger.app_logger as app_logger
+from logger.app_logger_formatter import CustomFormatter
+import utils.metrics as metrics
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# off: disabled, shadow: look up and compare with the upstream answer but
+# always call upstream, on: serve hits from the cache
+SEMANTIC_CACHE_MODE = os.environ.get("SEMANTIC_CACHE_MODE", "off").lower()
+SEMANTIC_CACHE_MAX_DISTANCE = int(
+    os.environ.get("SEMANTIC_CACHE_MAX_DISTANCE", 3))
+SEMANTIC_CACHE_MAX_ENTRIES = int(
+    os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 10000))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", 86400))
+SEMANTIC_CACHE_SHINGLE = 4
+SHADOW_LOG_EVERY = 100
+
+formatter = CustomFormatter("%(asctime)s")
+logger = app_logger.get_logger(__name__, formatter)
+
+
+def normalize(text):
+    # casing, accents, punctuation, symbols (emoji included) and whitespace
+    # do not change a language or sentiment label
+    text = unicodedata.normalize("NFKD", text).casefold()
+    kept = []
+    for c in text:
+        category = unicodedata.category(c)
+        if category == "Mn":
+            continue
+        kept.append(" " if category[0] in "PSC" else c)
+    return " ".join("".join(kept).split())
+
+
+def simhash(text):
+    shingles = {text[i:i + SEMANTIC_CACHE_SHINGLE]
+                for i in range(max(1, len(text) - SEMANTIC_CACHE_SHINGLE + 1))}
+    weights = [0] * 64
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(
+            shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+class SemanticCache:
+    # fingerprints are split into max_distance + 1 bands: two fingerprints
+    # within max_distance bits of each other share at least one band exactly,
+    # so candidates are found with max_distance + 1 dictionary lookups
+    def __init__(self, name, mode=SEMANTIC_CACHE_MODE, max_distance=SEMANTIC_CACHE_MAX_DISTANCE,
+                 max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl=SEMANTIC_CACHE_TTL):
+        self.name = name
+        self.mode = mode
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bands = max_distance + 1
+        self.band_bits = 64 // self.bands
+        self._entries = OrderedDict()
+        self._index = [{} for _ in range(self.bands)]
+        self._compared = 0
+        self._agreed = 0
+
+    def _band_keys(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [fingerprint >> (i * self.band_bits) & mask for i in range(self.bands)]
+
+    def fingerprint(self, text):
+        normalized = normalize(text)
+        return simhash(normalized) if normalized else None
+
+    def get(self, fingerprint):
+        if fingerprint is None:
+            return None
+
+        now = time.monotonic()
+        best = None
+        best_distance = self.max_distance + 1
+        for band, key in zip(self._index, self._band_keys(fingerprint)):
+            for candidate in band.get(key, ()):
+                distance = bin(candidate ^ fingerprint).count("1")
+                if distance < best_distance and self._entries[candidate][0] > now:
+                    best, best_distance = candidate, distance
+
+        result = "hit" if best is not None else "miss"
+        metrics.counter("semantic_cache_lookups_total",
+                        service=self.name, result=result).inc()
+        if best is None:
+            return None
+        self._entries.move_to_end(best)
+        return self._entries[best][1]
+
+    def put(self, fingerprint, response):
+        if fingerprint is None:
+            return
+
+        if fingerprint in self._entries:
+            self._entries.move_to_end(fingerprint)
+        else:
+            for band, key in zip(self._index, self._band_keys(fingerprint)):
+                band.setdefault(key, set()).add(fingerprint)
+        self._entries[fingerprint] = (time.monotonic() + self.ttl, response)
+
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            for band, key in zip(self._index, self._band_keys(evicted)):
+                members = band[key]
+                members.discard(evicted)
+                if not members:
+                    del band[key]
+            metrics.counter("semantic_cache_evictions_total",
+                            service=self.name).inc()
+
+        metrics.gauge("semantic_cache_entries", service=self.name).set(
+            len(self._entries))
+
+    def compare(self, cached, response):
+        # shadow mode bookkeeping: would the cached answer have matched?
+        agreed = normalize(cached["choices"][0]["text"]) == normalize(
+            response["choices"][0]["text"])
+        self._compared += 1
+        self._agreed += agreed
+        metrics.counter("semantic_cache_shadow_comparisons_total",
+                        service=self.name, agreed=str(agreed).lower()).inc()
+        if self._compared % SHADOW_LOG_EVERY == 0:
+            logger.info(f"Semantic cache shadow agreement for {self.name}: "
+                        f"{self._agreed / self._compared:.3f} over {self._compared} comparisons")
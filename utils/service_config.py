@@ -0,0 +1,84 @@
+import json
+import threading
+import time
+import models.models as models
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+COST_BY_TOKEN = float(os.environ["COST_BY_TOKEN"])
+DEFAULT_MODEL = os.environ.get("ENGINE")
+# price per token by model, e.g. {"text-davinci-003": 0.00002}
+MODEL_PRICING = json.loads(os.environ.get("MODEL_PRICING", "{}"))
+SERVICE_CONFIG_TTL = float(os.environ.get("SERVICE_CONFIG_TTL", 30))
+
+GENERATION_COLUMNS = ("model", "temperature", "max_tokens")
+
+_lock = threading.Lock()
+_cache = {"configs": None, "loaded": 0.0}
+
+
+def config_from_row(service):
+    # only the columns that are set override the service's defaults
+    generation = {c: getattr(service, c) for c in GENERATION_COLUMNS
+                  if getattr(service, c) is not None}
+    if service.stop:
+        generation["stop"] = json.loads(service.stop)
+    return {"is_active": service.is_active, "generation": generation,
+            "cost_by_token": service.cost_by_token}
+
+
+def load_service_configs(db):
+    configs = {s.id: config_from_row(s)
+               for s in db.query(models.Services).all()}
+    with _lock:
+        _cache["configs"] = configs
+        _cache["loaded"] = time.monotonic()
+    return configs
+
+
+def get_service_configs(db):
+    # the services table is tiny and changes rarely, it is read as a whole at
+    # most once per SERVICE_CONFIG_TTL; writes in this process invalidate it
+    configs = _cache["configs"]
+    if configs is None or time.monotonic() - _cache["loaded"] > SERVICE_CONFIG_TTL:
+        configs = load_service_configs(db)
+    return configs
+
+
+def cached_service_config(service_id):
+    # None when the config has to be loaded, so callers on the event loop
+    # only go to the threadpool when the DB is actually read
+    configs = _cache["configs"]
+    if configs is None or time.monotonic() - _cache["loaded"] > SERVICE_CONFIG_TTL:
+        return None
+    return configs.get(service_id)
+
+
+def get_service_config(db, service_id):
+    configs = get_service_configs(db)
+    if service_id not in configs:
+        configs = load_service_configs(db)
+    return configs.get(service_id)
+
+
+def invalidate_service_configs():
+    _cache["configs"] = None
+
+
+def token_price(configs, service_id, model):
+    # a price set on the service wins over the model's list price
+    config = configs.get(service_id)
+    if config and config["cost_by_token"] is not None:
+        return config["cost_by_token"]
+    return MODEL_PRICING.get(model, COST_BY_TOKEN)
+
+
+def service_price(configs, service_id):
+    # price of the model the service is configured to use right now
+    config = configs.get(service_id)
+    model = config["generation"].get(
+        "model", DEFAULT_MODEL) if config else DEFAULT_MODEL
+    return token_price(configs, service_id, model)
@@ -0,0 +1,215 @@
+import asyncio
+import datetime
+import threading
+import time
+import uuid
+from collections import defaultdict
+from sqlalchemy import delete, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+import logger.app_logger as app_logger
+from logger.app_logger_formatter import CustomFormatter
+import models.models as models
+import utils.metrics as metrics
+from database.database import SessionLocal
+from routers.auth import cached_revocation, lookup_revocation
+from utils.http_cache import bump_version
+from utils.rate_limit import record_token_usage
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WS_FLUSH_INTERVAL = float(os.environ.get("WS_FLUSH_INTERVAL", 2))
+WS_MAX_IN_FLIGHT = int(os.environ.get("WS_MAX_IN_FLIGHT", 8))
+# a standard user holds at most one session, its lease is renewed on every
+# flush and taken over by a new session once it has run out
+WS_SESSION_LEASE = float(os.environ.get(
+    "WS_SESSION_LEASE", 3 * WS_FLUSH_INTERVAL))
+# browsers send cookies on cross-site websocket handshakes, only pages served
+# from these origins may open a session; clients without an Origin are allowed
+WS_ALLOWED_ORIGINS = [o.strip() for o in os.environ.get(
+    "WS_ALLOWED_ORIGINS", "https://aiwriter.sagioscode.com").split(",") if o.strip()]
+
+formatter = CustomFormatter("%(asctime)s")
+logger = app_logger.get_logger(__name__, formatter)
+
+
+def origin_allowed(origin):
+    return origin is None or origin in WS_ALLOWED_ORIGINS
+
+
+class SessionAccounting:
+    # same interface as pipeline.DatabaseAccounting, but the balances are kept
+    # in memory for the lifetime of a websocket session and the usage rows are
+    # written in batches by flush() instead of one commit per invocation;
+    # the balances are only safe to spend from one session per user, which
+    # the lease makes sure of
+    blocking = False
+
+    def __init__(self, user, token=None, expires=None):
+        self.user = user
+        self.token = token
+        self.expires = expires
+        self.session_id = uuid.uuid4().hex
+        # why the session has to be closed, None while it may go on
+        self.ended = None
+        self.balances = {}
+        self.pending = []
+        self._lock = threading.Lock()
+
+    def needs_lease(self):
+        return self.user["subscription"] != "premium"
+
+    def claim_lease(self, db):
+        # False while another session of the user holds an unexpired lease
+        leases = models.SessionLeases.__table__
+        now = datetime.datetime.utcnow()
+        values = {"session_id": self.session_id,
+                  "expires_date": now + datetime.timedelta(seconds=WS_SESSION_LEASE)}
+        if db.execute(update(leases).where(leases.c.user_id == self.user["id"]).where(
+                or_(leases.c.session_id == self.session_id, leases.c.expires_date < now)).values(**values)).rowcount:
+            db.commit()
+            return True
+        try:
+            db.execute(insert(leases).values(user_id=self.user["id"], **values))
+            db.commit()
+            return True
+        except IntegrityError:
+            db.rollback()
+            return False
+
+    def release_lease(self, db):
+        leases = models.SessionLeases.__table__
+        db.execute(delete(leases).where(leases.c.user_id == self.user["id"]).where(
+            leases.c.session_id == self.session_id))
+        db.commit()
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    def check(self, db):
+        # run on every flush tick: the token may have been revoked by a
+        # logout since the handshake, and the lease has to be renewed
+        if self.token is not None:
+            revoked = cached_revocation(self.token)
+            if revoked is None:
+                revoked = lookup_revocation(self.token, db)
+            if revoked:
+                self.ended = "Token revoked"
+                return
+        if self.needs_lease() and not self.claim_lease(db):
+            self.ended = "Session lease lost"
+
+    def active(self):
+        if self.ended is None and self.expired():
+            self.ended = "Token expired"
+        return self.ended is None
+
+    def load(self, db):
+        # balances in the DB, minus what is tracked here but not flushed yet
+        rows = db.query(models.Permissions.service_id, models.Permissions.available_tokens).filter(
+            models.Permissions.user_id == self.user["id"]).all()
+        with self._lock:
+            debits = self._debits(self.pending)
+            self.balances = {service_id: available_tokens - debits.get(service_id, 0)
+                             for service_id, available_tokens in rows}
+
+    def available_tokens(self, service_id):
+        return self.balances.get(service_id, 0)
+
+    def track(self, service_id, consumed_tokens, model=None):
+        record_token_usage(self.user["id"], self.user["subscription"],
+                           service_id, consumed_tokens)
+        with self._lock:
+            self.pending.append({"user_id": self.user["id"], "service_id": service_id,
+                                 "insertion_date": datetime.datetime.utcnow(),
+                                 "consumed_tokens": consumed_tokens, "model": model})
+            if self.user["subscription"] != "premium":
+                self.balances[service_id] = self.balances.get(
+                    service_id, 0) - consumed_tokens
+
+    def _debits(self, rows):
+        debits = defaultdict(int)
+        if self.user["subscription"] != "premium":
+            for row in rows:
+                debits[row["service_id"]] += row["consumed_tokens"]
+        return debits
+
+    def flush(self, db):
+        with self._lock:
+            rows, self.pending = self.pending, []
+        if not rows:
+            return 0
+
+        try:
+            db.execute(insert(models.Tracking), rows)
+            # relative updates, other sessions and plain requests of the same
+            # user may be debiting the same rows at the same time
+            for service_id, tokens in self._debits(rows).items():
+                db.execute(update(models.Permissions).where(
+                    models.Permissions.user_id == self.user["id"]).where(
+                    models.Permissions.service_id == service_id).values(
+                    available_tokens=models.Permissions.available_tokens - tokens))
+            db.commit()
+        except Exception:
+            db.rollback()
+            with self._lock:
+                self.pending[:0] = rows
+            metrics.counter("ws_tracking_flush_errors_total").inc()
+            raise
+
+        metrics.counter("ws_tracking_rows_flushed_total").inc(len(rows))
+        if self.user["subscription"] != "premium":
+            bump_version(f"permissions:{self.user['id']}")
+        # picks up changes made outside this session, e.g. an admin top-up
+        self.load(db)
+        return len(rows)
+
+
+def flush_session(accounting):
+    db = SessionLocal()
+    try:
+        return accounting.flush(db)
+    finally:
+        db.close()
+
+
+def check_session(accounting):
+    with SessionLocal() as db:
+        accounting.check(db)
+
+
+def end_session(accounting):
+    db = SessionLocal()
+    try:
+        accounting.flush(db)
+    finally:
+        try:
+            if accounting.needs_lease():
+                accounting.release_lease(db)
+        finally:
+            db.close()
+
+
+async def flush_periodically(accounting, close):
+    # a failed flush keeps its rows queued for the next one; close() is
+    # awaited once the session may not go on, e.g. its token expired
+    while True:
+        interval = WS_FLUSH_INTERVAL
+        if accounting.expires is not None:
+            interval = max(0.0, min(interval, accounting.expires - time.time()))
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(flush_session, accounting)
+        except Exception as e:
+            logger.error(f"Session tracking flush failed: {str(e)}")
+        if accounting.active():
+            try:
+                await run_in_threadpool(check_session, accounting)
+            except Exception as e:
+                logger.error(f"Session check failed: {str(e)}")
+        if not accounting.active():
+            await close(accounting.ended)
+            return
@@ -0,0 +1,63 @@
+import asyncio
+import anyio.to_thread
+import utils.metrics as metrics
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# threads shared by the sync routes and dependencies, run_in_threadpool and
+# the session setup of get_db; anyio's default is 40
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", 40))
+THREADPOOL_SAMPLE_INTERVAL = float(
+    os.environ.get("THREADPOOL_SAMPLE_INTERVAL", 0.5))
+
+_pool = {"limiter": None, "sampler": None}
+
+
+def collect():
+    limiter = _pool["limiter"]
+    if limiter is None:
+        return
+    statistics = limiter.statistics()
+    metrics.gauge("threadpool_capacity").set(statistics.total_tokens)
+    metrics.gauge("threadpool_busy").set(statistics.borrowed_tokens)
+    # calls queued for a thread, the part of the latency nothing else shows
+    metrics.gauge("threadpool_waiting").set(statistics.tasks_waiting)
+
+
+async def sample():
+    # between scrapes the queue is only seen through these samples
+    waiting = metrics.histogram("threadpool_waiting_sampled")
+    busy = metrics.histogram("threadpool_busy_sampled")
+    while True:
+        statistics = _pool["limiter"].statistics()
+        waiting.observe(statistics.tasks_waiting)
+        busy.observe(statistics.borrowed_tokens)
+        if statistics.tasks_waiting:
+            metrics.counter("threadpool_saturated_samples_total").inc()
+        await asyncio.sleep(THREADPOOL_SAMPLE_INTERVAL)
+
+
+def configure_threadpool():
+    # the limiter belongs to the event loop, so this runs on startup
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = THREADPOOL_SIZE
+    _pool["limiter"] = limiter
+    if THREADPOOL_SAMPLE_INTERVAL > 0:
+        _pool["sampler"] = asyncio.create_task(sample())
+
+
+async def stop_sampler():
+    sampler = _pool["sampler"]
+    if sampler is not None:
+        sampler.cancel()
+        try:
+            await sampler
+        except asyncio.CancelledError:
+            pass
+        _pool["sampler"] = None
+
+
+metrics.register_collector(collect)
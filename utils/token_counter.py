@@ -0,0 +1,120 @@
+from string import Formatter
+import regex
+import utils.metrics as metrics
+from utils.tracing import span
+
+# the GPT-2 pre-tokenizer: BPE merges never cross these boundaries, so the
+# token count of a string is the sum of the counts of its pre-tokens
+GPT2_PRETOKENIZER = regex.compile(
+    r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+
+PRETOKEN_CACHE_SIZE = 50000
+PRETOKEN_CACHE_MAX_LENGTH = 32
+
+
+class TemplateTokenCounter:
+    # counts the tokens of a rendered str.format template as the sum of the
+    # counts of its pre-tokens: pre-tokens of the static segments are
+    # tokenized once here, so per request only the pre-tokens coming from
+    # user supplied fields, or straddling a field boundary, reach the
+    # tokenizer, in a single batch
+    def __init__(self, template, tokenizer):
+        self.tokenizer = tokenizer
+        self.formatter = Formatter()
+        self.parts = []
+        self.static_counts = []
+        self.pretoken_counts = {}
+        for literal, field_name, format_spec, conversion in self.formatter.parse(template):
+            if literal:
+                spans = [m.span() for m in GPT2_PRETOKENIZER.finditer(literal)]
+                counts = self._tokenize([literal[s:e] for s, e in spans])
+                self.static_counts.append(dict(zip(spans, counts)))
+                self.parts.append((literal, len(self.static_counts) - 1))
+            if field_name is not None:
+                self.parts.append((None, (field_name, format_spec, conversion)))
+
+    def _tokenize(self, pretokens):
+        with span("tokenize", texts=len(pretokens)):
+            return [len(ids) for ids in self.tokenizer(pretokens)["input_ids"]]
+
+    def _render(self, values):
+        chunks = []
+        static_ranges = []
+        position = 0
+        for literal, info in self.parts:
+            if literal is None:
+                field_name, format_spec, conversion = info
+                value = self.formatter.convert_field(
+                    values[field_name], conversion)
+                text = self.formatter.format_field(value, format_spec or "")
+            else:
+                text = literal
+                static_ranges.append((position, position + len(text), info))
+            chunks.append(text)
+            position += len(text)
+        return "".join(chunks), static_ranges
+
+    def count(self, values: dict):
+        text, static_ranges = self._render(values)
+
+        total = 0
+        missing = []
+        current = 0
+        for match in GPT2_PRETOKENIZER.finditer(text):
+            start, end = match.span()
+            while current < len(static_ranges) and static_ranges[current][1] <= start:
+                current += 1
+            if current < len(static_ranges):
+                range_start, range_end, index = static_ranges[current]
+                if range_start <= start and end <= range_end:
+                    count = self.static_counts[index].get(
+                        (start - range_start, end - range_start))
+                    if count is not None:
+                        total += count
+                        continue
+            pretoken = match.group()
+            count = self.pretoken_counts.get(pretoken)
+            if count is None:
+                missing.append(pretoken)
+            else:
+                total += count
+
+        if missing:
+            counts = self._tokenize(missing)
+            total += sum(counts)
+            for pretoken, count in zip(missing, counts):
+                if len(pretoken) <= PRETOKEN_CACHE_MAX_LENGTH and len(self.pretoken_counts) < PRETOKEN_CACHE_SIZE:
+                    self.pretoken_counts[pretoken] = count
+        return total
+
+
+def max_token_bytes(tokenizer):
+    # the byte level BPE vocabulary maps one byte to one character
+    return max(len(token) for token in tokenizer.get_vocab())
+
+
+class PromptTokens:
+    # every token is at least one byte and at most max_bytes bytes, so the
+    # UTF-8 length alone often settles a limit check without tokenizing
+    def __init__(self, counter: TemplateTokenCounter, values: dict, text: str, max_bytes: int):
+        self.counter = counter
+        self.values = values
+        self.bytes = len(text.encode("utf-8"))
+        self.lower_bound = -(-self.bytes // max_bytes)
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            metrics.counter("prompt_tokenizations_total").inc()
+            self._count = self.counter.count(self.values)
+        return self._count
+
+    def at_most(self, limit):
+        if self._count is None:
+            if self.bytes <= limit:
+                metrics.counter("prompt_tokenizations_skipped_total").inc()
+                return True
+            if self.lower_bound > limit:
+                metrics.counter("prompt_tokenizations_skipped_total").inc()
+                return False
+        return self.count() <= limit
@@ -0,0 +1,364 @@
+import abc
+import contextvars
+import importlib
+import json
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+import httpx
+import logger.app_logger as app_logger
+from logger.app_logger_formatter import CustomFormatter
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "false").lower() == "true"
+# share of the requests without a sampled traceparent that start a trace
+TRACING_SAMPLE_RATE = float(os.environ.get("TRACING_SAMPLE_RATE", 0.01))
+# "ring", "jsonl", "otlp" or "module:attr" of an exporter
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "ring")
+TRACING_RING_SIZE = int(os.environ.get("TRACING_RING_SIZE", 2048))
+TRACING_FILE = os.environ.get("TRACING_FILE", "traces.jsonl")
+TRACING_OTLP_ENDPOINT = os.environ.get(
+    "TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACING_OTLP_BATCH = int(os.environ.get("TRACING_OTLP_BATCH", 512))
+TRACING_OTLP_INTERVAL = float(os.environ.get("TRACING_OTLP_INTERVAL", 5))
+TRACING_SERVICE_NAME = os.environ.get("TRACING_SERVICE_NAME", "gpt-tools-api")
+# long SQL is cut, the statements never carry their parameters
+TRACING_MAX_STATEMENT = 500
+
+TRACEPARENT_HEADER = "traceparent"
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+formatter = CustomFormatter("%(asctime)s")
+logger = app_logger.get_logger(__name__, formatter)
+
+# the span of the current request, stage or statement; None when the request
+# is not traced, which is what keeps the unsampled path to one lookup
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "sampled",
+                 "attributes", "start", "end", "error", "_token")
+
+    def __init__(self, name, trace_id, parent_id=None, kind="internal", sampled=True, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.attributes = attributes or {}
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+        self._token = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+                "name": self.name, "kind": self.kind, "start_ns": self.start, "end_ns": self.end,
+                "duration_ms": round((self.end - self.start) / 1e6, 3),
+                "attributes": self.attributes, "error": self.error}
+
+
+class RemoteContext:
+    # the caller's span when this request is not sampled, only kept to
+    # forward its trace upstream
+    __slots__ = ("trace_id", "span_id", "sampled")
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = False
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-00"
+
+
+class RingBufferExporter:
+    # exporters have export(span); this one also recent(limit), the spans
+    # kept in this process, newest last
+    def __init__(self, size=TRACING_RING_SIZE):
+        self._spans = deque(maxlen=size)
+
+    def export(self, span: Span):
+        self._spans.append(span.to_dict())
+
+    def recent(self, limit):
+        spans = list(self._spans)
+        return spans[-limit:] if limit else spans
+
+
+class _BackgroundExporter(abc.ABC):
+    # spans are handed to a thread, exporting never blocks a request
+    name = "tracing"
+
+    def __init__(self):
+        self._spans = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self.run, name=self.name, daemon=True)
+                    self._thread.start()
+        self._spans.put(span.to_dict())
+
+    @abc.abstractmethod
+    def run(self):
+        pass
+
+
+class JsonlExporter(_BackgroundExporter):
+    name = "tracing-jsonl"
+
+    def __init__(self, path=TRACING_FILE):
+        super().__init__()
+        self.path = path
+
+    def run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                span = self._spans.get()
+                f.write(json.dumps(span, separators=(",", ":"), default=str) + "\n")
+                if self._spans.empty():
+                    f.flush()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_OTLP_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+class OtlpHttpExporter(_BackgroundExporter):
+    # OTLP/HTTP with the JSON encoding, which collectors accept on /v1/traces
+    name = "tracing-otlp"
+
+    def __init__(self, endpoint=TRACING_OTLP_ENDPOINT, batch=TRACING_OTLP_BATCH, interval=TRACING_OTLP_INTERVAL):
+        super().__init__()
+        self.endpoint = endpoint
+        self.batch = batch
+        self.interval = interval
+
+    def payload(self, spans):
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACING_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [{
+                "traceId": s["trace_id"], "spanId": s["span_id"], "parentSpanId": s["parent_id"] or "",
+                "name": s["name"], "kind": _OTLP_KINDS[s["kind"]],
+                "startTimeUnixNano": str(s["start_ns"]), "endTimeUnixNano": str(s["end_ns"]),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s["attributes"].items()],
+                "status": {"code": 2, "message": s["error"]} if s["error"] else {}
+            } for s in spans]}]}]}
+
+    def run(self):
+        with httpx.Client(timeout=10) as client:
+            while True:
+                spans = [self._spans.get()]
+                deadline = time.monotonic() + self.interval
+                while len(spans) < self.batch:
+                    try:
+                        spans.append(self._spans.get(
+                            timeout=max(0.0, deadline - time.monotonic())))
+                    except queue.Empty:
+                        break
+                try:
+                    client.post(self.endpoint, json=self.payload(spans)).raise_for_status()
+                except httpx.HTTPError as e:
+                    logger.error(f"Exporting {len(spans)} spans failed: {str(e)}")
+
+
+EXPORTERS = {"ring": RingBufferExporter,
+             "jsonl": JsonlExporter, "otlp": OtlpHttpExporter}
+
+
+def _load_exporter(path):
+    if path in EXPORTERS:
+        return EXPORTERS[path]()
+    module_name, _, attr = path.partition(":")
+    exporter = getattr(importlib.import_module(module_name), attr)
+    return exporter() if isinstance(exporter, type) else exporter
+
+
+exporter = _load_exporter(TRACING_EXPORTER)
+
+
+def parse_traceparent(value):
+    match = TRACEPARENT.match(value.strip().lower()) if value else None
+    if match is None or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return match.group(1), match.group(2), int(match.group(3), 16) & 1 == 1
+
+
+def start_trace(name, traceparent=None, **attributes):
+    # the root span of a request; a sampled caller is always followed, an
+    # unsampled one only passes its trace id on
+    parent = parse_traceparent(traceparent)
+    if parent is not None and not parent[2]:
+        return RemoteContext(parent[0], parent[1])
+    if parent is None and random.random() >= TRACING_SAMPLE_RATE:
+        return None
+    trace_id, parent_id = parent[:2] if parent else ("%032x" % random.getrandbits(128), None)
+    return Span(name, trace_id, parent_id, kind="server", attributes=attributes)
+
+
+def current_span():
+    return _current.get()
+
+
+def open_span(name, kind="internal", **attributes):
+    # for callers that cannot use a with block, the span has to be passed to
+    # close_span; returns None when the request is not sampled
+    parent = _current.get()
+    if parent is None or not parent.sampled:
+        return None
+    span = Span(name, parent.trace_id, parent.span_id, kind, attributes=attributes)
+    span._token = _current.set(span)
+    return span
+
+
+def close_span(span, error=None):
+    span.end = time.time_ns()
+    if error is not None:
+        span.error = f"{error.__class__.__name__}: {error}"[:TRACING_MAX_STATEMENT]
+    if span._token is not None:
+        try:
+            _current.reset(span._token)
+        except ValueError:
+            # closed from another context than it was opened in
+            pass
+        span._token = None
+    if span.sampled:
+        try:
+            exporter.export(span)
+        except Exception as e:
+            logger.error(f"Exporting span {span.name} failed: {str(e)}")
+
+
+class span:
+    # with span("name", key=value) as s: ...; s is None when not sampled
+    __slots__ = ("name", "kind", "attributes", "_span")
+
+    def __init__(self, name, kind="internal", **attributes):
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self._span = None
+
+    def __enter__(self):
+        self._span = open_span(self.name, self.kind, **self.attributes)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is not None:
+            close_span(self._span, exc)
+        return False
+
+
+def inject_headers(headers: dict):
+    # forwards the trace to an outbound call, the current span is its parent
+    current = _current.get()
+    if current is None:
+        return headers
+    return {**headers, TRACEPARENT_HEADER: current.traceparent()}
+
+
+def _route_name(scope):
+    route = scope.get("route")
+    return f"{scope['method']} {route.path if route is not None else scope['path']}"
+
+
+class TraceRequests:
+    # ASGI middleware, outermost, so the server span covers the other
+    # middlewares too; nothing is done for requests that are not sampled
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+        root = start_trace(f"{scope['method']} {scope['path']}", traceparent,
+                           **{"http.method": scope["method"], "http.target": scope["path"]})
+        if root is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_traceparent(message):
+            if message["type"] == "http.response.start":
+                if root.sampled:
+                    root.set("http.status_code", message["status"])
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + \
+                    [(b"traceresponse", root.traceparent().encode("latin-1"))]
+            await send(message)
+
+        token = _current.set(root)
+        error = None
+        try:
+            await self.app(scope, receive, send_traceparent)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _current.reset(token)
+            if root.sampled:
+                root.name = _route_name(scope)
+                close_span(root, error)
+
+
+def instrument_engine(engine):
+    # a span per statement, the listeners are only added with tracing on
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        statement_span = open_span("db.query", "client", **{
+            "db.system": engine.dialect.name,
+            "db.statement": statement[:TRACING_MAX_STATEMENT]})
+        if statement_span is not None:
+            conn.info.setdefault("trace_spans", []).append(statement_span)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("trace_spans")
+        if spans:
+            statement_span = spans.pop()
+            if cursor.rowcount is not None and cursor.rowcount >= 0:
+                statement_span.set("db.rowcount", cursor.rowcount)
+            close_span(statement_span)
+
+    @event.listens_for(engine, "handle_error")
+    def fail_statement(context):
+        spans = context.connection.info.get("trace_spans") if context.connection is not None else None
+        if spans:
+            close_span(spans.pop(), context.original_exception)
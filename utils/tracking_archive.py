@@ -0,0 +1,242 @@
+import datetime
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+from itertools import accumulate
+from sqlalchemy import func
+import utils.metrics as metrics
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRACKING_ARCHIVE_DIR = os.environ.get(
+    "TRACKING_ARCHIVE_DIR", os.path.join("archive", "tracking"))
+TRACKING_RETENTION_DAYS = int(os.environ.get("TRACKING_RETENTION_DAYS", 90))
+TRACKING_ARCHIVE_LEVEL = int(os.environ.get("TRACKING_ARCHIVE_LEVEL", 6))
+
+# segment layout: MAGIC, a little-endian uint32 header length, a JSON header
+# and one zlib-compressed int64 array per column. ids and timestamps are
+# sorted within a segment and stored as deltas, which compress far better;
+# strings are stored as positions in a per-segment dictionary, -1 for NULL;
+# NULL in the other nullable columns is the smallest int64, left out of the
+# column's min and max
+MAGIC = b"TSEG1\n"
+COLUMNS = ("id", "user_id", "service_id", "insertion_date", "consumed_tokens", "model")
+DELTA_COLUMNS = ("id", "insertion_date")
+DICTIONARY_COLUMNS = ("model",)
+NULLABLE_COLUMNS = ("user_id", "service_id", "consumed_tokens")
+NULL = -2 ** 63
+INDEX_FILE = "index.json"
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_index_lock = threading.Lock()
+_index_cache = {"mtime": None, "segments": []}
+
+
+def to_micros(value):
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(value):
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def encode_column(name, values):
+    if name in DELTA_COLUMNS:
+        values = [b - a for a, b in zip([0] + values[:-1], values)]
+    return zlib.compress(array("q", values).tobytes(), TRACKING_ARCHIVE_LEVEL)
+
+
+def decode_column(name, blob):
+    values = array("q")
+    values.frombytes(zlib.decompress(blob))
+    if name in DELTA_COLUMNS:
+        values = array("q", accumulate(values))
+    return values
+
+
+def write_segment(directory, day, rows):
+    # rows are tuples in COLUMNS order
+    rows = sorted(rows, key=lambda row: row[0])
+    columns = {name: [row[i] for row in rows] for i, name in enumerate(COLUMNS)}
+    columns["insertion_date"] = [to_micros(d) for d in columns["insertion_date"]]
+
+    header = {"date": day.isoformat(), "rows": len(rows), "columns": {}, "dictionaries": {}}
+    for name in DICTIONARY_COLUMNS:
+        dictionary = sorted({v for v in columns[name] if v is not None})
+        positions = {v: i for i, v in enumerate(dictionary)}
+        columns[name] = [positions.get(v, -1) for v in columns[name]]
+        header["dictionaries"][name] = dictionary
+    for name in NULLABLE_COLUMNS:
+        columns[name] = [NULL if v is None else v for v in columns[name]]
+    blobs = []
+    offset = 0
+    for name in COLUMNS:
+        blob = encode_column(name, columns[name])
+        present = [v for v in columns[name] if v != NULL]
+        header["columns"][name] = {"offset": offset, "length": len(blob),
+                                   "min": min(present, default=None), "max": max(present, default=None)}
+        blobs.append(blob)
+        offset += len(blob)
+
+    # several runs can archive rows of the same day, each one adds a part
+    part = 0
+    while os.path.exists(os.path.join(directory, f"{day.isoformat()}.{part}.seg")):
+        part += 1
+    filename = f"{day.isoformat()}.{part}.seg"
+
+    encoded = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    tmp_path = os.path.join(directory, filename + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(encoded)))
+        f.write(encoded)
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    return filename, tmp_path, header
+
+
+def publish_segment(directory, filename, tmp_path, header):
+    os.replace(tmp_path, os.path.join(directory, filename))
+    with _index_lock:
+        index = load_index(directory)
+        index.append({"file": filename, "date": header["date"], "rows": header["rows"],
+                      **{f"{name}_{bound}": header["columns"][name][bound]
+                         for name in ("id", "user_id", "service_id") for bound in ("min", "max")}})
+        tmp_index = os.path.join(directory, INDEX_FILE + ".tmp")
+        with open(tmp_index, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_index, os.path.join(directory, INDEX_FILE))
+
+
+def load_index(directory=TRACKING_ARCHIVE_DIR):
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_segments(directory=TRACKING_ARCHIVE_DIR):
+    # the index is re-read only when the retention job has rewritten it
+    path = os.path.join(directory, INDEX_FILE)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    if _index_cache["mtime"] != mtime:
+        _index_cache["segments"] = load_index(directory)
+        _index_cache["mtime"] = mtime
+    return _index_cache["segments"]
+
+
+def overlaps(segment, start_date, end_date, user_id, service_id):
+    day = datetime.date.fromisoformat(segment["date"])
+    if start_date and end_date and not start_date <= day <= end_date:
+        return False
+    # bounds are None when every value in the segment is NULL
+    if user_id is not None and (segment["user_id_min"] is None or
+                                not segment["user_id_min"] <= user_id <= segment["user_id_max"]):
+        return False
+    if service_id is not None and (segment["service_id_min"] is None or
+                                   not segment["service_id_min"] <= service_id <= segment["service_id_max"]):
+        return False
+    return True
+
+
+def read_segment(path):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a tracking segment")
+        start = len(MAGIC) + 4
+        (header_length,) = struct.unpack("<I", m[len(MAGIC):start])
+        header = json.loads(m[start:start + header_length])
+        base = start + header_length
+        view = memoryview(m)
+        try:
+            columns = {name: decode_column(name, view[base + c["offset"]:base + c["offset"] + c["length"]])
+                       for name, c in header["columns"].items()}
+        finally:
+            view.release()
+    for name, dictionary in header.get("dictionaries", {}).items():
+        columns[name] = [dictionary[i] if i >= 0 else None for i in columns[name]]
+    for name in NULLABLE_COLUMNS:
+        if name in columns and NULL in columns[name]:
+            columns[name] = [None if v == NULL else v for v in columns[name]]
+    return columns
+
+
+def read_archived(start_date=None, end_date=None, user_id=None, service_id=None,
+                  directory=TRACKING_ARCHIVE_DIR):
+    # only full-day partitions are archived, so a date range selects whole
+    # segments and rows never need to be filtered by date
+    data = []
+    for segment in get_segments(directory):
+        if not overlaps(segment, start_date, end_date, user_id, service_id):
+            continue
+        metrics.counter("tracking_archive_segments_read_total").inc()
+        columns = read_segment(os.path.join(directory, segment["file"]))
+        for i in range(len(columns["id"])):
+            if user_id is not None and columns["user_id"][i] != user_id:
+                continue
+            if service_id is not None and columns["service_id"][i] != service_id:
+                continue
+            data.append({"id": columns["id"][i], "user_id": columns["user_id"][i],
+                         "service_id": columns["service_id"][i],
+                         "insertion_date": from_micros(columns["insertion_date"][i]),
+                         "consumed_tokens": columns["consumed_tokens"][i],
+                         "model": columns["model"][i] if "model" in columns else None})
+    return data
+
+
+def archive_tracking(db, tracking, cutoff, directory=TRACKING_ARCHIVE_DIR, dry_run=False):
+    # moves every row inserted before the cutoff date, one day at a time; the
+    # rows are deleted in the same transaction that publishes the segment, a
+    # crash in between leaves rows in both places and readers drop duplicates
+    os.makedirs(directory, exist_ok=True)
+    cutoff = datetime.datetime.combine(cutoff, datetime.time())
+    columns = [getattr(tracking.c, name) for name in COLUMNS]
+
+    report = []
+    lower = None
+    while True:
+        query = tracking.select().with_only_columns(func.min(tracking.c.insertion_date)).where(
+            tracking.c.insertion_date < cutoff)
+        if lower is not None:
+            query = query.where(tracking.c.insertion_date >= lower)
+        first = db.execute(query).scalar()
+        if first is None:
+            break
+
+        day = first.date()
+        day_start = datetime.datetime.combine(day, datetime.time())
+        lower = day_start + datetime.timedelta(days=1)
+        rows = [tuple(r) for r in db.execute(tracking.select().with_only_columns(*columns).where(
+            tracking.c.insertion_date >= day_start).where(tracking.c.insertion_date < lower))]
+
+        report.append({"date": day.isoformat(), "rows": len(rows)})
+        if dry_run:
+            continue
+
+        filename, tmp_path, header = write_segment(directory, day, rows)
+        ids = [r[0] for r in rows]
+        try:
+            for start in range(0, len(ids), 1000):
+                db.execute(tracking.delete().where(
+                    tracking.c.id.in_(ids[start:start + 1000])))
+            publish_segment(directory, filename, tmp_path, header)
+        except Exception:
+            db.rollback()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        db.commit()
+        metrics.counter("tracking_archived_rows_total").inc(len(rows))
+    return report
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import queue
+import random
+import threading
+import time
+from starlette.requests import Request
+import logger.app_logger as app_logger
+from logger.app_logger_formatter import CustomFormatter
+from routers.auth import decode_access_token
+from security.oauth2 import get_authorization_scheme_param
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CAPTURE_TRAFFIC = os.environ.get("CAPTURE_TRAFFIC", "false").lower() == "true"
+CAPTURE_TRAFFIC_FILE = os.environ.get("CAPTURE_TRAFFIC_FILE", "traffic.jsonl")
+CAPTURE_TRAFFIC_SAMPLE = float(os.environ.get("CAPTURE_TRAFFIC_SAMPLE", 1.0))
+CAPTURE_USER_BUCKETS = int(os.environ.get("CAPTURE_USER_BUCKETS", 100))
+# shared by every worker of a capture so that a user lands in the same bucket
+# in all of them; a random one per process is only right with a single worker
+CAPTURE_TRAFFIC_SALT = os.environ.get("CAPTURE_TRAFFIC_SALT")
+# bodies of GPT responses are read for their usage up to this size
+CAPTURE_MAX_USAGE_BODY = 65536
+
+GPT_PREFIX = "/api/v1/services/gpt-3/"
+
+# path and query values kept as they are, they name services, roles and
+# dates rather than people
+PUBLIC_PARAMS = {"service_id", "service_name", "family",
+                 "role", "subscription", "start_date", "end_date"}
+
+formatter = CustomFormatter("%(asctime)s")
+logger = app_logger.get_logger(__name__, formatter)
+
+_records = queue.SimpleQueue()
+_writer = {"thread": None}
+_writer_lock = threading.Lock()
+_salt = CAPTURE_TRAFFIC_SALT.encode() if CAPTURE_TRAFFIC_SALT else os.urandom(16)
+if CAPTURE_TRAFFIC and not CAPTURE_TRAFFIC_SALT:
+    logger.warning(
+        "CAPTURE_TRAFFIC_SALT is not set, user buckets differ between workers")
+
+
+def shape(value):
+    # the body without its content: strings become their length, so prompts
+    # can be replayed with the same sizes and nothing users wrote is kept
+    if isinstance(value, dict):
+        return {k: shape(v) for k, v in value.items() if k != "password"}
+    if isinstance(value, list):
+        return [shape(v) for v in value]
+    if isinstance(value, str):
+        return {"len": len(value)}
+    return value
+
+
+def bucket(value):
+    # a salted hash, stable within one capture only; keeps repetitions and
+    # the per-user skew without recording the values
+    digest = hashlib.sha256(_salt + str(value).encode()).digest()
+    return int.from_bytes(digest[:4], "big") % CAPTURE_USER_BUCKETS
+
+
+def user_bucket(request: Request):
+    scheme, token = get_authorization_scheme_param(
+        request.cookies.get("access_token"))
+    if scheme.lower() != "bearer":
+        return None, None
+    try:
+        claims = decode_access_token(token)
+    except Exception:
+        return None, None
+    return bucket(claims.get("id")), claims.get("subscription")
+
+
+def sanitize_params(params, keep_unknown):
+    # ids of users and jobs become buckets, a user_id in the same bucket as
+    # the caller's is the caller; other path parameters are bucketed too so
+    # the route can still be filled in, other query parameters are dropped
+    kept = {}
+    for key, value in params.items():
+        if key in PUBLIC_PARAMS:
+            kept[key] = value
+        elif keep_unknown or key == "user_id":
+            kept[key] = {"bucket": bucket(value)}
+    return kept
+
+
+def write_records():
+    # every worker appends to the same file: one unbuffered write per line on
+    # an O_APPEND descriptor keeps their lines from interleaving
+    fd = os.open(CAPTURE_TRAFFIC_FILE, os.O_WRONLY |
+                 os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        while True:
+            record = _records.get()
+            os.write(fd, (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+def start_writer():
+    with _writer_lock:
+        if _writer["thread"] is None:
+            _writer["thread"] = threading.Thread(
+                target=write_records, name="traffic-capture", daemon=True)
+            _writer["thread"].start()
+
+
+class TrafficCapture:
+    # ASGI middleware rather than an "http" one: it sees the request body as
+    # the endpoint reads it and the response as it is sent, without
+    # buffering either
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not CAPTURE_TRAFFIC or random.random() >= CAPTURE_TRAFFIC_SAMPLE:
+            await self.app(scope, receive, send)
+            return
+
+        body = bytearray()
+        response = {"status": None, "bytes": 0, "body": bytearray()}
+        keep_body = scope["path"].startswith(GPT_PREFIX)
+
+        async def tee_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                body.extend(message.get("body", b""))
+            return message
+
+        async def tee_send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                response["bytes"] += len(chunk)
+                # the token counts are only in the body of GPT responses
+                if keep_body and len(response["body"]) + len(chunk) <= CAPTURE_MAX_USAGE_BODY:
+                    response["body"].extend(chunk)
+            await send(message)
+
+        started = time.time()
+        try:
+            await self.app(scope, tee_receive, tee_send)
+        finally:
+            try:
+                record = make_record(Request(scope), started, time.time() - started,
+                                     bytes(body), response)
+            except Exception as e:
+                logger.error(f"Traffic capture failed: {str(e)}")
+            else:
+                start_writer()
+                _records.put(record)
+
+
+def make_record(request, started, elapsed, body, response):
+    route = request.scope.get("route")
+    record = {"ts": round(started, 6), "method": request.method,
+              "route": route.path if route is not None else None,
+              "path_params": sanitize_params(request.path_params, True),
+              "query": sanitize_params(request.query_params, False),
+              "status": response["status"], "duration_ms": round(elapsed * 1000, 3),
+              "request_bytes": len(body), "response_bytes": response["bytes"],
+              "content_type": request.headers.get("content-type"),
+              "idempotency_key": "idempotency-key" in request.headers}
+    record["user_bucket"], record["subscription"] = user_bucket(request)
+    if body and (record["content_type"] or "").startswith("application/json"):
+        try:
+            record["body_shape"] = shape(json.loads(body))
+        except ValueError:
+            pass
+    if response["body"]:
+        try:
+            record["usage"] = json.loads(bytes(response["body"])).get("usage")
+        except (ValueError, AttributeError):
+            pass
+    return record